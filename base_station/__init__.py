@@ -1,10 +1,13 @@
 import asyncio
+import collections
 import json
 import os
 import pathlib
-import sqlite3
+import queue
+import time
 import traceback
 import ssl
+import uuid
 
 import serde
 import websockets
@@ -12,15 +15,47 @@ import typing as t
 import logging
 import logging.handlers
 from common import *
-from base_station.util import LOG_LEVELS, Client
+from base_station.util import LOG_LEVELS, Client, LogThrottle, parse_path, authenticate
+from base_station.storage import SensorStore
+from base_station.nmea_archive import NmeaArchive, NmeaArchiveReader
+from base_station.metrics import MetricsRegistry, serve_metrics
+from base_station.replay import Replay, merge_by_time, read_camera_frames, read_nmea, read_sensor_data
+from camera_archive import CameraArchiveReader
 
 
 class RoverBaseStation:
-    def __init__(self):
+    def __init__(self, worker_id: t.Optional[int] = None, registry: t.Optional[t.MutableMapping[int, list]] = None):
+        """
+        :param worker_id: This station's index if it is a worker behind the front process, see `base_station.front`
+        :param registry: Clients of every worker by worker index, shared between the workers
+        """
         self.module_path = pathlib.Path(os.path.dirname(__file__))
+        self.worker_id = worker_id
+        self.registry = registry
 
-        # Clients collection
+        # Clients collection, also indexed by role
         self.clients: t.Set[Client] = set()
+        self.clients_by_role: t.Dict[Role, t.Set[Client]] = {role: set() for role in Role}
+
+        # Routing table: connected rovers by username, and the drivers subscribed to each rover. A driver subscribed
+        # to all rovers is in every rover's set, so routing a message is a single lookup.
+        self.rovers: t.Dict[str, Client] = {}
+        self.subscribers: t.Dict[str, t.Set[Client]] = {}
+        self.all_rovers_subscribers: t.Set[Client] = set()
+
+        # Running history streams and registry updates, kept so they aren't garbage collected
+        self.background_tasks: t.Set[asyncio.Task] = set()
+        # Running replays and their tasks by driver and replay id
+        self.replays: t.Dict[t.Tuple[Client, str], t.Tuple[Replay, asyncio.Task]] = {}
+        # Camera frames archived by camera_server.py, played back with telemetry
+        camera_archive_path = os.environ.get("SANDSHARK_CAMERA_ARCHIVE", self.module_path.parent / "camera_archive")
+        self.camera_archive = CameraArchiveReader(camera_archive_path) if camera_archive_path else None
+
+        # Latency of each hop of traced commands
+        self.latency: t.DefaultDict[str, LatencyHistogram] = collections.defaultdict(LatencyHistogram)
+        # When each traced command still running was forwarded to the rover, and the hops already recorded for it
+        self.command_traces: t.OrderedDict[str, t.Tuple[int, t.Set[str]]] = collections.OrderedDict()
+        self.max_command_traces = 1000
 
         # #  LOGGING CONFIGURATION  # #
         # Create formatter
@@ -35,14 +70,21 @@ class RoverBaseStation:
         stream_handl.setLevel(logging.INFO)
         # File handler
         file_handl = logging.handlers.TimedRotatingFileHandler(
-            self.module_path / "logs" / "base_station.log",
+            # Each worker has its own file, rotating a file shared between processes would lose records
+            self.module_path / "logs" / ("base_station.log" if worker_id is None else f"base_station-{worker_id}.log"),
             when="midnight",
             interval=1
         )
         file_handl.setFormatter(fmt)
         file_handl.setLevel(logging.DEBUG)
 
-        handlers = [stream_handl, file_handl]
+        # Records are only queued on the event loop; a background thread formats and writes them, so a burst of
+        # errors never blocks the loop on disk I/O
+        log_queue = queue.SimpleQueue()
+        self.log_listener = logging.handlers.QueueListener(
+            log_queue, stream_handl, file_handl, respect_handler_level=True
+        )
+        queue_handl = logging.handlers.QueueHandler(log_queue)
         # Logger setup
         for logger, level in {
             "sandshark": logging.DEBUG,
@@ -50,31 +92,84 @@ class RoverBaseStation:
         }.items():
             logger = logging.getLogger(logger)
             logger.setLevel(level)
-            for handler in handlers:
-                logger.addHandler(handler)
+            logger.addHandler(queue_handl)
+        self.log_listener.start()
 
         # Main logger
         self.logger = logging.getLogger("sandshark")
 
-        # Connect to sensor data database and initialize
-        self.db = sqlite3.connect(self.module_path / "sensor_data" / "data.db")
-        self.db.executescript("""
-            begin;
-            create table if not exists sensors (
-                id integer primary key autoincrement,
-                time integer,
-                sensor text,
-                measurement text,
-                value float
-            );
-            
-            create table if not exists nmea (
-                id integer primary key autoincrement,
-                time integer,
-                sentence text
-            );
-            commit;
-        """)
+        # Logs broadcast to drivers are filtered by level, deduplicated and rate limited
+        driver_level = os.environ.get("SANDSHARK_DRIVER_LOG_LEVEL", "info").lower()
+        self.driver_log_level = LOG_LEVELS.get(driver_level, logging.INFO)
+        self.log_throttle = LogThrottle()
+
+        # Open sensor data database, written to in batches from a background thread
+        self.store = SensorStore(self.module_path / "sensor_data" / "data.db")
+        # NMEA sentences are archived separately, each minute compressed into a block once it's over unless the codec
+        # is "none", and read back for replays through a read-only connection
+        nmea_codec = os.environ.get("SANDSHARK_NMEA_CODEC", "zlib").lower()
+        self.nmea_archive = NmeaArchive(
+            self.module_path / "sensor_data" / "data.db", codec=None if nmea_codec == "none" else nmea_codec
+        )
+        self.nmea_reader = NmeaArchiveReader(self.module_path / "sensor_data" / "data.db")
+
+        # Operational metrics, served locally over HTTP for Prometheus
+        self.metrics = MetricsRegistry()
+        self.messages_received = self.metrics.counter(
+            "sandshark_messages_received_total", "Messages received by type and sender role", ("type", "role")
+        )
+        self.messages_sent = self.metrics.counter(
+            "sandshark_messages_sent_total", "Messages queued to clients by type and recipient role", ("type", "role")
+        )
+        self.handler_seconds = self.metrics.histogram(
+            "sandshark_handler_seconds", "Time spent handling a message by type", ("type",)
+        )
+        self.broadcast_seconds = self.metrics.histogram(
+            "sandshark_broadcast_seconds", "Time to encode a broadcast and queue it on every recipient"
+        )
+        self.loop_lag_seconds = self.metrics.histogram(
+            "sandshark_event_loop_lag_seconds", "How late the event loop runs a task scheduled to wake up"
+        )
+        self.metrics.collected(
+            "sandshark_clients", "Connected clients by role", "gauge", ("role",),
+            lambda: {(role.name,): len(clients) for role, clients in self.clients_by_role.items()}
+        )
+        self.metrics.collected(
+            "sandshark_client_queue_depth", "Frames waiting to be sent to each client", "gauge",
+            ("user", "role", "address"),
+            lambda: {(c.user, c.role.name, c.address): c.queue_depth for c in self.clients}
+        )
+        self.metrics.collected(
+            "sandshark_client_dropped_total", "Droppable frames discarded for each slow client", "counter",
+            ("user", "role", "address"),
+            lambda: {(c.user, c.role.name, c.address): c.dropped for c in self.clients}
+        )
+        self.metrics.add("sandshark_sqlite_insert_seconds", "Time to insert a batch of rows", self.store.insert_seconds)
+        self.metrics.add("sandshark_sqlite_commit_seconds", "Time to commit a batch of rows", self.store.commit_seconds)
+        for stat, kind, help_ in (
+                ("depth", "gauge", "Rows waiting for the sensor database writer"),
+                ("dropped", "counter", "Rows dropped because the writer queue was full"),
+                ("rows_written", "counter", "Rows written to the sensor database"),
+                ("errors", "counter", "Failed sensor database writes")):
+            self.metrics.collected(
+                f"sandshark_sqlite_{stat}" + ("_total" if kind == "counter" else ""),
+                help_, kind, (), lambda stat=stat: {(): self.store.stats()[stat]}
+            )
+        for stat, kind, help_ in (
+                ("depth", "gauge", "Sentences waiting for the NMEA archiver"),
+                ("dropped", "counter", "Sentences dropped because the NMEA archiver queue was full"),
+                ("written", "counter", "Sentences written to the NMEA archive"),
+                ("sealed", "counter", "Minutes of NMEA sentences compressed into blocks"),
+                ("errors", "counter", "Failed NMEA archive writes")):
+            self.metrics.collected(
+                f"sandshark_nmea_{stat}" + ("_total" if kind == "counter" else ""),
+                help_, kind, (), lambda stat=stat: {(): self.nmea_archive.stats()[stat]}
+            )
+        self.metrics.collected(
+            "sandshark_driver_logs_suppressed_total", "Log messages not broadcast to drivers by reason", "counter",
+            ("reason",),
+            lambda: {("repeat",): self.log_throttle.suppressed_repeats, ("rate",): self.log_throttle.suppressed_rate}
+        )
 
         # Load user authentication "database"
         try:
@@ -82,12 +177,17 @@ class RoverBaseStation:
                 self.userbase = json.load(f)
         except FileNotFoundError:
             self.logger.critical("Unable to open rover_users.json: file does not exist.")
+            self.log_listener.stop()
             raise SystemExit(1)
 
         self.logger.info("Rover base station starting!")
 
-    async def main(self):
-        if "SANDSHARK_NOWSS" in os.environ:
+    async def main(self, socket_path: t.Optional[str] = None):
+        """
+        Serves clients until cancelled
+        :param socket_path: Unix socket to serve the front process's relayed connections on, instead of the public port
+        """
+        if "SANDSHARK_NOWSS" in os.environ or socket_path is not None:
             ssl_ctx = None
         else:
             ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
@@ -95,40 +195,141 @@ class RoverBaseStation:
                 self.module_path / "certs" / "fullchain.pem",
                 self.module_path / "certs" / "privkey.pem"
             )
-        async with websockets.serve(
-            self.serve,
-            port=11571,
-            ssl=ssl_ctx
-        ):
-            await asyncio.Future()  # run forever
+        self.store.start()
+        self.nmea_archive.start()
+        metrics_port = int(os.environ.get("SANDSHARK_METRICS_PORT", 11573))
+        if metrics_port:
+            # Workers serve theirs on the following ports
+            await serve_metrics(self.metrics, port=metrics_port + (0 if self.worker_id is None else 1 + self.worker_id))
+        lag_task = asyncio.create_task(self.monitor_loop_lag())
+        log_summary_task = asyncio.create_task(self.send_log_summaries())
+        publish_task = asyncio.create_task(self.publish_clients()) if self.registry is not None else None
+        try:
+            if socket_path is not None:
+                server = websockets.unix_serve(self.serve, socket_path, ping_interval=None)
+            else:
+                server = websockets.serve(self.serve, port=11571, ssl=ssl_ctx)
+            async with server:
+                await asyncio.Future()  # run forever
+        finally:
+            lag_task.cancel()
+            log_summary_task.cancel()
+            if publish_task is not None:
+                publish_task.cancel()
+            # Flush any sensor data still queued
+            self.store.close()
+            self.nmea_archive.close()
+            self.nmea_reader.close()
+            self.log_listener.stop()
+
+    async def monitor_loop_lag(self, interval: float = 0.5):
+        """Measures how late the event loop wakes up a sleeping task, which grows when handlers block it"""
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag_seconds.observe(max(loop.time() - start - interval, 0))
 
     async def broadcast(self, message: Message, role: t.Optional[Role] = None):
         """
-        Send a message to multiple clients
+        Send a message to multiple clients. The message is encoded once per encoding in use and queued on each client,
+        so this never waits on a slow client.
         :param message: The message to send
         :param role: The role to send the message to, or None for all roles
         :return:
         """
-        if role:
-            role_clients = {client for client in self.clients if client.role == role}
-            if role_clients:
-                await asyncio.wait([client.sck.send_msg(message) for client in role_clients])
-        elif self.clients:
-            await asyncio.wait([client.sck.send_msg(message) for client in self.clients])
+        recipients = self.clients_by_role[role] if role else self.clients
+        self.send(message, recipients, role.name if role else "ALL")
+
+    def send(self, message: Message, recipients: t.Collection[Client], role_name: str):
+        """
+        Queues a message on each recipient, encoding it once per encoding in use
+        :param message: The message to send
+        :param recipients: The clients to send the message to
+        :param role_name: The recipients' role, for metrics
+        """
+        if not recipients:
+            return
+        start = time.perf_counter()
+        for client in recipients:
+            client.enqueue(message.encode(client.sck.encoding), message.droppable)
+        self.broadcast_seconds.observe(time.perf_counter() - start)
+        self.messages_sent.inc(message.tag_name, role_name, amount=len(recipients))
+
+    def reply(self, client: Client, message: Message):
+        """
+        Queues the answer to a client's request. Replies are never dropped, even logs reporting that a request failed,
+        and go through the client's queue so they stay in order with everything else sent to it.
+        :param client: The client that made the request
+        :param message: The reply
+        """
+        client.enqueue(message.encode(client.sck.encoding))
+        self.messages_sent.inc(message.tag_name, client.role.name)
+
+    def send_to_rovers(self, message: Message, driver: Client):
+        """Sends a message to the rovers a driver is subscribed to"""
+        if driver.subscriptions is None:
+            recipients = self.rovers.values()
+        else:
+            recipients = [self.rovers[rover] for rover in driver.subscriptions if rover in self.rovers]
+        self.send(message, recipients, Role.ROVER.name)
+
+    def send_to_subscribers(self, message: Message, rover: Client):
+        """Sends a message from a rover to the drivers subscribed to it"""
+        self.send(message, self.subscribers.get(rover.user, self.all_rovers_subscribers), Role.DRIVER.name)
+
+    def subscribe(self, driver: Client, rovers: t.Optional[t.Iterable[str]]):
+        """
+        Replaces the rovers a driver is subscribed to
+        :param driver: The driver
+        :param rovers: Usernames of the rovers, or None for all rovers
+        """
+        self.unsubscribe(driver)
+        if rovers is None:
+            driver.subscriptions = None
+            self.all_rovers_subscribers.add(driver)
+            for subscribers in self.subscribers.values():
+                subscribers.add(driver)
+        else:
+            driver.subscriptions = set(rovers)
+            for rover in driver.subscriptions:
+                self.subscribers.setdefault(rover, set(self.all_rovers_subscribers)).add(driver)
+
+    def unsubscribe(self, driver: Client):
+        """Removes a driver from the routing table"""
+        if driver.subscriptions is None:
+            self.all_rovers_subscribers.discard(driver)
+            for subscribers in self.subscribers.values():
+                subscribers.discard(driver)
+        else:
+            for rover in driver.subscriptions:
+                self.subscribers[rover].discard(driver)
+        driver.subscriptions = set()
 
     async def log(self, message: str, level="info"):
         """
-        Broadcasts a log message to the connected Drivers and writes to local log
+        Broadcasts a log message to the connected Drivers and writes to local log. Messages below the driver log level
+        are only written locally, and repeated or excessive messages aren't broadcast; see `LogThrottle`.
         :param message: The message to send
         :param level: The loglevel or "severity" to indicate (debug, info, warning, error, critical)
         :return:
         """
         if level.lower() in LOG_LEVELS:
-            self.logger.log(LOG_LEVELS[level], message)
+            self.logger.log(LOG_LEVELS[level.lower()], message)
         else:
             self.logger.warning(f"Invalid logging level: {level}")
             self.logger.warning(message)
-        await self.broadcast(LogMessage(message=message, level=level), Role.DRIVER)
+        if LOG_LEVELS.get(level.lower(), logging.WARNING) < self.driver_log_level:
+            return
+        if self.log_throttle.allow(level, message, time.monotonic()):
+            await self.broadcast(LogMessage(message=message, level=level), Role.DRIVER)
+
+    async def send_log_summaries(self, interval: float = 1.0):
+        """Periodically tells drivers how many log messages were suppressed"""
+        while True:
+            await asyncio.sleep(interval)
+            for level, message in self.log_throttle.summaries(time.monotonic()):
+                await self.broadcast(LogMessage(message=message, level=level), Role.DRIVER)
 
     async def register_client(self, sck: websockets.WebSocketServerProtocol, path: str) -> t.Optional[Client]:
         """
@@ -138,22 +339,44 @@ class RoverBaseStation:
         :return: The client object created in registration
         """
         # Determine role client is connecting as
-        role = Role.from_path(path)
+        role, rover = parse_path(path)
+        if role is Role.DRIVER and rover is not None and rover not in self.userbase.values():
+            role = None
         if not role:
             await self.log(f"Client {sck.remote_address[0]} tried to connect with invalid path: {path}", "warning")
+            # Not registered yet, so nothing else is sending to this socket
             await sck.send_msg(LogMessage(message="Invalid path", level="error"))
             await sck.close(1008, "Invalid path")
             return None
 
-        # Authenticate client
-        username = await self.authenticate_client(sck)
-        if username is None:
-            return None  # Close message and reason was already sent
+        if self.worker_id is None:
+            # Authenticate client
+            username = await self.authenticate_client(sck)
+            if username is None:
+                return None  # Close message and reason was already sent
+            remote_address = None
+        else:
+            # The front process already authenticated the client and negotiated its encoding
+            username = sck.request_headers["X-Sandshark-User"]
+            sck.encoding = Encoding(sck.request_headers["X-Sandshark-Encoding"])
+            ip, _, port = sck.request_headers["X-Sandshark-Address"].rpartition(":")
+            remote_address = (ip, int(port))
 
         # Add client
-        await self.log(f"Client {sck.remote_address[0]} connected as user {username} ({role.name})")
-        client = Client(sck, username, role)
+        client = Client(sck, username, role, remote_address=remote_address)
+        await self.log(f"Client {client.ip} connected as user {username} ({role.name})")
         self.clients.add(client)
+        self.clients_by_role[role].add(client)
+        if role is Role.ROVER:
+            if username in self.rovers:
+                await self.log(f"Rover {username} connected again, replacing its previous connection", "warning")
+            self.rovers[username] = client
+            self.subscribers.setdefault(username, set(self.all_rovers_subscribers))
+        else:
+            # Drivers connecting to /driver/<rover> only see that rover, otherwise every rover
+            self.subscribe(client, None if rover is None else [rover])
+        client.start_sender()
+        self.publish_clients_now()
         return client
 
     async def authenticate_client(self, sck: websockets.WebSocketServerProtocol) -> t.Optional[str]:
@@ -162,51 +385,156 @@ class RoverBaseStation:
         :param sck: the socket to authenticate
         :return: the username authenticated, or None if the authentication failed
         """
-        # Receive first message, which should be an `auth` message
-        auth_msg_raw = await sck.recv()
-        try:
-            auth_msg = Message.from_json(auth_msg_raw)
-        # Error if invalid message
-        except (serde.ValidationError, json.JSONDecodeError):
-            await self.log(f"Received invalid auth message from {sck.remote_address[0]}", "error")
-            await sck.send_msg(AuthResponseMessage(success=False, user=None))
-            await sck.send_msg(LogMessage(message="Invalid auth message", level="error"))
-            await sck.close(1002, "Invalid auth message")
-            return None
-        # Error if first message is not of type `auth`
-        if not isinstance(auth_msg, AuthMessage):
-            await self.log(f"Expected auth message but received `{auth_msg.tag_name}` from {sck.remote_address[0]}",
-                           "error")
-            await sck.send_msg(AuthResponseMessage(success=False, user=None))
-            await sck.send_msg(LogMessage(message="Expected an auth message", level="error"))
-            await sck.close(1008, "Expected an auth message on first message")
-            return None
-
-        # Check token
-        user = self.userbase.get(auth_msg.token)
-        if not user:
-            await self.log(f"Client {sck.remote_address[0]} tried to authenticate with unknown token", "warning")
-            await sck.send_msg(AuthResponseMessage(success=False, user=None))
-            await sck.send_msg(LogMessage(message="Authentication failed", level="error"))
-            await sck.close(1008, "Authentication failed")
-            return None
-
-        await sck.send_msg(AuthResponseMessage(success=True, user=user))
-        return user
+        return await authenticate(sck, self.userbase, self.log)
 
     async def unregister_client(self, client: Client):
         """
         Unregisters a client connection
         :param client: The client
         """
+        client.stop_sender()
         if client in self.clients:
             self.clients.remove(client)
+            self.clients_by_role[client.role].discard(client)
+            if client.role is Role.ROVER:
+                if self.rovers.get(client.user) is client:
+                    del self.rovers[client.user]
+            else:
+                self.unsubscribe(client)
+                for key in [key for key in self.replays if key[0] is client]:
+                    self.replays[key][1].cancel()
+            self.publish_clients_now()
             await self.log(f"User {client.user} ({client.role.name}) disconnected with code {client.sck.close_code}",
                            "info" if client.sck.close_code is not None and client.sck.close_code <= 1001 else "warning")
         else:
             await self.log(f"User {client.user} ({client.role.name}) disconnected with code {client.sck.close_code} "
                            f"but was never registered", "warning")
 
+    def client_info(self, client: Client) -> t.Dict[str, t.Any]:
+        """Describes a client for the `clients` query"""
+        return {
+            "user": client.user,
+            "ip": list(client.remote_address),
+            "role": client.role.name,
+            "encoding": client.sck.encoding.value,
+            "queued": client.queue_depth,
+            "dropped": client.dropped,
+            "worker": self.worker_id
+        }
+
+    def publish_clients_now(self):
+        """Updates this worker's entry in the shared client registry in the background"""
+        if self.registry is not None:
+            snapshot = [self.client_info(client) for client in self.clients]
+            task = asyncio.create_task(asyncio.to_thread(self.registry.__setitem__, self.worker_id, snapshot))
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+
+    async def publish_clients(self, interval: float = 1.0):
+        """Periodically publishes this worker's clients, so queue depths seen by other workers stay current"""
+        while True:
+            await asyncio.sleep(interval)
+            self.publish_clients_now()
+
+    async def all_clients(self) -> t.List[t.Dict[str, t.Any]]:
+        """Describes the clients of this station, and of the other workers if it is a worker"""
+        clients = [self.client_info(client) for client in self.clients]
+        if self.registry is not None:
+            registry = await asyncio.to_thread(self.registry.copy)
+            for worker_id, worker_clients in sorted(registry.items()):
+                if worker_id != self.worker_id:
+                    clients.extend(worker_clients)
+        return clients
+
+    def record_trace(self, trace: t.Optional[Trace], hop: t.Optional[str] = None, end: bool = False):
+        """
+        Records the latency of a traced command's hops that weren't recorded yet
+        :param trace: The trace returned by the rover, with the hops it measured
+        :param hop: Name of the hop from forwarding the command to the rover until now
+        :param end: Whether the command ended, so its trace can be forgotten
+        """
+        if trace is None or trace.id not in self.command_traces:
+            return
+        forwarded, recorded = self.command_traces.pop(trace.id) if end else self.command_traces[trace.id]
+        hops = dict(trace.hops)
+        if hop is not None:
+            hops[hop] = time.monotonic_ns() - forwarded
+        for name, duration in hops.items():
+            if name not in recorded:
+                recorded.add(name)
+                self.latency[name].record(duration)
+
+    async def stream_history(self, client: Client, msg: QueryHistoryMessage):
+        """
+        Streams the result of a history query to a client one chunk at a time
+        :param client: The client that sent the query
+        :param msg: The query
+        """
+        limit = min(max(msg.limit, 1), 5000)
+        cursor = msg.cursor
+        try:
+            while True:
+                # Each page is read in a worker thread, and the next isn't read until the previous one is sent
+                tier, points, cursor = await asyncio.to_thread(
+                    self.store.read_history,
+                    msg.sensor, msg.measurement, msg.start, msg.end, msg.resolution, cursor, limit
+                )
+                self.reply(client, QueryHistoryResponseMessage(
+                    id=msg.id,
+                    tier=tier,
+                    points=points,
+                    cursor=cursor,
+                    done=cursor is None
+                ))
+                await client.priority_sent.wait()
+                if cursor is None or client.sck.closed:
+                    break
+        except ValueError:
+            self.reply(client, LogMessage(message=f"Invalid cursor for history query {msg.id}", level="error"))
+        except Exception as e:
+            await self.log(f"Base station error in history query {msg.id} {e!r}: {traceback.format_exc()}", "error")
+
+    def start_replay(self, client: Client, msg: ReplayMessage):
+        """
+        Starts replaying a time range to a driver, replacing its replay with the same id
+        :param client: The driver that requested the replay
+        :param msg: The replay request
+        """
+        previous = self.replays.pop((client, msg.id), None)
+        if previous is not None:
+            previous[1].cancel()
+
+        # Read lazily from each source, merged in time order
+        sources = [read_sensor_data(self.store, msg.start, msg.end), read_nmea(self.nmea_reader, msg.start, msg.end)]
+        if msg.camera and self.camera_archive is not None:
+            sources.append(read_camera_frames(self.camera_archive, msg.start, msg.end))
+        replay = Replay(
+            merge_by_time(*sources),
+            lambda message: self.send(message, (client,), Role.DRIVER.name),
+            msg.start,
+            msg.speed
+        )
+        task = asyncio.create_task(self.run_replay(msg.id, replay))
+        task.add_done_callback(lambda _task: self.replay_ended(client, msg.id, replay, _task))
+        self.replays[(client, msg.id)] = (replay, task)
+
+    async def run_replay(self, replay_id: str, replay: Replay) -> bool:
+        """Plays a replay, returning whether it completed"""
+        try:
+            await replay.run()
+        except Exception as e:
+            await self.log(f"Base station error in replay {replay_id} {e!r}: {traceback.format_exc()}", "error")
+            return False
+        return True
+
+    def replay_ended(self, client: Client, replay_id: str, replay: Replay, task: asyncio.Task):
+        # Called even if the replay was stopped before it started playing
+        if self.replays.get((client, replay_id), (None,))[0] is replay:
+            del self.replays[(client, replay_id)]
+        if client in self.clients:
+            completed = not task.cancelled() and task.result()
+            self.reply(client, ReplayEndedMessage(id=replay_id, position=replay.position, completed=completed))
+
     async def serve(self, sck: websockets.WebSocketServerProtocol, path: str):
         """
         Main entry point for WebSocket server.
@@ -223,7 +551,9 @@ class RoverBaseStation:
             async for msg_raw in client.sck:  # raises websockets.ConnectionClosed on close
                 try:
                     # Decode and verify message formatting
-                    msg = Message.from_json(msg_raw)
+                    msg = decode_message(msg_raw)
+                    # Counted before dispatch so messages without a handler show up too
+                    self.messages_received.inc(msg.tag_name, client.role.name)
                     # Delegate to message handler
                     await message_handlers.get(msg.__class__, default_handler)(self, client, msg)
 
@@ -238,11 +568,18 @@ class RoverBaseStation:
                     await self.log(f"Base station error {e!r}: {traceback.format_exc()}", "error")
 
         except websockets.ConnectionClosed:
-            await self.broadcast(EStopMessage(), Role.ROVER)
-            await self.log(f"Client {client.user} ({client.role.name}) disconnected, activating e-stop!", "warning")
+            # A lost rover stops every rover
+            if client.role is Role.ROVER:
+                await self.broadcast(EStopMessage(), Role.ROVER)
+                await self.log(f"Client {client.user} ({client.role.name}) disconnected, activating e-stop!", "warning")
 
         # Unregister clients when the connection loop ends even if it errors
         finally:
+            # Stop the rovers a driver was controlling however it disconnected, before unregistering drops its
+            # subscriptions
+            if client.role is Role.DRIVER:
+                self.send_to_rovers(EStopMessage(), client)
+                await self.log(f"Client {client.user} ({client.role.name}) disconnected, activating e-stop!", "warning")
             await self.unregister_client(client)
 
 
@@ -250,21 +587,23 @@ class RoverBaseStation:
 message_handlers = {}
 
 
-# Registers a message handler
+# Registers a message handler, timing the messages it handles
 def message_handler(message_type: t.Type, sender: t.Optional[Role] = None):
     def decorate(fn: t.Callable[[RoverBaseStation, Client, Message], t.Coroutine]):
-        if sender is not None:
-            async def wrapper(self: RoverBaseStation, client: Client, msg: Message):
-                if client.role != sender:
-                    await self.log(f"User {client.user} ({client.role.name}) sent"
-                                   f" unexpected {msg.tag_name} message", "error")
-                    return
+        tag_name = message_type.tag_name
+
+        async def wrapper(self: RoverBaseStation, client: Client, msg: Message):
+            if sender is not None and client.role != sender:
+                await self.log(f"User {client.user} ({client.role.name}) sent"
+                               f" unexpected {msg.tag_name} message", "error")
+                return
+            start = time.perf_counter()
+            try:
                 await fn(self, client, msg)
+            finally:
+                self.handler_seconds.observe(time.perf_counter() - start, tag_name)
 
-            message_handlers[message_type] = wrapper
-
-        else:
-            message_handlers[message_type] = fn
+        message_handlers[message_type] = wrapper
 
     return decorate
 
@@ -277,8 +616,15 @@ async def handle_log(self: RoverBaseStation, client: Client, msg: LogMessage):
 
 @message_handler(CommandMessage, Role.DRIVER)
 async def handle_command(self: RoverBaseStation, client: Client, msg: CommandMessage):
-    # Forward command to rover
-    await self.broadcast(msg, Role.ROVER)
+    # Trace every command, drivers may start a trace themselves to measure their own round trip
+    if msg.trace is None:
+        msg.trace = Trace(id=uuid.uuid4().hex)
+    self.command_traces[msg.trace.id] = (time.monotonic_ns(), set())
+    if len(self.command_traces) > self.max_command_traces:
+        self.command_traces.popitem(last=False)
+
+    # Forward command to the driver's rovers
+    self.send_to_rovers(msg, client)
     # Log command
     if msg.command is None:
         await self.log(f"Driver {client.user} cancelled the current command")
@@ -288,88 +634,150 @@ async def handle_command(self: RoverBaseStation, client: Client, msg: CommandMes
 
 @message_handler(CommandEndedMessage, Role.ROVER)
 async def handle_command_ended(self: RoverBaseStation, client: Client, msg: CommandEndedMessage):
-    # Forward to drivers
-    await self.broadcast(msg, Role.DRIVER)
+    self.record_trace(msg.trace, "base.completed" if msg.completed else None, end=True)
+    # Forward to subscribed drivers
+    msg.rover = client.user
+    self.send_to_subscribers(msg, client)
     # Log ending
     await self.log(f"Rover {client.user} completed command {msg.command.tag_name}: {msg.completed}")
 
 
 @message_handler(CommandStatusMessage, Role.ROVER)
-async def handle_command_status(self: RoverBaseStation, _client: Client, msg: CommandStatusMessage):
-    # Forward to drivers
-    await self.broadcast(msg, Role.DRIVER)
+async def handle_command_status(self: RoverBaseStation, client: Client, msg: CommandStatusMessage):
+    self.record_trace(msg.trace, "base.rover_ack")
+    # Forward to subscribed drivers
+    msg.rover = client.user
+    self.send_to_subscribers(msg, client)
 
 
 @message_handler(OptionMessage, Role.DRIVER)
-async def handle_option(self: RoverBaseStation, _client: Client, msg: OptionMessage):
-    # Forward to rover
-    await self.broadcast(msg, Role.ROVER)
+async def handle_option(self: RoverBaseStation, client: Client, msg: OptionMessage):
+    # Forward to the driver's rovers
+    self.send_to_rovers(msg, client)
 
 
 @message_handler(OptionResponseMessage, Role.ROVER)
-async def handle_option_response(self: RoverBaseStation, _client: Client, msg: OptionResponseMessage):
-    # Forward to drivers
-    await self.broadcast(msg, Role.DRIVER)
+async def handle_option_response(self: RoverBaseStation, client: Client, msg: OptionResponseMessage):
+    # Forward to subscribed drivers
+    msg.rover = client.user
+    self.send_to_subscribers(msg, client)
 
 
 @message_handler(SensorDataMessage, Role.ROVER)
-async def handle_sensor_data(self: RoverBaseStation, _client: Client, msg: SensorDataMessage):
-    # Forward to drivers
-    await self.broadcast(msg, Role.DRIVER)
-    self.db.executemany(
-        """
-            insert into sensors (time, sensor, measurement, value)
-            values (?, ?, ?, ?)
-        """,
-        ((msg.time, msg.sensor, measurement, value) for measurement, value in msg.measurements.items())
-    )
-    self.db.commit()
+async def handle_sensor_data(self: RoverBaseStation, client: Client, msg: SensorDataMessage):
+    # Queue for storage first so the write never waits on the broadcast
+    if not self.store.add_sensor_data(msg):
+        self.logger.warning(f"Sensor write queue full, dropped {msg.sensor} reading")
+    # Forward live readings to subscribed drivers, replayed ones are only stored
+    if not msg.replayed:
+        msg.rover = client.user
+        self.send_to_subscribers(msg, client)
 
 
 @message_handler(QueryBaseMessage, Role.DRIVER)
-async def handle_query_base(self: RoverBaseStation, client: Client, msg: QueryBaseMessage):  # TODO
+async def handle_query_base(self: RoverBaseStation, client: Client, msg: QueryBaseMessage):
     match msg.query:
         case "clients":
-            await client.sck.send_msg(QueryBaseResponseMessage(
+            self.reply(client, QueryBaseResponseMessage(
+                query=msg.query,
+                value=await self.all_clients()
+            ))
+        case "storage":
+            self.reply(client, QueryBaseResponseMessage(
+                query=msg.query,
+                value={**self.store.stats(), "nmea": self.nmea_archive.stats()}
+            ))
+        case "rovers":
+            self.reply(client, QueryBaseResponseMessage(
                 query=msg.query,
-                value=[
-                    {
-                        "user": client.user,
-                        "ip": client.sck.remote_address,
-                        "role": client.role.name
-                    }
-                    for client in self.clients
-                ]
+                value={
+                    "connected": sorted(self.rovers),
+                    "subscribed": None if client.subscriptions is None else sorted(client.subscriptions)
+                }
             ))
+        case "latency":
+            self.reply(client, QueryBaseResponseMessage(
+                query=msg.query,
+                value={hop: histogram.summary() for hop, histogram in sorted(self.latency.items())}
+            ))
+        case _:
+            self.reply(client, LogMessage(message=f"Unknown query {msg.query}", level="error"))
+
+
+@message_handler(SubscribeMessage, Role.DRIVER)
+async def handle_subscribe(self: RoverBaseStation, client: Client, msg: SubscribeMessage):
+    if msg.rovers is not None:
+        unknown = set(msg.rovers) - set(self.userbase.values())
+        if unknown:
+            self.reply(client, LogMessage(
+                message=f"Unknown rovers: {', '.join(sorted(unknown))}",
+                level="error"
+            ))
+            return
+    self.subscribe(client, msg.rovers)
+    rovers = "all rovers" if msg.rovers is None else ", ".join(msg.rovers)
+    await self.log(f"Driver {client.user} subscribed to {rovers}")
+
+
+@message_handler(ReplayMessage, Role.DRIVER)
+async def handle_replay(self: RoverBaseStation, client: Client, msg: ReplayMessage):
+    if type(msg.speed) not in (int, float) or msg.speed <= 0 or msg.end <= msg.start:
+        self.reply(client, LogMessage(message=f"Invalid replay {msg.id}", level="error"))
+        return
+    self.start_replay(client, msg)
+    await self.log(f"Driver {client.user} started replay {msg.id} at {msg.speed}x")
+
+
+@message_handler(ReplayControlMessage, Role.DRIVER)
+async def handle_replay_control(self: RoverBaseStation, client: Client, msg: ReplayControlMessage):
+    running = self.replays.get((client, msg.id))
+    if running is None:
+        self.reply(client, LogMessage(message=f"No running replay {msg.id}", level="error"))
+        return
+    replay, task = running
+    if msg.stop:
+        task.cancel()
+    elif msg.speed is not None:
+        if type(msg.speed) not in (int, float) or msg.speed <= 0:
+            self.reply(client, LogMessage(message="Replay speed must be a positive number", level="error"))
+            return
+        replay.set_speed(msg.speed)
+
+
+@message_handler(QueryHistoryMessage, Role.DRIVER)
+async def handle_query_history(self: RoverBaseStation, client: Client, msg: QueryHistoryMessage):
+    # Stream in the background so the client's other messages aren't held up
+    task = asyncio.create_task(self.stream_history(client, msg))
+    self.background_tasks.add(task)
+    task.add_done_callback(self.background_tasks.discard)
 
 
 @message_handler(EStopMessage)
 async def handle_e_stop(self: RoverBaseStation, client: Client, msg: EStopMessage):
-    await self.broadcast(msg, Role.ROVER)
+    # A driver stops the rovers it controls, a rover's e-stop stops every rover
+    if client.role is Role.DRIVER:
+        self.send_to_rovers(msg, client)
+    else:
+        await self.broadcast(msg, Role.ROVER)
     await self.log(f"Client {client.user} ({client.role.name}) activated e-stop!", "warning")
 
 
 @message_handler(PointCameraMessage, Role.DRIVER)
-async def handle_point_camera(self: RoverBaseStation, _client: Client, msg: PointCameraMessage):
-    # Forward to rover
-    await self.broadcast(msg, Role.ROVER)
+async def handle_point_camera(self: RoverBaseStation, client: Client, msg: PointCameraMessage):
+    # Forward to the driver's rovers
+    self.send_to_rovers(msg, client)
 
 
 @message_handler(ArduinoDebugMessage, Role.DRIVER)
-async def handle_arduino_debug(self: RoverBaseStation, _client: Client, msg: ArduinoDebugMessage):
-    # Forward to rover
-    await self.broadcast(msg, Role.ROVER)
+async def handle_arduino_debug(self: RoverBaseStation, client: Client, msg: ArduinoDebugMessage):
+    # Forward to the driver's rovers
+    self.send_to_rovers(msg, client)
 
 
 @message_handler(NmeaMessage, Role.ROVER)
 async def handle_nmea(self: RoverBaseStation, _client: Client, msg: NmeaMessage):
-    self.db.execute(
-        """
-            insert into nmea (time, sentence)
-            values (?, ?)
-        """,
-        (msg.time, msg.sentence)
-    )
+    if not self.nmea_archive.add(msg):
+        self.logger.warning("NMEA archive queue full, dropped NMEA sentence")
 
 
 async def default_handler(self: RoverBaseStation, client: Client, msg: Message):
@@ -1,6 +1,20 @@
+import argparse
 import asyncio
-from base_station import RoverBaseStation
 
-station = RoverBaseStation()
+parser = argparse.ArgumentParser(description="Sandshark rover base station")
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=0,
+    help="relay connections to this many worker processes, sharded by rover (default: serve in a single process)"
+)
+args = parser.parse_args()
 
-asyncio.run(station.main())
+if args.workers > 0:
+    from base_station.front import FrontRouter
+    router = FrontRouter(args.workers)
+    asyncio.run(router.main())
+else:
+    from base_station import RoverBaseStation
+    station = RoverBaseStation()
+    asyncio.run(station.main())
@@ -0,0 +1,52 @@
+"""
+Exports archived NMEA sentences in a time range to a .nmea log file, e.g. for GPS tools that replay logs.
+
+Usage: python -m base_station.export_nmea [--database DATABASE] start end output.nmea
+
+Start and end are ISO 8601 times, e.g. 2023-04-01T12:00:00+00:00 (local time without an offset), or nanoseconds since
+the epoch.
+"""
+import argparse
+import datetime
+import os
+import pathlib
+
+from base_station import storage
+from base_station.nmea_archive import NmeaArchiveReader
+
+
+def parse_time(value: str) -> int:
+    """Parses an ISO 8601 time, or nanoseconds since the epoch, into nanoseconds since the epoch"""
+    if value.isdigit():
+        return int(value)
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.tzinfo is None:
+        moment = moment.astimezone()
+    return int(moment.timestamp()) * storage.SECOND + moment.microsecond * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export archived NMEA sentences to a .nmea log file")
+    parser.add_argument("start", type=parse_time, help="start of the time range, inclusive")
+    parser.add_argument("end", type=parse_time, help="end of the time range, exclusive")
+    parser.add_argument("output", help="path of the .nmea file to write")
+    parser.add_argument(
+        "--database",
+        default=pathlib.Path(os.path.dirname(__file__)) / "sensor_data" / "data.db",
+        help="path to the database (default: base_station/sensor_data/data.db)"
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        parser.error(f"{args.database} does not exist")
+
+    reader = NmeaArchiveReader(args.database)
+    try:
+        count = reader.export(args.output, args.start, args.end)
+    finally:
+        reader.close()
+    print(f"Wrote {count} sentences to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
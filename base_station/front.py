@@ -0,0 +1,220 @@
+"""
+Sharded base station: a front process accepts every connection on the public port, authenticates it and relays it to
+the worker process hosting its rover. Each worker is a `RoverBaseStation` running its own message loops, fan-out and
+sensor storage, so one busy rover or a crowd of spectators doesn't slow down the others.
+
+Rovers are assigned to workers by a hash of their username. Drivers connect to /driver/<rover> to reach the worker
+hosting that rover; with more than one worker, drivers connecting to /driver are rejected since they would only reach
+the rovers of one worker.
+"""
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import pathlib
+import shutil
+import signal
+import ssl
+import tempfile
+import typing as t
+import zlib
+
+import websockets
+
+from common import *
+from base_station import RoverBaseStation, storage
+from base_station.metrics import MetricsRegistry, serve_metrics
+from base_station.util import LOG_LEVELS, authenticate, parse_path
+
+logger = logging.getLogger("sandshark.front")
+
+
+def run_worker(worker_id: int, socket_path: str, registry: t.MutableMapping[int, list]):
+    """Entry point of a worker process"""
+    station = RoverBaseStation(worker_id=worker_id, registry=registry)
+
+    async def run():
+        # Stop cleanly when the front process stops, so queued sensor data is flushed
+        main_task = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, main_task.cancel)
+        await station.main(socket_path)
+
+    try:
+        asyncio.run(run())
+    except asyncio.CancelledError:
+        pass
+
+
+class FrontRouter:
+    def __init__(self, workers: int):
+        """
+        :param workers: Number of worker processes
+        """
+        self.module_path = pathlib.Path(os.path.dirname(__file__))
+        self.worker_count = workers
+
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("{asctime} [{levelname}] [{name}] {message}", style="{"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+        try:
+            with open(self.module_path / "rover_users.json", "r") as f:
+                self.userbase = json.load(f)
+        except FileNotFoundError:
+            logger.critical("Unable to open rover_users.json: file does not exist.")
+            raise SystemExit(1)
+
+        self._ctx = multiprocessing.get_context("spawn")
+        self._manager = None
+        self.registry: t.Optional[t.MutableMapping[int, list]] = None
+        self._socket_dir = tempfile.mkdtemp(prefix="sandshark-")
+        self.socket_paths = [os.path.join(self._socket_dir, f"worker{i}.sock") for i in range(workers)]
+        self.processes: t.List[t.Optional[multiprocessing.Process]] = [None] * workers
+
+        self.metrics = MetricsRegistry()
+        self.connections = self.metrics.gauge(
+            "sandshark_front_connections", "Connections relayed to each worker", ("worker",)
+        )
+        self.relayed = self.metrics.counter(
+            "sandshark_front_relayed_total", "Messages relayed by direction", ("direction",)
+        )
+
+    def shard(self, rover: t.Optional[str]) -> int:
+        """The worker hosting a rover, stable across restarts"""
+        if rover is None:
+            return 0
+        return zlib.crc32(rover.encode()) % self.worker_count
+
+    def start_worker(self, worker_id: int):
+        # Remove the socket of a previous worker so the front can tell when the new one is listening
+        if os.path.exists(self.socket_paths[worker_id]):
+            os.remove(self.socket_paths[worker_id])
+        process = self._ctx.Process(
+            target=run_worker,
+            args=(worker_id, self.socket_paths[worker_id], self.registry),
+            name=f"sandshark-worker-{worker_id}",
+            daemon=True
+        )
+        process.start()
+        self.processes[worker_id] = process
+
+    async def supervise(self, interval: float = 1.0):
+        """Restarts workers that exit"""
+        while True:
+            await asyncio.sleep(interval)
+            for worker_id, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error(f"Worker {worker_id} exited with code {process.exitcode}, restarting")
+                    self.registry.pop(worker_id, None)
+                    self.start_worker(worker_id)
+
+    async def log(self, message: str, level: str = "info"):
+        logger.log(LOG_LEVELS.get(level.lower(), logging.WARNING), message)
+
+    async def relay(self, source: websockets.WebSocketCommonProtocol, destination: websockets.WebSocketCommonProtocol,
+                    direction: str):
+        """Forwards messages as they are, text or binary, until the source closes"""
+        counter = self.relayed
+        try:
+            async for message in source:
+                await destination.send(message)
+                counter.inc(direction)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def serve(self, sck: websockets.WebSocketServerProtocol, path: str):
+        role, rover = parse_path(path)
+        if role is None:
+            await self.log(f"Client {sck.remote_address[0]} tried to connect with invalid path: {path}", "warning")
+            await sck.send_msg(LogMessage(message="Invalid path", level="error"))
+            await sck.close(1008, "Invalid path")
+            return
+        # A driver without a rover would only reach the rovers of one worker
+        if role is Role.DRIVER and rover is None and self.worker_count > 1:
+            await self.log(f"Client {sck.remote_address[0]} connected to /driver without a rover", "warning")
+            await sck.send_msg(LogMessage(message="Connect to /driver/<rover>", level="error"))
+            await sck.close(1008, "Rover required")
+            return
+
+        user = await authenticate(sck, self.userbase, self.log)
+        if user is None:
+            return  # Close message and reason was already sent
+        # A rover is identified by its username
+        worker_id = self.shard(user if role is Role.ROVER else rover)
+
+        try:
+            worker = await websockets.unix_connect(
+                self.socket_paths[worker_id],
+                f"ws://worker{path}",
+                extra_headers={
+                    "X-Sandshark-User": user,
+                    "X-Sandshark-Encoding": sck.encoding.value,
+                    "X-Sandshark-Address": f"{sck.remote_address[0]}:{sck.remote_address[1]}"
+                },
+                ping_interval=None,
+                max_size=None
+            )
+        except OSError:
+            await self.log(f"Worker {worker_id} is unavailable for user {user} ({role.name})", "error")
+            await sck.send_msg(LogMessage(message="Base station worker unavailable", level="error"))
+            await sck.close(1013, "Worker unavailable")
+            return
+
+        self.connections.inc(str(worker_id))
+        upstream = asyncio.create_task(self.relay(sck, worker, "upstream"))
+        downstream = asyncio.create_task(self.relay(worker, sck, "downstream"))
+        try:
+            await asyncio.wait((upstream, downstream), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            upstream.cancel()
+            downstream.cancel()
+            self.connections.inc(str(worker_id), amount=-1)
+            # Pass on clean closes as they are, anything else as an error so the worker treats it as a dropped
+            # connection, e.g. e-stopping the rover
+            if sck.close_code is None:
+                await sck.close(worker.close_code if worker.close_code in (1000, 1001) else 1011)
+            await worker.close(sck.close_code if sck.close_code in (1000, 1001) else 1011)
+
+    async def main(self):
+        if "SANDSHARK_NOWSS" in os.environ:
+            ssl_ctx = None
+        else:
+            ssl_ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ssl_ctx.load_cert_chain(
+                self.module_path / "certs" / "fullchain.pem",
+                self.module_path / "certs" / "privkey.pem"
+            )
+
+        # Migrate once here rather than racing in every worker
+        db = storage.connect(self.module_path / "sensor_data" / "data.db")
+        storage.migrate(db)
+        db.close()
+
+        self._manager = self._ctx.Manager()
+        self.registry = self._manager.dict()
+        for worker_id in range(self.worker_count):
+            self.start_worker(worker_id)
+        logger.info(f"Started {self.worker_count} workers")
+
+        metrics_port = int(os.environ.get("SANDSHARK_METRICS_PORT", 11573))
+        if metrics_port:
+            await serve_metrics(self.metrics, port=metrics_port)
+        supervise_task = asyncio.create_task(self.supervise())
+        # Run until terminated, then stop the workers cleanly
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        try:
+            async with websockets.serve(self.serve, port=11571, ssl=ssl_ctx):
+                await stop.wait()
+        finally:
+            supervise_task.cancel()
+            for process in self.processes:
+                process.terminate()
+            for process in self.processes:
+                process.join(15)
+            self._manager.shutdown()
+            shutil.rmtree(self._socket_dir, ignore_errors=True)
@@ -0,0 +1,188 @@
+"""
+Lightweight metrics registry rendered in the Prometheus text exposition format, and a local HTTP endpoint serving it
+"""
+import asyncio
+import bisect
+import collections
+import math
+import typing as t
+
+Labels = t.Tuple[str, ...]
+Sample = t.Tuple[str, t.Dict[str, str], float]
+
+
+class Counter:
+    """A value that only goes up, per combination of label values"""
+    kind = "counter"
+
+    def __init__(self, labelnames: t.Sequence[str] = ()):
+        self.labelnames = tuple(labelnames)
+        self._values: t.DefaultDict[Labels, float] = collections.defaultdict(float)
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] += amount
+
+    def samples(self) -> t.Iterator[Sample]:
+        for labels, value in list(self._values.items()):
+            yield "", dict(zip(self.labelnames, labels)), value
+
+
+class Gauge(Counter):
+    """A value that goes up and down, per combination of label values"""
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str):
+        self._values[labels] = value
+
+
+class Collected:
+    """A counter or gauge whose values are read from elsewhere when the metrics are rendered"""
+
+    def __init__(self, kind: str, labelnames: t.Sequence[str], collect: t.Callable[[], t.Dict[Labels, float]]):
+        """
+        :param kind: "counter" or "gauge"
+        :param labelnames: Names of the labels
+        :param collect: Returns the current values by label values
+        """
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def samples(self) -> t.Iterator[Sample]:
+        for labels, value in self.collect().items():
+            yield "", dict(zip(self.labelnames, labels)), value
+
+
+class Histogram:
+    """Counts observations in cumulative buckets, per combination of label values"""
+    kind = "histogram"
+    # Seconds, suited to handler and database latencies
+    DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, labelnames: t.Sequence[str] = (), buckets: t.Sequence[float] = DEFAULT_BUCKETS):
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # Bucket counts (the last one for anything above the largest bucket), sum and count by label values
+        self._values: t.Dict[Labels, t.List] = {}
+        if not self.labelnames:
+            # Created up front so observing from another thread never resizes the dict while rendering
+            self._values[()] = self._new()
+
+    def _new(self) -> t.List:
+        return [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+    def observe(self, value: float, *labels: str):
+        entry = self._values.get(labels)
+        if entry is None:
+            entry = self._values[labels] = self._new()
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def samples(self) -> t.Iterator[Sample]:
+        for labels, (counts, total, count) in list(self._values.items()):
+            labels = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                yield "_bucket", {**labels, "le": _format_value(bound)}, cumulative
+            yield "_sum", labels, total
+            yield "_count", labels, count
+
+
+Metric = t.Union[Counter, Gauge, Collected, Histogram]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsRegistry:
+    """Named metrics with their help text, in registration order"""
+
+    def __init__(self):
+        self._metrics: t.Dict[str, t.Tuple[str, Metric]] = {}
+
+    def add(self, name: str, help_: str, metric: Metric) -> Metric:
+        """
+        Registers a metric
+        :param name: The metric name, e.g. sandshark_messages_received_total
+        :param help_: Description of the metric
+        :param metric: The metric
+        :return: The metric
+        """
+        if name in self._metrics:
+            raise ValueError(f"Metric {name} is already registered")
+        self._metrics[name] = (help_, metric)
+        return metric
+
+    def counter(self, name: str, help_: str, labelnames: t.Sequence[str] = ()) -> Counter:
+        return self.add(name, help_, Counter(labelnames))
+
+    def gauge(self, name: str, help_: str, labelnames: t.Sequence[str] = ()) -> Gauge:
+        return self.add(name, help_, Gauge(labelnames))
+
+    def histogram(self, name: str, help_: str, labelnames: t.Sequence[str] = (),
+                  buckets: t.Sequence[float] = Histogram.DEFAULT_BUCKETS) -> Histogram:
+        return self.add(name, help_, Histogram(labelnames, buckets))
+
+    def collected(self, name: str, help_: str, kind: str, labelnames: t.Sequence[str],
+                  collect: t.Callable[[], t.Dict[Labels, float]]) -> Collected:
+        return self.add(name, help_, Collected(kind, labelnames, collect))
+
+    def render(self) -> str:
+        """Renders every metric in the Prometheus text exposition format"""
+        lines = []
+        for name, (help_, metric) in self._metrics.items():
+            lines.append(f"# HELP {name} {_escape(help_)}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            for suffix, labels, value in metric.samples():
+                if labels:
+                    label_text = ",".join(f'{key}="{_escape(str(label))}"' for key, label in labels.items())
+                    lines.append(f"{name}{suffix}{{{label_text}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{name}{suffix} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+async def serve_metrics(registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 11573) -> asyncio.Server:
+    """
+    Serves the registry's metrics at /metrics over plain HTTP
+    :param registry: The metrics to serve
+    :param host: Interface to listen on, local only by default
+    :param port: Port to listen on
+    :return: The started server
+    """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            method, path, *_ = request.split(b" ", 2)
+            if method not in (b"GET", b"HEAD"):
+                status, body = "405 Method Not Allowed", b""
+            elif path.split(b"?")[0] != b"/metrics":
+                status, body = "404 Not Found", b""
+            else:
+                status, body = "200 OK", registry.render().encode()
+            writer.write(
+                f"HTTP/1.1 {status}\r\n"
+                f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode()
+                + (body if method == b"GET" else b"")
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError,
+                ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,53 @@
+"""
+Upgrades a sensor database to the current schema.
+
+Usage: python -m base_station.migrate [--vacuum] [database]
+"""
+import argparse
+import os
+import pathlib
+import time
+
+from base_station import storage
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Upgrade a sensor database to the current schema")
+    parser.add_argument(
+        "database",
+        nargs="?",
+        default=pathlib.Path(os.path.dirname(__file__)) / "sensor_data" / "data.db",
+        help="path to the database (default: base_station/sensor_data/data.db)"
+    )
+    parser.add_argument(
+        "--vacuum",
+        action="store_true",
+        help="rebuild the file afterwards to reclaim space and apply the page size"
+    )
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        parser.error(f"{args.database} does not exist")
+
+    db = storage.connect(args.database)
+    old_version = storage.schema_version(db)
+    if old_version == storage.SCHEMA_VERSION:
+        print(f"{args.database} is already at schema version {old_version}")
+    else:
+        print(f"Migrating {args.database} from schema version {old_version} to {storage.SCHEMA_VERSION}...")
+        start = time.monotonic()
+        storage.migrate(db)
+        print(f"Migrated in {time.monotonic() - start:.1f}s")
+
+    if args.vacuum:
+        print("Vacuuming...")
+        # The page size can't be changed while in WAL mode
+        db.execute("pragma journal_mode = delete")
+        db.execute("pragma page_size = 8192")
+        db.execute("vacuum")
+        db.execute("pragma journal_mode = wal")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
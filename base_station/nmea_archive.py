@@ -0,0 +1,390 @@
+"""
+Write-behind archive of the NMEA sentences received from rovers. See `base_station.export_nmea` to export a time range
+to a .nmea log file.
+
+New sentences are appended to the `nmea` table. With a codec, each minute's rows are sealed once the minute is over:
+compressed together into one block of `nmea_blocks` and deleted, so every sentence is compressed once. Readers merge
+rows and blocks, so a range is readable whether or not it has been sealed.
+"""
+import heapq
+import logging
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+import typing as t
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from common import NmeaMessage
+from base_station import storage
+
+logger = logging.getLogger("sandshark.nmea")
+
+MINUTE = 60 * storage.SECOND
+
+# Compression of NMEA blocks by codec name, as (compress, decompress)
+CODECS: t.Dict[str, t.Tuple[t.Callable[[bytes], bytes], t.Callable[[bytes], bytes]]] = {
+    "zlib": (lambda data: zlib.compress(data, 9), zlib.decompress),
+}
+if zstandard is not None:
+    CODECS["zstd"] = (zstandard.ZstdCompressor(level=19).compress, zstandard.ZstdDecompressor().decompress)
+
+# Raised decoding a corrupt block, or one written with a codec that isn't available
+BLOCK_ERRORS: t.Tuple[t.Type[Exception], ...] = (zlib.error, UnicodeDecodeError, ValueError, KeyError) + (
+    (zstandard.ZstdError,) if zstandard is not None else ()
+)
+
+INSERT_NMEA = """
+    insert into nmea (time, sentence)
+    values (?, ?)
+"""
+
+# Used to skip sentences the rover replays from its offline buffer that were already stored
+NMEA_EXISTS = """
+    select 1 from nmea where time = ? and sentence = ? limit 1
+"""
+
+NMEA_PAGE = """
+    select time, id, sentence from nmea
+    where (time, id) > (:after_time, :after_id) and time < :end
+    order by time, id
+    limit :limit
+"""
+
+# First unsealed row in a time range, found through the time index
+FIRST_ROW = """
+    select min(time) from nmea where time >= ? and time < ?
+"""
+
+MINUTE_ROWS = """
+    select time, sentence from nmea where time >= ? and time < ?
+"""
+
+DELETE_ROWS = """
+    delete from nmea where time >= ? and time < ?
+"""
+
+SELECT_BLOCK = """
+    select codec, data from nmea_blocks where minute = ?
+"""
+
+NEXT_BLOCK = """
+    select minute, codec, data from nmea_blocks
+    where minute >= ? and minute < ?
+    order by minute
+    limit 1
+"""
+
+UPSERT_BLOCK = """
+    insert or replace into nmea_blocks (minute, first_time, last_time, count, codec, data)
+    values (?, ?, ?, ?, ?, ?)
+"""
+
+# Sentinel put on the queue to make the writer thread flush and exit
+_STOP = object()
+
+
+def encode_block(sentences: t.Iterable[t.Tuple[int, str]], codec: str) -> bytes:
+    return CODECS[codec][0]("".join(f"{time_} {sentence}\n" for time_, sentence in sentences).encode())
+
+
+def decode_block(data: bytes, codec: str) -> t.List[t.Tuple[int, str]]:
+    sentences = []
+    for line in CODECS[codec][1](data).decode().splitlines():
+        time_, _, sentence = line.partition(" ")
+        sentences.append((int(time_), sentence))
+    return sentences
+
+
+class NmeaArchive:
+    """
+    Queues NMEA sentences and writes them in batches from a dedicated thread, committing every few seconds, and seals
+    each minute into a compressed block once it's over
+    """
+
+    def __init__(self, path: t.Union[str, pathlib.Path], codec: t.Optional[str] = "zlib",
+                 commit_interval: float = 5.0, batch_size: int = 1000, max_queue: int = 10000,
+                 seal_delay: float = 30.0, max_seal: int = 10):
+        """
+        :param path: Path to the SQLite database
+        :param codec: "zlib", "zstd" (needs the zstandard package) or None to keep uncompressed rows
+        :param commit_interval: Maximum number of seconds a queued sentence waits before being committed
+        :param batch_size: Maximum number of sentences written per commit
+        :param max_queue: Maximum number of queued sentences before new ones are dropped
+        :param seal_delay: Seconds after a minute ends before it is sealed, so sentences still in flight make it in
+        :param max_seal: Maximum number of minutes sealed per commit, bounding how long the write lock is held
+        """
+        if codec is not None and codec not in CODECS:
+            raise ValueError(f"Unsupported NMEA codec {codec}, available: {', '.join(CODECS)}")
+        self.path = path
+        self.codec = codec
+        self.commit_interval = commit_interval
+        self.batch_size = batch_size
+        self.seal_delay = seal_delay
+        self.max_seal = max_seal
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread: t.Optional[threading.Thread] = None
+        # Minutes that can't be sealed because their block is corrupt, left as rows
+        self._unsealable: t.Set[int] = set()
+
+        self.queued = 0
+        self.dropped = 0
+        self.written = 0
+        self.commits = 0
+        self.sealed = 0
+        self.errors = 0
+        # Size of the sentences sealed, and of the blocks holding them
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+
+        # The connection is only ever used by the writer thread after setup
+        self.db = storage.connect(path, check_same_thread=False)
+        storage.migrate(self.db)
+
+    def start(self):
+        """Starts the writer thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="nmea-archiver", daemon=True)
+            self._thread.start()
+
+    def close(self, timeout: t.Optional[float] = 10.0):
+        """
+        Writes all queued sentences, stops the writer thread and closes the database
+        :param timeout: Maximum number of seconds to wait for the writes
+        """
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.error("NMEA archiver did not finish writing before timeout")
+                return
+            self._thread = None
+        self.db.close()
+
+    def add(self, msg: NmeaMessage) -> bool:
+        """
+        Queues a sentence to be archived. Replayed sentences are skipped if already stored.
+        :param msg: The NMEA message
+        :return: False if the queue was full and the sentence was dropped
+        """
+        try:
+            self._queue.put_nowait((msg.time, msg.sentence.rstrip("\r\n"), bool(msg.replayed)))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.queued += 1
+        return True
+
+    def stats(self) -> t.Dict[str, t.Union[int, float, str, None]]:
+        """Returns the archiver's backpressure and compression metrics"""
+        return {
+            "codec": self.codec,
+            "depth": self._queue.qsize(),
+            "dropped": self.dropped,
+            "written": self.written,
+            "commits": self.commits,
+            "sealed": self.sealed,
+            "errors": self.errors,
+            "compression_ratio": self.raw_bytes / self.stored_bytes if self.stored_bytes else None,
+        }
+
+    def _write_rows(self, batch: t.List[t.Tuple[int, str, bool]]):
+        rows = {}
+        for time_, sentence, replayed in batch:
+            if (time_, sentence) in rows:
+                continue
+            # Replayed sentences of sealed minutes are deduplicated when the minute's new rows are sealed
+            if replayed and self.db.execute(NMEA_EXISTS, (time_, sentence)).fetchone() is not None:
+                continue
+            rows[time_, sentence] = None
+        self.db.executemany(INSERT_NMEA, list(rows))
+
+    def _flush(self, batch: t.List[t.Tuple[int, str, bool]]):
+        if not batch:
+            return
+        try:
+            with self.db:
+                self._write_rows(batch)
+        except sqlite3.Error:
+            self.errors += 1
+            logger.exception(f"Failed to write {len(batch)} NMEA sentences")
+        else:
+            self.written += len(batch)
+            self.commits += 1
+        batch.clear()
+
+    def _seal_minute(self, minute: int) -> bool:
+        """Replaces a minute's rows with its block, merged with the block already stored if any"""
+        sentences = set(self.db.execute(MINUTE_ROWS, (minute, minute + MINUTE)))
+        raw_bytes = sum(len(sentence) + 1 for _time, sentence in sentences)
+        stored = self.db.execute(SELECT_BLOCK, (minute,)).fetchone()
+        if stored is not None:
+            # Late sentences, e.g. replayed from the rover's spool
+            try:
+                sentences.update(decode_block(stored[1], stored[0]))
+            except BLOCK_ERRORS:
+                self.errors += 1
+                self._unsealable.add(minute)
+                logger.exception(f"Corrupt NMEA block for minute {minute}, leaving its new sentences unsealed")
+                return False
+        sentences = sorted(sentences)
+        data = encode_block(sentences, self.codec)
+        self.db.execute(UPSERT_BLOCK, (minute, sentences[0][0], sentences[-1][0], len(sentences), self.codec, data))
+        self.db.execute(DELETE_ROWS, (minute, minute + MINUTE))
+        self.raw_bytes += raw_bytes
+        self.stored_bytes += len(data) - (len(stored[1]) if stored is not None else 0)
+        return True
+
+    def _seal(self):
+        """Seals the oldest minutes that are over"""
+        end = time.time_ns() - int(self.seal_delay * storage.SECOND)
+        end -= end % MINUTE
+        sealed = 0
+        minute = 0
+        try:
+            # Workers of a sharded base station may seal at the same time, so take the write lock before reading
+            self.db.execute("begin immediate")
+            try:
+                while sealed < self.max_seal:
+                    first = self.db.execute(FIRST_ROW, (minute, end)).fetchone()[0]
+                    if first is None:
+                        break
+                    minute = first - first % MINUTE
+                    if minute not in self._unsealable and self._seal_minute(minute):
+                        sealed += 1
+                    minute += MINUTE
+                self.db.commit()
+            except BaseException:
+                self.db.rollback()
+                raise
+        except sqlite3.Error:
+            self.errors += 1
+            logger.exception("Failed to seal NMEA sentences")
+        else:
+            self.sealed += sealed
+
+    def _run(self):
+        batch: t.List[t.Tuple[int, str, bool]] = []
+        deadline = time.monotonic() + self.commit_interval
+        while True:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                item = None
+
+            if item is not None and item is not _STOP:
+                batch.append(item)
+                if len(batch) < self.batch_size:
+                    continue
+
+            try:
+                self._flush(batch)
+                if self.codec is not None and (item is None or item is _STOP):
+                    self._seal()
+            except Exception:
+                # Keep archiving whatever goes wrong with one batch
+                self.errors += 1
+                logger.exception("NMEA archiver error")
+                batch.clear()
+            if item is _STOP:
+                return
+            if item is None:
+                deadline = time.monotonic() + self.commit_interval
+
+
+class NmeaArchiveReader:
+    """
+    Reads archived sentences from both rows and blocks. The database is opened read-only and never migrated, so this
+    is safe on a live database or an archived copy.
+    """
+
+    def __init__(self, path: t.Union[str, pathlib.Path]):
+        """
+        :param path: Path to the SQLite database
+        """
+        self.path = pathlib.Path(path)
+        self._db: t.Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        # Whether the database has been migrated to a schema with blocks
+        self._has_blocks = False
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _execute(self, query: str, params: t.Union[tuple, dict]) -> t.List[tuple]:
+        with self._lock:
+            if self._db is None:
+                self._db = sqlite3.connect(self.path.resolve().as_uri() + "?mode=ro", uri=True, check_same_thread=False)
+                self._has_blocks = self._db.execute(
+                    "select 1 from sqlite_master where type = 'table' and name = 'nmea_blocks'"
+                ).fetchone() is not None
+            if query is NEXT_BLOCK and not self._has_blocks:
+                return []
+            return self._db.execute(query, params).fetchall()
+
+    def _read_rows(self, start: int, end: int, page: int = 1000) -> t.Iterator[t.Tuple[int, str]]:
+        params = {"after_time": start, "after_id": -1, "end": end, "limit": page}
+        while True:
+            rows = self._execute(NMEA_PAGE, params)
+            for time_, _id, sentence in rows:
+                yield time_, sentence.rstrip("\r\n")
+            if len(rows) < page:
+                return
+            params["after_time"], params["after_id"] = rows[-1][:2]
+
+    def _read_blocks(self, start: int, end: int) -> t.Iterator[t.Tuple[int, str]]:
+        # Blocks are found by the minute they start at, then only the ones in range are decompressed
+        minute = start - start % MINUTE
+        while True:
+            rows = self._execute(NEXT_BLOCK, (minute, end))
+            if not rows:
+                return
+            minute, codec, data = rows[0]
+            try:
+                sentences = decode_block(data, codec)
+            except BLOCK_ERRORS:
+                logger.exception(f"Skipping corrupt NMEA block for minute {minute}")
+                sentences = []
+            for time_, sentence in sentences:
+                if start <= time_ < end:
+                    yield time_, sentence
+            minute += 1
+
+    def read(self, start: int, end: int) -> t.Iterator[t.Tuple[int, str]]:
+        """
+        Reads the sentences in a time range in time order, a page or block at a time. This blocks on the database, so
+        run it off the event loop.
+        :param start: Start of the time range in nanoseconds, inclusive
+        :param end: End of the time range in nanoseconds, exclusive
+        :return: The sentences and their times, without line endings
+        """
+        previous = None
+        for sentence in heapq.merge(self._read_rows(start, end), self._read_blocks(start, end)):
+            # A replayed sentence can be in both a block and a row until its minute is sealed again
+            if sentence != previous:
+                yield sentence
+            previous = sentence
+
+    def export(self, path: t.Union[str, pathlib.Path], start: int, end: int) -> int:
+        """
+        Writes the sentences in a time range to a .nmea log file
+        :param path: The file to write
+        :param start: Start of the time range in nanoseconds, inclusive
+        :param end: End of the time range in nanoseconds, exclusive
+        :return: The number of sentences written
+        """
+        count = 0
+        with open(path, "w", newline="") as f:
+            for _time, sentence in self.read(start, end):
+                f.write(sentence + "\r\n")
+                count += 1
+        return count
@@ -0,0 +1,116 @@
+"""
+Replays stored telemetry and archived camera frames to a driver as the messages it would have received live
+"""
+import asyncio
+import base64
+import heapq
+import itertools
+import typing as t
+
+from common import *
+from base_station.storage import SensorStore
+from base_station.nmea_archive import NmeaArchiveReader
+from camera_archive import CameraArchiveReader
+
+Timed = t.Union[SensorDataMessage, NmeaMessage, CameraFrameMessage]
+
+
+async def read_sensor_data(store: SensorStore, start: int, end: int, page: int = 1000) \
+        -> t.AsyncIterator[SensorDataMessage]:
+    """Reads stored readings a page at a time, grouping the measurements of each reading back into one message"""
+    after = (start, -1)
+    msg = None
+    while True:
+        rows = await asyncio.to_thread(store.read_readings, after, end, page)
+        for time_, _rowid, sensor, measurement, value in rows:
+            if msg is None or msg.time != time_ or msg.sensor != sensor:
+                if msg is not None:
+                    yield msg
+                msg = SensorDataMessage(time=time_, sensor=sensor, measurements={}, replayed=True)
+            msg.measurements[measurement] = value
+        if len(rows) < page:
+            break
+        after = rows[-1][:2]
+    if msg is not None:
+        yield msg
+
+
+async def read_nmea(reader: NmeaArchiveReader, start: int, end: int, batch: int = 1000) \
+        -> t.AsyncIterator[NmeaMessage]:
+    """Reads archived NMEA sentences a batch at a time off the event loop"""
+    sentences = reader.read(start, end)
+    while True:
+        chunk = await asyncio.to_thread(lambda: list(itertools.islice(sentences, batch)))
+        for time_, sentence in chunk:
+            yield NmeaMessage(time=time_, sentence=sentence, replayed=True)
+        if len(chunk) < batch:
+            return
+
+
+async def read_camera_frames(reader: CameraArchiveReader, start: int, end: int) -> t.AsyncIterator[CameraFrameMessage]:
+    async for time_, frame in reader.read_frames(start, end):
+        yield CameraFrameMessage(time=time_, frame=base64.b64encode(frame).decode())
+
+
+async def merge_by_time(*streams: t.AsyncIterator[Timed]) -> t.AsyncIterator[Timed]:
+    """Merges streams that are each in time order into one, only holding the next message of each"""
+    heap = []
+    for i, stream in enumerate(streams):
+        msg = await anext(stream, None)
+        if msg is not None:
+            heap.append((msg.time, i, msg))
+    heapq.heapify(heap)
+    while heap:
+        _time, i, msg = heap[0]
+        yield msg
+        msg = await anext(streams[i], None)
+        if msg is None:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (msg.time, i, msg))
+
+
+class Replay:
+    """Sends messages paced by their timestamps"""
+
+    def __init__(self, messages: t.AsyncIterator[Timed], send: t.Callable[[Message], None], start: int,
+                 speed: float = 1):
+        """
+        :param messages: The messages to replay, in time order
+        :param send: Sends a message to the driver
+        :param start: Start of the replayed time range in ns since the epoch
+        :param speed: Playback speed, 1 for real time
+        """
+        self.messages = messages
+        self.send = send
+        self.speed = speed
+        # Time of the last message played
+        self.position = start
+        self._speed_changed = asyncio.Event()
+
+    def set_speed(self, speed: float):
+        self.speed = speed
+        self._speed_changed.set()
+
+    async def run(self):
+        """Plays every message, returning once the last one was sent"""
+        loop = asyncio.get_running_loop()
+        # Replay time and loop time that are played at the same moment, and the speed played at since
+        origin = None
+        async for msg in self.messages:
+            if origin is None:
+                origin = (msg.time, loop.time(), self.speed)
+            while True:
+                delay = origin[1] + (msg.time - origin[0]) / 1e9 / origin[2] - loop.time()
+                if delay <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._speed_changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    break
+                # Continue from the replay time reached so far, which is between messages, at the new speed
+                self._speed_changed.clear()
+                now = loop.time()
+                origin = (origin[0] + (now - origin[1]) * 1e9 * origin[2], now, self.speed)
+            self.position = msg.time
+            self.send(msg)
@@ -0,0 +1,542 @@
+"""
+Write-behind storage for sensor data received by the base station. NMEA sentences are archived separately by
+`base_station.nmea_archive` in the same database.
+"""
+import logging
+import pathlib
+import queue
+import sqlite3
+import threading
+import time
+import typing as t
+
+from common import SensorDataMessage
+from base_station.metrics import Histogram
+
+logger = logging.getLogger("sandshark.storage")
+
+# Current schema version, stored in `pragma user_version`
+SCHEMA_VERSION = 3
+
+SECOND = 1_000_000_000
+DAY = 86400 * SECOND
+
+# Rollup tiers as (bucket width, retention) in nanoseconds, from finest to coarsest. A retention of None keeps the
+# buckets forever.
+ROLLUP_TIERS = (
+    (1 * SECOND, 7 * DAY),
+    (10 * SECOND, 30 * DAY),
+    (60 * SECOND, None)
+)
+
+# Connection settings, applied every time the database is opened
+PRAGMAS = """
+    pragma journal_mode = wal;
+    pragma synchronous = normal;
+    pragma cache_size = -16384;
+    pragma temp_store = memory;
+"""
+
+# Sensor and measurement names are interned in dictionary tables and referenced by id from `readings`. The `sensors`
+# view keeps the old flat layout available for ad-hoc queries.
+SCHEMA = """
+    create table if not exists sensor_names (
+        id integer primary key,
+        name text not null unique
+    );
+
+    create table if not exists measurement_names (
+        id integer primary key,
+        name text not null unique
+    );
+
+    create table if not exists readings (
+        time integer not null,
+        sensor_id integer not null references sensor_names (id),
+        measurement_id integer not null references measurement_names (id),
+        value float
+    );
+    create index if not exists readings_series on readings (sensor_id, measurement_id, time);
+    create index if not exists readings_time on readings (time);
+
+    create table if not exists nmea (
+        id integer primary key autoincrement,
+        time integer,
+        sentence text
+    );
+    create index if not exists nmea_time on nmea (time);
+"""
+
+# Min/max/sum/count per sensor and measurement over fixed-width time buckets. `tier` is the bucket width and `bucket`
+# the start time of the bucket, both in nanoseconds.
+ROLLUP_SCHEMA = """
+    create table if not exists rollups (
+        tier integer not null,
+        sensor_id integer not null references sensor_names (id),
+        measurement_id integer not null references measurement_names (id),
+        bucket integer not null,
+        min float,
+        max float,
+        sum float,
+        count integer,
+        primary key (tier, sensor_id, measurement_id, bucket)
+    ) without rowid;
+"""
+
+# NMEA sentences compressed in blocks of one minute. `minute` is the start of the minute in nanoseconds and indexes the
+# blocks by time; `data` holds the "<time> <sentence>" lines of the minute in time order, compressed with `codec`.
+NMEA_BLOCKS_SCHEMA = """
+    create table if not exists nmea_blocks (
+        minute integer primary key,
+        first_time integer not null,
+        last_time integer not null,
+        count integer not null,
+        codec text not null,
+        data blob not null
+    );
+"""
+
+SENSORS_VIEW = """
+    create view if not exists sensors as
+    select readings.rowid as id, time, sensor_names.name as sensor, measurement_names.name as measurement, value
+    from readings
+    join sensor_names on sensor_names.id = readings.sensor_id
+    join measurement_names on measurement_names.id = readings.measurement_id;
+"""
+
+# Copies the version 0 flat `sensors` table into the normalized tables
+MIGRATE_V0 = """
+    insert or ignore into sensor_names (name) select distinct sensor from sensors where sensor is not null;
+    insert or ignore into measurement_names (name) select distinct measurement from sensors where measurement is not null;
+    insert into readings (time, sensor_id, measurement_id, value)
+        select sensors.time, sensor_names.id, measurement_names.id, sensors.value
+        from sensors
+        join sensor_names on sensor_names.name = sensors.sensor
+        join measurement_names on measurement_names.name = sensors.measurement
+        order by sensors.id;
+    drop table sensors;
+"""
+
+INSERT_READINGS = """
+    insert into readings (time, sensor_id, measurement_id, value)
+    values (?, ?, ?, ?)
+"""
+
+UPSERT_ROLLUP = """
+    insert into rollups (tier, sensor_id, measurement_id, bucket, min, max, sum, count)
+    values (?, ?, ?, ?, ?, ?, ?, ?)
+    on conflict (tier, sensor_id, measurement_id, bucket) do update set
+        min = min(min, excluded.min),
+        max = max(max, excluded.max),
+        sum = sum + excluded.sum,
+        count = count + excluded.count
+"""
+
+# Builds a tier from the raw readings, only numeric values are rolled up
+BACKFILL_ROLLUP = """
+    insert or replace into rollups (tier, sensor_id, measurement_id, bucket, min, max, sum, count)
+    select :tier, sensor_id, measurement_id, time - time % :tier, min(value), max(value), sum(value), count(value)
+    from readings
+    where typeof(value) in ('integer', 'real')
+    group by sensor_id, measurement_id, time - time % :tier
+"""
+
+# Pages are selected with keyset pagination on the series index, so every chunk costs the same regardless of how far
+# into the range it is
+RAW_PAGE = """
+    select time, value, readings.rowid from readings
+    where sensor_id = (select id from sensor_names where name = :sensor)
+        and measurement_id = (select id from measurement_names where name = :measurement)
+        and (time, readings.rowid) > (:after_time, :after_rowid) and time < :end
+    order by time, readings.rowid
+    limit :limit
+"""
+
+ROLLUP_PAGE = """
+    select bucket, min, max, sum / count, count from rollups
+    where tier = :tier
+        and sensor_id = (select id from sensor_names where name = :sensor)
+        and measurement_id = (select id from measurement_names where name = :measurement)
+        and bucket > :after and bucket < :end
+    order by bucket
+    limit :limit
+"""
+
+# Every sensor's readings in time order, paged like RAW_PAGE on the time index
+READINGS_PAGE = """
+    select time, readings.rowid, sensor_names.name, measurement_names.name, value from readings
+    join sensor_names on sensor_names.id = readings.sensor_id
+    join measurement_names on measurement_names.id = readings.measurement_id
+    where (time, readings.rowid) > (:after_time, :after_rowid) and time < :end
+    order by time, readings.rowid
+    limit :limit
+"""
+
+# Used to skip rows the rover replays from its offline buffer that were already stored
+READING_EXISTS = """
+    select 1 from readings where sensor_id = ? and measurement_id = ? and time = ? limit 1
+"""
+
+
+def connect(path: t.Union[str, pathlib.Path], **kwargs) -> sqlite3.Connection:
+    """
+    Opens the sensor database with the connection settings applied
+    :param path: Path to the SQLite database
+    :param kwargs: Extra arguments passed to `sqlite3.connect`
+    :return: The connection
+    """
+    db = sqlite3.connect(path, **kwargs)
+    # Only takes effect on a new database, existing ones need a vacuum outside of WAL mode
+    db.execute("pragma page_size = 8192")
+    db.executescript(PRAGMAS)
+    return db
+
+
+def schema_version(db: sqlite3.Connection) -> int:
+    return db.execute("pragma user_version").fetchone()[0]
+
+
+def migrate(db: sqlite3.Connection):
+    """
+    Creates the schema or upgrades an existing database to the current schema version
+    :param db: The database connection
+    """
+    version = schema_version(db)
+    if version == SCHEMA_VERSION:
+        return
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"Sensor database has schema version {version}, newer than supported {SCHEMA_VERSION}")
+
+    db.execute("begin")
+    try:
+        if version < 1:
+            legacy = db.execute("select 1 from sqlite_master where type = 'table' and name = 'sensors'").fetchone()
+            # The old nmea table has the same layout, only its index is added by the schema
+            for statement in split_script(SCHEMA):
+                db.execute(statement)
+            if legacy:
+                logger.info("Migrating sensor database from flat sensors table")
+                for statement in split_script(MIGRATE_V0):
+                    db.execute(statement)
+            db.execute(SENSORS_VIEW)
+        if version < 2:
+            db.execute(ROLLUP_SCHEMA)
+            for tier, _retention in ROLLUP_TIERS:
+                db.execute(BACKFILL_ROLLUP, {"tier": tier})
+        if version < 3:
+            db.execute(NMEA_BLOCKS_SCHEMA)
+        db.execute(f"pragma user_version = {SCHEMA_VERSION}")
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+
+
+def choose_tier(resolution: int) -> t.Optional[int]:
+    """
+    Picks the coarsest rollup tier that is no coarser than the requested resolution
+    :param resolution: The requested time between points in nanoseconds
+    :return: The tier's bucket width, or None if only raw readings are fine enough
+    """
+    chosen = None
+    for tier, _retention in ROLLUP_TIERS:
+        if tier <= resolution:
+            chosen = tier
+    return chosen
+
+
+def split_script(script: str) -> t.List[str]:
+    """Splits an SQL script of simple statements, so they can be run inside a single transaction"""
+    return [statement.strip() for statement in script.split(";") if statement.strip()]
+
+
+# Sentinel put on the queue to make the writer thread flush and exit
+_STOP = object()
+
+
+class SensorStore:
+    """
+    Queues rows to be written to the sensor database and writes them in batches from a dedicated thread, so the event
+    loop never waits on a commit.
+    """
+
+    def __init__(self, path: t.Union[str, pathlib.Path], batch_size: int = 500, flush_interval: float = 1.0,
+                 max_queue: int = 10000, raw_retention: t.Optional[int] = 3 * DAY, prune_interval: float = 60.0):
+        """
+        :param path: Path to the SQLite database
+        :param batch_size: Maximum number of rows written per commit
+        :param flush_interval: Maximum number of seconds a queued row waits before being committed
+        :param max_queue: Maximum number of queued messages before new ones are dropped
+        :param raw_retention: Nanoseconds to keep raw readings for, or None to keep them forever
+        :param prune_interval: Seconds between removing readings and rollups past their retention
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.raw_retention = raw_retention
+        self.prune_interval = prune_interval
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread: t.Optional[threading.Thread] = None
+
+        # Backpressure metrics
+        self.queued = 0
+        self.dropped = 0
+        self.rows_written = 0
+        self.commits = 0
+        self.max_depth = 0
+        self.last_commit_duration = 0.0
+        self.errors = 0
+        self.pruned = 0
+        # Seconds spent inserting each batch, and committing it
+        self.insert_seconds = Histogram()
+        self.commit_seconds = Histogram()
+
+        # Interned name ids, only used by the writer thread
+        self._sensor_ids: t.Dict[str, int] = {}
+        self._measurement_ids: t.Dict[str, int] = {}
+
+        # The connection is only ever used by the writer thread after setup
+        self.db = connect(path, check_same_thread=False)
+        migrate(self.db)
+
+        # Separate connection for history queries, WAL lets it read while the writer commits
+        self._reader: t.Optional[sqlite3.Connection] = None
+        self._reader_lock = threading.Lock()
+
+    def start(self):
+        """Starts the writer thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="sensor-writer", daemon=True)
+            self._thread.start()
+
+    def close(self, timeout: t.Optional[float] = 10.0):
+        """
+        Flushes all queued rows, stops the writer thread and closes the database
+        :param timeout: Maximum number of seconds to wait for the flush
+        """
+        if self._thread is not None:
+            # Block here rather than drop: everything queued before close() must be written
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.error("Sensor writer did not finish flushing before timeout")
+                return
+            self._thread = None
+        self.db.close()
+        if self._reader is not None:
+            self._reader.close()
+
+    def _enqueue(self, table: str, rows: t.List[tuple]) -> bool:
+        try:
+            self._queue.put_nowait((table, rows))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.queued += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    def add_sensor_data(self, msg: SensorDataMessage) -> bool:
+        """
+        Queues a sensor reading to be written. Replayed readings are skipped if already stored.
+        :param msg: The sensor data message
+        :return: False if the queue was full and the reading was dropped
+        """
+        return self._enqueue(
+            "replayed_readings" if msg.replayed else "readings",
+            [(msg.time, msg.sensor, measurement, value) for measurement, value in msg.measurements.items()]
+        )
+
+    def stats(self) -> t.Dict[str, t.Union[int, float]]:
+        """Returns the writer's backpressure metrics"""
+        return {
+            "depth": self._queue.qsize(),
+            "max_depth": self.max_depth,
+            "queued": self.queued,
+            "dropped": self.dropped,
+            "rows_written": self.rows_written,
+            "commits": self.commits,
+            "last_commit_duration": self.last_commit_duration,
+            "errors": self.errors,
+            "pruned": self.pruned
+        }
+
+    def read_history(self, sensor: str, measurement: str, start: int, end: int, resolution: int = 0,
+                     cursor: t.Optional[str] = None, limit: int = 500) \
+            -> t.Tuple[t.Optional[int], t.List[list], t.Optional[str]]:
+        """
+        Reads one page of a measurement's history. This blocks on the database, so run it off the event loop.
+        :param sensor: The sensor name
+        :param measurement: The measurement name
+        :param start: Start of the time range in nanoseconds, inclusive
+        :param end: End of the time range in nanoseconds, exclusive
+        :param resolution: Requested nanoseconds between points, used to pick a rollup tier
+        :param cursor: Cursor returned with the previous page, or None for the first page
+        :param limit: Maximum number of points in the page
+        :return: The tier read (None for raw readings), the points, and the cursor of the next page or None if this is
+            the last one
+        """
+        tier = choose_tier(resolution)
+        params = {"sensor": sensor, "measurement": measurement, "end": end, "limit": limit}
+        with self._reader_lock:
+            if self._reader is None:
+                self._reader = connect(self.path, check_same_thread=False)
+
+            if tier is None:
+                if cursor is None:
+                    params["after_time"], params["after_rowid"] = start, -1
+                else:
+                    params["after_time"], params["after_rowid"] = map(int, cursor.split(":"))
+                rows = self._reader.execute(RAW_PAGE, params).fetchall()
+                points = [[time_, value] for time_, value, _rowid in rows]
+                next_cursor = f"{rows[-1][0]}:{rows[-1][2]}" if len(rows) == limit else None
+            else:
+                params["tier"] = tier
+                params["after"] = start - start % tier - 1 if cursor is None else int(cursor)
+                points = [list(row) for row in self._reader.execute(ROLLUP_PAGE, params)]
+                next_cursor = str(points[-1][0]) if len(points) == limit else None
+
+        return tier, points, next_cursor
+
+    def read_readings(self, after: t.Tuple[int, int], end: int, limit: int = 1000) -> t.List[tuple]:
+        """
+        Reads one page of every sensor's readings in a time range, in time order. This blocks on the database, so run
+        it off the event loop.
+        :param after: Time and rowid of the last row of the previous page, or (start time, -1) for the first page
+        :param end: End of the time range in nanoseconds, exclusive
+        :param limit: Maximum number of rows in the page
+        :return: (time, rowid, sensor, measurement, value) rows
+        """
+        params = {"after_time": after[0], "after_rowid": after[1], "end": end, "limit": limit}
+        with self._reader_lock:
+            if self._reader is None:
+                self._reader = connect(self.path, check_same_thread=False)
+            return self._reader.execute(READINGS_PAGE, params).fetchall()
+
+    def _intern(self, table: str, cache: t.Dict[str, int], name: str) -> int:
+        name_id = cache.get(name)
+        if name_id is None:
+            self.db.execute(f"insert or ignore into {table} (name) values (?)", (name,))
+            name_id = self.db.execute(f"select id from {table} where name = ?", (name,)).fetchone()[0]
+            cache[name] = name_id
+        return name_id
+
+    def _write_readings(self, rows: t.List[tuple], dedup: bool = False):
+        sensor_ids = self._sensor_ids
+        measurement_ids = self._measurement_ids
+        readings = [
+            (
+                time_,
+                sensor_ids.get(sensor) or self._intern("sensor_names", sensor_ids, sensor),
+                measurement_ids.get(measurement) or self._intern("measurement_names", measurement_ids, measurement),
+                value
+            )
+            for time_, sensor, measurement, value in rows
+        ]
+        if dedup:
+            # A reading is identified by its series and timestamp
+            seen = set()
+            unique = []
+            for reading in readings:
+                key = (reading[1], reading[2], reading[0])
+                if key not in seen and self.db.execute(READING_EXISTS, key).fetchone() is None:
+                    unique.append(reading)
+                seen.add(key)
+            readings = unique
+        self.db.executemany(INSERT_READINGS, readings)
+
+        # Aggregate the batch per bucket before touching the rollup table
+        buckets: t.Dict[tuple, list] = {}
+        for time_, sensor_id, measurement_id, value in readings:
+            if type(value) not in (int, float):  # skips None, strings and bools
+                continue
+            for tier, _retention in ROLLUP_TIERS:
+                key = (tier, sensor_id, measurement_id, time_ - time_ % tier)
+                agg = buckets.get(key)
+                if agg is None:
+                    buckets[key] = [value, value, value, 1]
+                else:
+                    if value < agg[0]:
+                        agg[0] = value
+                    if value > agg[1]:
+                        agg[1] = value
+                    agg[2] += value
+                    agg[3] += 1
+        self.db.executemany(UPSERT_ROLLUP, [key + tuple(agg) for key, agg in buckets.items()])
+
+    def _prune(self):
+        now = time.time_ns()
+        try:
+            with self.db:
+                if self.raw_retention is not None:
+                    self.pruned += self.db.execute(
+                        "delete from readings where time < ?", (now - self.raw_retention,)
+                    ).rowcount
+                for tier, retention in ROLLUP_TIERS:
+                    if retention is not None:
+                        self.db.execute("delete from rollups where tier = ? and bucket < ?", (tier, now - retention))
+        except sqlite3.Error:
+            self.errors += 1
+            logger.exception("Failed to prune sensor database")
+
+    def _flush(self, pending: t.Dict[str, t.List[tuple]]):
+        if not pending:
+            return
+        start = time.perf_counter()
+        inserted = None
+        rows = 0
+        try:
+            with self.db:  # commits, or rolls back on error
+                for table, batch in pending.items():
+                    if table == "readings":
+                        self._write_readings(batch)
+                    else:
+                        self._write_readings(batch, dedup=True)
+                    rows += len(batch)
+                inserted = time.perf_counter()
+        except sqlite3.Error:
+            # Ids interned in the rolled back transaction are gone
+            self._sensor_ids.clear()
+            self._measurement_ids.clear()
+            self.errors += 1
+            logger.exception(f"Failed to write {rows} rows to sensor database")
+        else:
+            self.rows_written += rows
+            self.commits += 1
+            self.insert_seconds.observe(inserted - start)
+            self.commit_seconds.observe(time.perf_counter() - inserted)
+        self.last_commit_duration = time.perf_counter() - start
+        pending.clear()
+
+    def _run(self):
+        pending: t.Dict[str, t.List[tuple]] = {}
+        pending_rows = 0
+        deadline = None
+        next_prune = time.monotonic()
+        while True:
+            if time.monotonic() >= next_prune:
+                self._prune()
+                next_prune = time.monotonic() + self.prune_interval
+
+            timeout = max(min(next_prune, deadline or next_prune) - time.monotonic(), 0)
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._flush(pending)
+                return
+
+            if item is not None:
+                table, rows = item
+                pending.setdefault(table, []).extend(rows)
+                pending_rows += len(rows)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if pending_rows >= self.batch_size or (deadline is not None and time.monotonic() >= deadline):
+                self._flush(pending)
+                pending_rows = 0
+                deadline = None
@@ -1,6 +1,14 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import json
 import logging
+import typing as t
+
+import serde
 import websockets
-from common import Role
+from common import *
 
 # Numeric logging levels as defined by `logging`
 LOG_LEVELS = {
@@ -14,12 +22,214 @@ LOG_LEVELS = {
 }
 
 
+def parse_path(path: str) -> t.Tuple[t.Optional[Role], t.Optional[str]]:
+    """
+    Parses a connection path, e.g. /rover or /driver/sandshark
+    :param path: The path the client connected to
+    :return: The client's role, or None if the path is invalid, and the rover named after the role if any
+    """
+    role_path, _, rover = path.split("?")[0].partition("/")[2].partition("/")
+    role = Role.from_path("/" + role_path)
+    if role is None or "/" in rover:
+        return None, None
+    return role, rover or None
+
+
+async def authenticate(sck: websockets.WebSocketServerProtocol, userbase: t.Dict[str, str],
+                       log: t.Callable[[str, str], t.Awaitable]) -> t.Optional[str]:
+    """
+    Authenticates a client connection and negotiates its encoding
+    :param sck: the socket to authenticate
+    :param userbase: Usernames by token
+    :param log: Logs a message at a level
+    :return: the username authenticated, or None if the authentication failed
+    """
+    # Receive first message, which should be an `auth` message
+    auth_msg_raw = await sck.recv()
+    try:
+        auth_msg = decode_message(auth_msg_raw)
+    # Error if invalid message
+    except (serde.ValidationError, json.JSONDecodeError):
+        await log(f"Received invalid auth message from {sck.remote_address[0]}", "error")
+        await sck.send_msg(AuthResponseMessage(success=False, user=None))
+        await sck.send_msg(LogMessage(message="Invalid auth message", level="error"))
+        await sck.close(1002, "Invalid auth message")
+        return None
+    # Error if first message is not of type `auth`
+    if not isinstance(auth_msg, AuthMessage):
+        await log(f"Expected auth message but received `{auth_msg.tag_name}` from {sck.remote_address[0]}", "error")
+        await sck.send_msg(AuthResponseMessage(success=False, user=None))
+        await sck.send_msg(LogMessage(message="Expected an auth message", level="error"))
+        await sck.close(1008, "Expected an auth message on first message")
+        return None
+
+    # Check token
+    user = userbase.get(auth_msg.token)
+    if not user:
+        await log(f"Client {sck.remote_address[0]} tried to authenticate with unknown token", "warning")
+        await sck.send_msg(AuthResponseMessage(success=False, user=None))
+        await sck.send_msg(LogMessage(message="Authentication failed", level="error"))
+        await sck.close(1008, "Authentication failed")
+        return None
+
+    # Reply in JSON, then switch to the negotiated encoding
+    encoding = Encoding.negotiate(auth_msg.encodings)
+    await sck.send_msg(AuthResponseMessage(success=True, user=user, encoding=encoding.value))
+    sck.encoding = encoding
+    return user
+
+
+class LogThrottle:
+    """
+    Limits the log messages broadcast to drivers: repeats of a message within a window are suppressed and counted,
+    and a token bucket bounds the rate of distinct messages.
+    """
+
+    def __init__(self, rate: float = 5.0, burst: int = 20, dedup_window: float = 10.0):
+        """
+        :param rate: Messages per second allowed on average
+        :param burst: Messages allowed at once after a quiet period
+        :param dedup_window: Seconds during which repeats of a sent message are suppressed
+        """
+        self.rate = rate
+        self.burst = burst
+        self.dedup_window = dedup_window
+
+        self._tokens = float(burst)
+        self._last_refill: t.Optional[float] = None
+        # When each recently sent message was sent and how many repeats of it were suppressed since, by level and text
+        self._recent: t.Dict[t.Tuple[str, str], t.List] = {}
+        # Distinct messages suppressed by the rate limit since the last summary
+        self._rate_limited = 0
+
+        self.suppressed_repeats = 0
+        self.suppressed_rate = 0
+
+    def allow(self, level: str, message: str, now: float) -> bool:
+        """
+        Decides whether to broadcast a message
+        :param level: The message's level
+        :param message: The message
+        :param now: The current monotonic time in seconds
+        :return: True if the message should be sent
+        """
+        key = (level, message)
+        recent = self._recent.get(key)
+        if recent is not None and now - recent[0] < self.dedup_window:
+            recent[1] += 1
+            self.suppressed_repeats += 1
+            return False
+
+        if self._last_refill is not None:
+            self._tokens = min(self._tokens + (now - self._last_refill) * self.rate, self.burst)
+        self._last_refill = now
+        if self._tokens < 1:
+            self._rate_limited += 1
+            self.suppressed_rate += 1
+            return False
+        self._tokens -= 1
+        self._recent[key] = [now, 0]
+        return True
+
+    def summaries(self, now: float) -> t.List[t.Tuple[str, str]]:
+        """
+        Forgets messages whose window has passed
+        :param now: The current monotonic time in seconds
+        :return: Messages, as level and text, reporting how many repeats and rate limited messages were suppressed
+        """
+        summaries = []
+        for key, (sent, repeats) in list(self._recent.items()):
+            if now - sent >= self.dedup_window:
+                del self._recent[key]
+                if repeats:
+                    level, message = key
+                    summaries.append(
+                        (level, f"{message} [repeated {repeats} more times in {self.dedup_window:g} seconds]")
+                    )
+        if self._rate_limited:
+            summaries.append(("warning", f"{self._rate_limited} log messages were not sent to drivers (rate limited)"))
+            self._rate_limited = 0
+        return summaries
+
+
 class Client:
-    def __init__(self, sck: websockets.WebSocketServerProtocol, user: str, role: Role):
+    def __init__(self, sck: websockets.WebSocketServerProtocol, user: str, role: Role, max_queue: int = 100,
+                 remote_address: t.Optional[t.Tuple[str, int]] = None):
+        """
+        :param sck: The client connection
+        :param user: The authenticated username
+        :param role: The client's role
+        :param max_queue: Maximum number of droppable frames queued
+        :param remote_address: The client's IP and port, if the connection is relayed by the front process
+        """
         self.sck = sck
         self.user = user
         self.role = role
+        self.remote_address = remote_address or sck.remote_address[:2]
+        # Usernames of the rovers a driver receives messages from, None for every rover
+        self.subscriptions: t.Optional[t.Set[str]] = set()
+
+        # Outgoing frames with the order they were queued in. Priority frames are never dropped; droppable frames are
+        # bounded and the oldest is dropped when a slow client falls behind.
+        self.priority_queue: t.Deque[t.Tuple[int, bytes]] = collections.deque()
+        self.droppable_queue: t.Deque[t.Tuple[int, bytes]] = collections.deque(maxlen=max_queue)
+        self._order = itertools.count()
+        self.queued = asyncio.Event()
+        # Set once every priority frame queued so far has been sent, or can't be because the connection closed
+        self.priority_sent = asyncio.Event()
+        self.priority_sent.set()
+        self.sent = 0
+        self.dropped = 0
+        self.sender_task: t.Optional[asyncio.Task] = None
 
     @property
     def ip(self) -> str:
-        return self.sck.remote_address[0]
+        return self.remote_address[0]
+
+    @property
+    def address(self) -> str:
+        return f"{self.remote_address[0]}:{self.remote_address[1]}"
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.priority_queue) + len(self.droppable_queue)
+
+    def enqueue(self, frame: bytes, droppable: bool = False):
+        """
+        Queues an encoded frame to be sent by the client's sender task
+        :param frame: The encoded message, as returned by `Message.encode`
+        :param droppable: Whether the frame may be dropped if the client falls behind
+        """
+        if droppable:
+            if len(self.droppable_queue) == self.droppable_queue.maxlen:
+                self.dropped += 1  # the deque discards the oldest frame
+            self.droppable_queue.append((next(self._order), frame))
+        else:
+            self.priority_queue.append((next(self._order), frame))
+            self.priority_sent.clear()
+        self.queued.set()
+
+    def start_sender(self):
+        self.sender_task = asyncio.create_task(self._send_queued())
+
+    def stop_sender(self):
+        if self.sender_task is not None:
+            self.sender_task.cancel()
+            self.sender_task = None
+        self.priority_sent.set()
+
+    async def _send_queued(self):
+        try:
+            while True:
+                await self.queued.wait()
+                self.queued.clear()
+                # Send everything queued so far in one batch, in the order it was queued
+                frames = [frame for _order, frame in heapq.merge(self.priority_queue, self.droppable_queue)]
+                self.priority_queue.clear()
+                self.droppable_queue.clear()
+                await self.sck.send_frames(frames)
+                self.sent += len(frames)
+                if not self.priority_queue:
+                    self.priority_sent.set()
+        except websockets.ConnectionClosed:
+            self.priority_sent.set()
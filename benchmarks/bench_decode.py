@@ -0,0 +1,75 @@
+"""
+Compares `decode_message` with `Message.from_json` on a mix of messages like the base station receives in the field.
+
+Usage: python -m benchmarks.bench_decode [--messages N]
+"""
+import argparse
+import json
+import random
+import time
+
+from common import Message, decode_message
+
+
+def traffic(count: int) -> list:
+    """Builds a realistic message mix, mostly telemetry with the occasional driver message"""
+    rng = random.Random(1157)
+    now = time.time_ns()
+    messages = []
+    for i in range(count):
+        ts = now + i * 20_000_000
+        kind = rng.random()
+        if kind < 0.35:
+            msg = {"type": "sensor_data", "time": ts, "sensor": "imu", "measurements": {
+                "roll": rng.uniform(-10, 10), "pitch": rng.uniform(-10, 10), "yaw": rng.uniform(0, 360), "temp": 31
+            }}
+        elif kind < 0.55:
+            msg = {"type": "sensor_data", "time": ts, "sensor": "internal_bme", "measurements": {
+                "temp": rng.uniform(20, 40), "humidity": rng.uniform(5, 30), "pressure": rng.randint(90000, 101000)
+            }}
+        elif kind < 0.65:
+            msg = {"type": "sensor_data", "time": ts, "sensor": "panel_power", "measurements": {
+                "voltage": rng.uniform(11, 14), "current": rng.uniform(0, 3)
+            }}
+        elif kind < 0.93:
+            msg = {"type": "nmea", "time": ts,
+                   "sentence": "$GPGGA,172814.0,3723.46587704,N,12202.26957864,W,2,6,1.2,18.893,M,-25.669,M,2.0,0031*4F\r\n"}
+        elif kind < 0.98:
+            msg = {"type": "point_camera", "yaw": rng.randint(-5, 5), "pitch": rng.randint(-5, 5), "relative": True}
+        else:
+            msg = {"type": "command", "command": {
+                "type": "move_distance", "distance": rng.uniform(0, 5), "speed": 0.5, "angle": rng.randint(-90, 90)
+            }}
+        messages.append(json.dumps(msg))
+    return messages
+
+
+def bench(name: str, decode, messages: list, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for raw in messages:
+            decode(raw)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:>16}: {best * 1e6 / len(messages):7.2f} us/msg, {len(messages) / best:9.0f} msg/s")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    messages = traffic(args.messages)
+    # Both paths must agree before timing them
+    for raw in messages:
+        assert decode_message(raw) == Message.from_json(raw), raw
+
+    slow = bench("from_json", Message.from_json, messages, args.repeat)
+    fast = bench("decode_message", decode_message, messages, args.repeat)
+    print(f"{'speedup':>16}: {slow / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
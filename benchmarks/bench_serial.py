@@ -0,0 +1,148 @@
+"""
+Compares the table-driven Arduino line parser with the previous decode, regex and split parsing, and the text protocol
+with binary frames in bytes on the wire and read and parse time.
+
+Usage: python -m benchmarks.bench_serial [--trace FILE] [--lines N]
+
+A captured trace is a raw dump of the Arduino's serial output, e.g. `cat /dev/ttyACM0 > trace.txt`. Without one, a
+trace following the Arduino's task schedule is generated.
+"""
+import argparse
+import asyncio
+import binascii
+import random
+import re
+import struct
+import time
+import typing as t
+
+from rover_control.serial_parser import FRAME_SYNC, SENSOR_SCHEMAS, parse_line, read_message
+
+
+def synthetic_trace(count: int) -> t.List[bytes]:
+    """Lines in the proportions the Arduino's sensor tasks and heartbeat replies produce them"""
+    rng = random.Random(1157)
+    lines = []
+    while len(lines) < count:
+        # One 500 ms tick: imu, load current, panel power and a heartbeat reply, BMEs every 10th tick
+        lines.append(f"data imu {rng.uniform(-5, 5):.2f} {rng.uniform(-5, 5):.2f} {rng.uniform(0, 360):.2f} 31 \n"
+                     .encode())
+        lines.append(f"data load_current {rng.randint(0, 250)} \n".encode())
+        lines.append(f"data panel_power {rng.uniform(11, 14):.2f} {rng.uniform(0, 3):.2f} \n".encode())
+        lines.append(b"hb\n")
+        if rng.random() < 0.1:
+            for name in ("internal_bme", "external_bme"):
+                lines.append(f"data {name} {rng.uniform(20, 40):.2f} {rng.uniform(5, 30):.2f} "
+                             f"{rng.randint(90000, 101000)} \n".encode())
+        if rng.random() < 0.01:
+            lines.append(b"log debug targetLeftClicks = 1564\n")
+    return lines[:count]
+
+
+# The parsing done before the table-driven parser, kept for comparison
+def _float_or_none(x: str) -> t.Optional[float]:
+    try:
+        return float(x)
+    except ValueError:
+        return None
+
+
+def _int_or_none(x: str) -> t.Optional[int]:
+    try:
+        return int(x)
+    except ValueError:
+        return None
+
+
+def legacy_parse(line: bytes):
+    msg = line.decode()
+    msg_type = msg.strip().split(" ")[0]
+    if msg_type == "data":
+        m = re.match(r"^data (\w+) (.*)$", msg)
+        raw_meas = m[2].strip().split(" ")
+        if m[1] in ("internal_bme", "external_bme"):
+            return {"temp": _float_or_none(raw_meas[0]), "humidity": _float_or_none(raw_meas[1]),
+                    "pressure": _int_or_none(raw_meas[2])}
+        elif m[1] == "imu":
+            return {"roll": _float_or_none(raw_meas[0]), "pitch": _float_or_none(raw_meas[1]),
+                    "yaw": _float_or_none(raw_meas[2]), "temp": _int_or_none(raw_meas[3])}
+        elif m[1] == "load_current":
+            int_current = _int_or_none(raw_meas[0])
+            return {"current": None if int_current is None else int_current / 10}
+        elif m[1] == "panel_power":
+            return {"voltage": _float_or_none(raw_meas[0]), "current": _float_or_none(raw_meas[1])}
+    elif msg_type == "log":
+        m = re.match(r"^log (\w+) (.*)$", msg)
+        return m[1], m[2]
+    elif msg_type == "echo":
+        return re.match(r"^echo (.*)$", msg)[1]
+    return None
+
+
+def to_frame(line: bytes) -> bytes:
+    """Encodes a data line as the Arduino would in binary mode, other lines are sent as text in both modes"""
+    fields = line.split()
+    if len(fields) < 2 or fields[0] != b"data" or fields[1] not in SENSOR_SCHEMAS:
+        return line
+    schema = SENSOR_SCHEMAS[fields[1]]
+    values = [float(v) if fmt == "f" else int(v) for v, fmt in zip(fields[2:], schema.frame_format[1:])]
+    body = bytes((schema.frame_type,)) + struct.pack(schema.frame_format, *values)
+    length = bytes((len(body),))
+    crc = binascii.crc_hqx(length + body, 0xFFFF)
+    return bytes((FRAME_SYNC,)) + length + body + struct.pack(">H", crc)
+
+
+def bench_stream(name: str, data: bytes, count: int, repeat: int) -> float:
+    """Times reading `count` messages out of a stream with `read_message`"""
+    async def read_all():
+        reader = asyncio.StreamReader(limit=len(data) + 1)
+        reader.feed_data(data)
+        reader.feed_eof()
+        start = time.perf_counter()
+        for _ in range(count):
+            await read_message(reader)
+        return time.perf_counter() - start
+
+    best = min(asyncio.run(read_all()) for _ in range(repeat))
+    print(f"{name:>12}: {best * 1e6 / count:6.2f} us/msg, {count / best:9.0f} msgs/s, {len(data) / count:5.1f} bytes/msg")
+    return best
+
+
+def bench(name: str, parse, lines: t.List[bytes], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            parse(line)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:>12}: {best * 1e6 / len(lines):6.2f} us/line, {len(lines) / best:9.0f} lines/s")
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--trace", help="captured serial output to parse")
+    parser.add_argument("--lines", type=int, default=50000, help="length of the generated trace")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.trace:
+        with open(args.trace, "rb") as f:
+            lines = f.read().splitlines(keepends=True)
+    else:
+        lines = synthetic_trace(args.lines)
+
+    slow = bench("legacy", legacy_parse, lines, args.repeat)
+    fast = bench("parse_line", parse_line, lines, args.repeat)
+    print(f"{'speedup':>12}: {slow / fast:.1f}x")
+
+    print()
+    text = b"".join(lines)
+    binary = b"".join(to_frame(line) for line in lines)
+    slow = bench_stream("text", text, len(lines), args.repeat)
+    fast = bench_stream("binary", binary, len(lines), args.repeat)
+    print(f"{'speedup':>12}: {slow / fast:.1f}x, {len(text) / len(binary):.1f}x fewer bytes")
+
+
+if __name__ == "__main__":
+    main()
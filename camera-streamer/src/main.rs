@@ -1,7 +1,11 @@
 use std::error::Error;
-use std::io::Cursor;
+use std::io::{Cursor, ErrorKind};
 use std::path::PathBuf;
+use std::sync::mpsc;
+use std::thread;
+use std::time::Duration;
 use tungstenite::{connect, Message, Error as WsError};
+use tungstenite::stream::MaybeTlsStream;
 use clap::Parser;
 use image::io::Reader as ImageReader;
 
@@ -30,7 +34,44 @@ struct Args {
     debug: bool,
 
     #[clap(short, long, value_parser)]
-    skip: Option<u16>
+    skip: Option<u16>,
+
+    /// Apply the skip, quality and scale the relay asks for, implies --reencode
+    #[clap(short, long)]
+    adaptive: bool
+}
+
+/// Output settings that can be changed while streaming, by the relay or by control lines on stdin
+struct Settings {
+    skip: u16,
+    quality: u8,
+    resolution: (u32, u32),
+    scale: u32
+}
+
+impl Settings {
+    /// Applies a control line of names and values, e.g. "skip 1 quality 40 scale 2" or "resolution 320 240"
+    fn apply(&mut self, line: &str) {
+        let words: Vec<&str> = line.split_whitespace().collect();
+        let mut i = 0;
+        while i < words.len() {
+            match (words[i], number(&words, i + 1), number(&words, i + 2)) {
+                ("skip", Some(skip), _) => { self.skip = skip as u16; i += 2; }
+                ("quality", Some(quality), _) => { self.quality = quality.clamp(1, 100) as u8; i += 2; }
+                ("scale", Some(scale), _) => { self.scale = scale.max(1); i += 2; }
+                ("resolution", Some(width), Some(height)) => { self.resolution = (width, height); i += 3; }
+                _ => { println!("invalid control line: {line}"); return; }
+            }
+        }
+    }
+
+    fn output_resolution(&self) -> (u32, u32) {
+        (self.resolution.0 / self.scale, self.resolution.1 / self.scale)
+    }
+}
+
+fn number(words: &[&str], i: usize) -> Option<u32> {
+    words.get(i).and_then(|word| word.parse().ok())
 }
 
 
@@ -38,17 +79,33 @@ fn main() {
     // Parse args
     let args: Args = Args::parse();
     let input_res = args.input_resolution.map(|v| (v[0], v[1])).unwrap_or((640, 480));
-    let output_res = args.output_resolution.map(|v| (v[0], v[1])).unwrap_or((256, 144));
-    let output_qual = args.output_quality.unwrap_or(50);
+    let framerate = args.framerate.unwrap_or(10);
+    let mut settings = Settings {
+        skip: args.skip.unwrap_or(0),
+        quality: args.output_quality.unwrap_or(50),
+        resolution: args.output_resolution.map(|v| (v[0], v[1])).unwrap_or((256, 144)),
+        scale: 1
+    };
     let debug = args.debug;
-    let reencode = args.reencode;
-    let skip = args.skip.unwrap_or(0);
+    let adaptive = args.adaptive;
+    let reencode = args.reencode || adaptive;
+
+    // Control lines from the rover, read on their own thread so they never hold up a frame
+    let (control_tx, control_rx) = mpsc::channel::<String>();
+    thread::spawn(move || {
+        for line in std::io::stdin().lines() {
+            match line {
+                Ok(line) => if control_tx.send(line).is_err() { break; },
+                Err(_) => break
+            }
+        }
+    });
 
     // get camera device, config and start
     let mut cam = rscam::new(args.device.to_str().unwrap()).expect("failed to get camera device");
 
     cam.start(&rscam::Config {
-        interval: (1, args.framerate.unwrap_or(10)),
+        interval: (1, framerate),
         resolution: input_res,
         format: b"MJPG",
         ..Default::default()
@@ -62,10 +119,33 @@ fn main() {
             Err(e) => { println!("failed to connect: {e}"); continue; }
         };
         println!("connected");
+        // Poll for control messages from the relay between frames, which also answers its keepalive pings
+        if let MaybeTlsStream::Plain(stream) = sck.get_mut() {
+            stream.set_read_timeout(Some(Duration::from_millis(1))).expect("failed to set read timeout");
+        }
+        if let Err(e) = sck.write_message(Message::Text(format!("framerate {framerate}"))) {
+            println!("failed to send hello: {e}");
+            continue 'conn_loop;
+        }
         loop { // Endlessly send frames
+            while let Ok(line) = control_rx.try_recv() {
+                settings.apply(&line);
+            }
+            loop {
+                match sck.read_message() {
+                    Ok(Message::Text(line)) => if adaptive { settings.apply(&line); },
+                    Ok(_) => (),
+                    Err(WsError::Io(e)) if matches!(e.kind(), ErrorKind::WouldBlock | ErrorKind::TimedOut) => break,
+                    Err(e) => {
+                        println!("conn closed ({e}), reconnecting");
+                        continue 'conn_loop;
+                    }
+                }
+            }
+
             if debug { println!("getting frame"); }
             let frame= cam.capture().expect("failed to get frame");
-            for _ in 0..skip {
+            for _ in 0..settings.skip {
                 cam.capture().expect("failed to get frame");
             }
             if debug { println!("frame {}: {}, size {}", n, std::str::from_utf8(&frame.format).unwrap(), frame.len()); }
@@ -75,8 +155,8 @@ fn main() {
                 // reencode frame
                 let encoded_frame = match reencode_frame(
                     &frame,
-                    output_res,
-                    output_qual
+                    settings.output_resolution(),
+                    settings.quality
                 ) {
                     Ok(f) => f,
                     Err(e) => {
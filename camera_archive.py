@@ -0,0 +1,340 @@
+"""
+Append-only archive of camera frames, for replaying runs after the fact.
+
+The archive is a directory of segments. Each segment is a blob of the JPEG frames back to back (an MJPEG file named
+<start>.mjpeg, with the start in ns since the epoch) and an index of fixed-size entries (<start>.idx):
+
+    timestamp in ns (u64) | offset in the blob (u64) | length (u64)
+
+Entries are in native byte order and time order, so a segment's index can be binary searched in place. The blob is
+always written before the index, so every indexed frame is complete. If the clock steps back, a new segment is started,
+so segments can overlap in time but each is in order.
+"""
+import asyncio
+import bisect
+import heapq
+import itertools
+import logging
+import os
+import pathlib
+import queue
+import struct
+import threading
+import time
+import typing as t
+
+INDEX_ENTRY = struct.Struct("=QQQ")
+
+logger = logging.getLogger(__name__)
+
+# Sentinel put on the queue to make the writer thread flush and exit
+_STOP = object()
+
+
+def list_segments(directory: pathlib.Path) -> t.List[int]:
+    """The start of every segment in an archive, in order"""
+    return sorted(int(path.stem) for path in directory.glob("*.idx") if path.stem.isdigit())
+
+
+class CameraArchive:
+    """
+    Queues frames to be archived and writes them in batches from a dedicated thread, so the relay never waits on the
+    disk.
+    """
+
+    def __init__(self, directory: t.Union[str, pathlib.Path], flush_interval: float = 1.0,
+                 batch_bytes: int = 4 * 1024 * 1024, segment_bytes: int = 256 * 1024 * 1024,
+                 segment_seconds: float = 600, max_queue: int = 500, retention: t.Optional[float] = 3 * 86400,
+                 max_bytes: t.Optional[int] = 20 * 1024 ** 3):
+        """
+        :param directory: Directory of the archive's segments, created if needed
+        :param flush_interval: Maximum number of seconds a queued frame waits before being written
+        :param batch_bytes: Frame bytes written per batch
+        :param segment_bytes: Size at which a new segment is started
+        :param segment_seconds: Age at which a new segment is started
+        :param max_queue: Maximum number of queued frames before new ones are dropped
+        :param retention: Seconds to keep a segment for after it was last written to, or None to keep them forever
+        :param max_bytes: Size of the archive above which the oldest segments are deleted, or None for no limit
+        """
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.flush_interval = flush_interval
+        self.batch_bytes = batch_bytes
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.retention = retention
+        self.max_bytes = max_bytes
+
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._thread: t.Optional[threading.Thread] = None
+
+        # The current segment, only used by the writer thread
+        self._blob: t.Optional[t.BinaryIO] = None
+        self._index: t.Optional[t.BinaryIO] = None
+        self._segment_start = 0
+        self._segment_size = 0
+        self._index_size = 0
+        # Size of the other segments as of the last prune
+        self._other_bytes = 0
+        # Timestamp of the last frame written, to notice the clock stepping back
+        self._last_timestamp = 0
+
+        self.queued = 0
+        self.dropped = 0
+        self.frames_written = 0
+        self.bytes_written = 0
+        self.segments_deleted = 0
+        self.errors = 0
+
+    def start(self):
+        """Starts the writer thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="camera-archiver", daemon=True)
+            self._thread.start()
+
+    def close(self, timeout: t.Optional[float] = 10.0):
+        """
+        Writes all queued frames and stops the writer thread
+        :param timeout: Maximum number of seconds to wait for the writes
+        """
+        if self._thread is not None:
+            self._queue.put(_STOP)
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.error("Camera archiver did not finish writing before timeout")
+                return
+            self._thread = None
+
+    def add(self, frame: bytes, timestamp: int) -> bool:
+        """
+        Queues a frame to be archived
+        :param frame: The JPEG frame
+        :param timestamp: When the frame was received, in ns since the epoch
+        :return: False if the queue was full and the frame was dropped
+        """
+        try:
+            self._queue.put_nowait((timestamp, frame))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.queued += 1
+        return True
+
+    def _open_segment(self, start: int):
+        self._close_segment()
+        # After the clock steps back, an earlier segment may already start at the same time
+        while (self.directory / f"{start}.idx").exists():
+            start += 1
+        self._blob = open(self.directory / f"{start}.mjpeg", "ab")
+        self._index = open(self.directory / f"{start}.idx", "ab")
+        self._segment_start = start
+        self._segment_size = 0
+        self._index_size = 0
+        self._prune()
+
+    def _prune(self):
+        """Deletes the oldest segments past the retention or the size limit, except the one being written"""
+        segments = []
+        total = self._segment_size + self._index_size
+        for segment in list_segments(self.directory):
+            if segment == self._segment_start:
+                continue
+            paths = [self.directory / f"{segment}.idx", self.directory / f"{segment}.mjpeg"]
+            stats = [path.stat() for path in paths if path.exists()]
+            segments.append((max(stat.st_mtime for stat in stats), paths, sum(stat.st_size for stat in stats)))
+            total += segments[-1][2]
+        # Least recently written first
+        segments.sort(key=lambda segment: segment[0])
+        now = time.time()
+        for modified, paths, size in segments:
+            expired = self.retention is not None and now - modified > self.retention
+            if not expired and (self.max_bytes is None or total <= self.max_bytes):
+                break
+            for path in paths:
+                path.unlink(missing_ok=True)
+            total -= size
+            self.segments_deleted += 1
+        self._other_bytes = total - self._segment_size - self._index_size
+
+    def _close_segment(self):
+        if self._blob is not None:
+            self._blob.close()
+            self._index.close()
+            self._blob = self._index = None
+
+    def _write(self, batch: t.List[t.Tuple[int, bytes]]):
+        """Writes frames, starting a new segment when the current one is full or old, or the clock stepped back"""
+        run: t.List[t.Tuple[int, bytes]] = []
+        size = 0
+        for timestamp, frame in batch:
+            last = run[-1][0] if run else self._last_timestamp
+            if (self._blob is None or self._segment_size + size >= self.segment_bytes or timestamp < last
+                    or timestamp - self._segment_start >= self.segment_seconds * 1e9):
+                if run:
+                    self._append(run)
+                    run = []
+                    size = 0
+                self._open_segment(timestamp)
+            run.append((timestamp, frame))
+            size += len(frame)
+        self._append(run)
+
+    def _append(self, frames: t.List[t.Tuple[int, bytes]]):
+        """Appends frames to the current segment"""
+        entries = []
+        offset = self._segment_size
+        for timestamp, frame in frames:
+            entries.append(INDEX_ENTRY.pack(timestamp, offset, len(frame)))
+            offset += len(frame)
+        # Blob first, so the index never points past the end of it
+        self._blob.write(b"".join(frame for _timestamp, frame in frames))
+        self._blob.flush()
+        self._index.write(b"".join(entries))
+        self._index.flush()
+
+        self.frames_written += len(frames)
+        self.bytes_written += offset - self._segment_size
+        self._segment_size = offset
+        self._index_size += len(entries) * INDEX_ENTRY.size
+        self._last_timestamp = frames[-1][0]
+
+        if (self.max_bytes is not None and self._other_bytes
+                and self._other_bytes + self._segment_size + self._index_size > self.max_bytes):
+            self._prune()
+
+    def _run(self):
+        batch: t.List[t.Tuple[int, bytes]] = []
+        size = 0
+        deadline = None
+        stopping = False
+        while not stopping:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is _STOP:
+                stopping = True
+            elif item is not None:
+                batch.append(item)
+                size += len(item[1])
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+
+            if batch and (stopping or size >= self.batch_bytes or time.monotonic() >= deadline):
+                try:
+                    self._write(batch)
+                except OSError:
+                    self.errors += 1
+                    logger.exception("Failed to write camera frames")
+                    self._close_segment()
+                batch = []
+                size = 0
+                deadline = None
+        self._close_segment()
+
+
+class _Timestamps(t.Sequence[int]):
+    """The timestamps of an index, without unpacking it"""
+
+    def __init__(self, entries: memoryview):
+        self.entries = entries
+
+    def __len__(self) -> int:
+        return len(self.entries) // 3
+
+    def __getitem__(self, i: int) -> int:
+        return self.entries[3 * i]
+
+
+class CameraArchiveReader:
+    """Reads frames from an archive, including the segment being written"""
+
+    def __init__(self, directory: t.Union[str, pathlib.Path]):
+        """
+        :param directory: Directory of the archive's segments
+        """
+        self.directory = pathlib.Path(directory)
+
+    def segments(self) -> t.List[int]:
+        """The start of every segment, in time order"""
+        return list_segments(self.directory)
+
+    def _load_index(self, segment: int) -> memoryview:
+        data = (self.directory / f"{segment}.idx").read_bytes()
+        # Ignore an entry still being written
+        return memoryview(data)[:len(data) - len(data) % INDEX_ENTRY.size].cast("Q")
+
+    def _last_timestamp(self, segment: int) -> t.Optional[int]:
+        """The timestamp of a segment's last frame, or None if it has none or was deleted"""
+        try:
+            with open(self.directory / f"{segment}.idx", "rb") as index:
+                size = os.fstat(index.fileno()).st_size
+                size -= size % INDEX_ENTRY.size
+                if not size:
+                    return None
+                index.seek(size - INDEX_ENTRY.size)
+                return INDEX_ENTRY.unpack(index.read(INDEX_ENTRY.size))[0]
+        except FileNotFoundError:
+            return None
+
+    def _segment_frames(self, segment: int, start: int, end: t.Optional[int]) -> t.Iterator[t.Tuple[int, bytes]]:
+        try:
+            index = self._load_index(segment)
+            blob = open(self.directory / f"{segment}.mjpeg", "rb")
+        except FileNotFoundError:
+            return  # deleted by retention
+        with blob:
+            for i in range(bisect.bisect_left(_Timestamps(index), start), len(index) // 3):
+                timestamp, offset, length = index[3 * i:3 * i + 3]
+                if end is not None and timestamp >= end:
+                    return
+                blob.seek(offset)
+                yield timestamp, blob.read(length)
+
+    def frames(self, start: int = 0, end: t.Optional[int] = None) -> t.Iterator[t.Tuple[int, bytes]]:
+        """
+        Reads frames in time order. This blocks on the disk, so run it off the event loop.
+        :param start: Time of the first frame in ns since the epoch, inclusive
+        :param end: Time of the last frame in ns since the epoch, exclusive, or None for every frame archived
+        :return: The frames and their timestamps
+        """
+        # Segments overlapping the range, in groups that overlap each other, which only happens after a clock step
+        groups: t.List[t.List[int]] = []
+        group_end = None
+        for segment in self.segments():
+            if end is not None and segment >= end:
+                break
+            last = self._last_timestamp(segment)
+            if last is None or last < start:
+                continue
+            if groups and segment <= group_end:
+                groups[-1].append(segment)
+                group_end = max(group_end, last)
+            else:
+                groups.append([segment])
+                group_end = last
+
+        for group in groups:
+            if len(group) == 1:
+                yield from self._segment_frames(group[0], start, end)
+            else:
+                yield from heapq.merge(
+                    *(self._segment_frames(segment, start, end) for segment in group), key=lambda frame: frame[0]
+                )
+
+    async def read_frames(self, start: int = 0, end: t.Optional[int] = None, batch: int = 16) \
+            -> t.AsyncIterator[t.Tuple[int, bytes]]:
+        """
+        Reads frames in time order, a batch at a time off the event loop
+        :param start: Time of the first frame in ns since the epoch, inclusive
+        :param end: Time of the last frame in ns since the epoch, exclusive, or None for every frame archived
+        :param batch: Frames read per trip to the reading thread
+        """
+        frames = self.frames(start, end)
+        while True:
+            chunk = await asyncio.to_thread(lambda: list(itertools.islice(frames, batch)))
+            for frame in chunk:
+                yield frame
+            if len(chunk) < batch:
+                return
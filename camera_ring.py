@@ -0,0 +1,168 @@
+"""
+Ring buffer of camera frames in a memory-mapped file, written by the camera relay and read by consumers on the same
+machine (recorders, thumbnailers, vision) without another websocket hop or copy per consumer.
+
+Layout, all little-endian:
+
+    header: magic (8s) | slot count (u32) | slot size (u32) | frames written (u64), padded to 64 bytes
+    slot:   sequence (u64) | timestamp in ns (u64) | length (u32), padded to 32 bytes | frame data (slot size bytes)
+
+Frame n (counting from 1) goes in slot (n - 1) % slot count. Each slot is guarded by a sequence lock: its sequence is
+2n - 1 while frame n is being written and 2n once it is complete, so readers can tell when a frame they are looking at
+was overwritten.
+"""
+import asyncio
+import mmap
+import os
+import struct
+import time
+import typing as t
+
+MAGIC = b"SSCAMRNG"
+HEADER = struct.Struct("<8sIIQ")
+HEADER_SIZE = 64
+SLOT_HEADER = struct.Struct("<QQI")
+SLOT_HEADER_SIZE = 32
+# Frames written is the last header field
+FRAMES_OFFSET = HEADER.size - 8
+
+DEFAULT_PATH = "/dev/shm/sandshark-camera"
+
+
+class Frame(t.NamedTuple):
+    sequence: int
+    timestamp: int  # time.time_ns() when the relay received the frame
+    data: memoryview  # Valid until the slot is overwritten, check with `FrameRingReader.valid`
+
+
+class FrameRing:
+    """Writes frames to the ring"""
+
+    def __init__(self, path: str = DEFAULT_PATH, slots: int = 16, slot_size: int = 256 * 1024):
+        """
+        :param path: The ring file, best on a tmpfs like /dev/shm
+        :param slots: Number of frames kept
+        :param slot_size: Largest frame size in bytes, bigger frames are skipped
+        """
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        size = HEADER_SIZE + slots * (SLOT_HEADER_SIZE + slot_size)
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            # Keep counting from the previous relay's frames if the layout is the same, so readers waiting for the next
+            # frame don't stall
+            header = os.pread(fd, HEADER.size, 0)
+            if len(header) == HEADER.size and HEADER.unpack(header)[:3] == (MAGIC, slots, slot_size):
+                self.written = HEADER.unpack(header)[3]
+            else:
+                self.written = 0
+                os.ftruncate(fd, 0)
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        HEADER.pack_into(self._map, 0, MAGIC, slots, slot_size, self.written)
+
+        self.skipped = 0
+
+    def write(self, frame: bytes, timestamp: t.Optional[int] = None) -> bool:
+        """
+        Adds a frame to the ring, overwriting the oldest one
+        :param frame: The JPEG frame
+        :param timestamp: When the frame was received in ns since the epoch, now by default
+        :return: Whether the frame fit in a slot
+        """
+        if len(frame) > self.slot_size:
+            self.skipped += 1
+            return False
+        sequence = self.written + 1
+        offset = HEADER_SIZE + (sequence - 1) % self.slots * (SLOT_HEADER_SIZE + self.slot_size)
+        SLOT_HEADER.pack_into(self._map, offset, 2 * sequence - 1, 0, 0)
+        start = offset + SLOT_HEADER_SIZE
+        self._map[start:start + len(frame)] = frame
+        SLOT_HEADER.pack_into(self._map, offset, 2 * sequence, timestamp or time.time_ns(), len(frame))
+        struct.pack_into("<Q", self._map, FRAMES_OFFSET, sequence)
+        self.written = sequence
+        return True
+
+    def close(self):
+        self._map.close()
+
+
+class FrameRingReader:
+    """
+    Reads frames from the ring without copying them. Frames are views into the shared mapping, so a frame's data can
+    change under the reader once the writer laps it: check `valid` after using it, and release frames (e.g. `del`)
+    before `close`.
+    """
+
+    def __init__(self, path: str = DEFAULT_PATH):
+        """
+        :param path: The ring file, raises FileNotFoundError if the relay hasn't created it yet
+        """
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slots, self.slot_size, _ = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError(f"{path} is not a camera frame ring")
+        self._view = memoryview(self._map)
+
+    @property
+    def written(self) -> int:
+        """Number of frames written so far, which is the sequence of the latest frame"""
+        return struct.unpack_from("<Q", self._map, FRAMES_OFFSET)[0]
+
+    def _offset(self, sequence: int) -> int:
+        return HEADER_SIZE + (sequence - 1) % self.slots * (SLOT_HEADER_SIZE + self.slot_size)
+
+    def get(self, sequence: int) -> t.Optional[Frame]:
+        """
+        Gets a frame by its sequence
+        :return: The frame, or None if it hasn't been written yet or was overwritten
+        """
+        if sequence < 1:
+            return None
+        offset = self._offset(sequence)
+        slot_sequence, timestamp, length = SLOT_HEADER.unpack_from(self._map, offset)
+        if slot_sequence != 2 * sequence:
+            return None
+        start = offset + SLOT_HEADER_SIZE
+        return Frame(sequence, timestamp, self._view[start:start + length])
+
+    def latest(self) -> t.Optional[Frame]:
+        """Gets the newest complete frame, or None if there are none"""
+        # Retry if the writer laps the slot between reading the count and the slot
+        for _ in range(3):
+            frame = self.get(self.written)
+            if frame is not None:
+                return frame
+        return None
+
+    async def follow(self, every_frame: bool = False, poll_interval: float = 0.005) -> t.AsyncIterator[Frame]:
+        """
+        Yields frames as they are written, starting after the current latest frame
+        :param every_frame: Yield every frame still in the ring, e.g. for a recorder, instead of skipping to the latest
+        :param poll_interval: Seconds between checks for new frames
+        """
+        last = self.written
+        while True:
+            written = self.written
+            if written == last:
+                await asyncio.sleep(poll_interval)
+                continue
+            # Frames more than a ring behind are already gone
+            last = max(last + 1, written - self.slots + 1) if every_frame else written
+            frame = self.get(last)
+            if frame is not None:
+                yield frame
+
+    def valid(self, frame: Frame) -> bool:
+        """Whether a frame's data is still intact, i.e. the writer hasn't started overwriting its slot"""
+        return struct.unpack_from("<Q", self._map, self._offset(frame.sequence))[0] == 2 * frame.sequence
+
+    def close(self):
+        self._view.release()
+        self._map.close()
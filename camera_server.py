@@ -1,26 +1,332 @@
 import websockets
 import asyncio
+import os
+import pathlib
+import time
+import typing as t
+import urllib.parse
 
-viewers = set()
+from camera_archive import CameraArchive, CameraArchiveReader
+from camera_ring import DEFAULT_PATH as RING_PATH, FrameRing
 
 
-async def serve(sck):
+class Viewer:
+    def __init__(self, sck: websockets.WebSocketServerProtocol):
+        """
+        :param sck: The viewer connection
+        """
+        self.sck = sck
+        # Single-slot mailbox: a new frame replaces one the viewer hasn't been sent yet, so a slow viewer skips to the
+        # newest frame instead of falling behind
+        self.frame: t.Optional[bytes] = None
+        self.ready = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+        self.connected_at = time.monotonic()
+
+    def offer(self, frame: bytes) -> bool:
+        """
+        Puts a frame in the viewer's mailbox
+        :return: Whether a frame the viewer hadn't been sent yet was dropped
+        """
+        dropped = self.frame is not None
+        if dropped:
+            self.dropped += 1
+        self.frame = frame
+        self.ready.set()
+        return dropped
+
+    async def run(self):
+        """Sends frames to the viewer as fast as it takes them, until it disconnects"""
+        try:
+            while True:
+                await self.ready.wait()
+                self.ready.clear()
+                frame, self.frame = self.frame, None
+                await self.sck.send(frame)
+                self.sent += 1
+        except websockets.ConnectionClosed:
+            pass
+
+    def stats(self) -> str:
+        return f"{self.sent} frames sent, {self.dropped} dropped in {time.monotonic() - self.connected_at:.0f}s"
+
+
+class StreamController:
+    """
+    Adapts the stream to what the uplink and the viewers can keep up with. Each window, the stream steps down a level
+    if viewers drop too many frames or fewer frames arrive than the streamer captures, and steps back up after a few
+    windows without drops.
+    """
+    # (skip, quality, scale) from best to worst
+    LEVELS = ((0, 70, 1), (0, 50, 1), (1, 50, 1), (1, 40, 2), (3, 30, 2))
+
+    def __init__(self, interval: float = 2, drop_high: float = 0.2, drop_low: float = 0.02, uplink_low: float = 0.8,
+                 stable_windows: int = 3):
+        """
+        :param interval: Seconds per measurement window
+        :param drop_high: Fraction of frames dropped for viewers above which the stream steps down
+        :param drop_low: Fraction of frames dropped for viewers below which the stream may step up
+        :param uplink_low: Fraction of the expected frame rate arriving from the streamer below which it steps down
+        :param stable_windows: Good windows needed in a row to step up
+        """
+        self.interval = interval
+        self.drop_high = drop_high
+        self.drop_low = drop_low
+        self.uplink_low = uplink_low
+        self.stable_windows = stable_windows
+
+        self.streamer: t.Optional[websockets.WebSocketServerProtocol] = None
+        self.framerate: t.Optional[int] = None  # The streamer's capture rate, once it has said hello
+        self.level = 1
+        self.good_windows = 0
+        self.settling = False
+
+        # Counts for the current window
+        self.received = 0
+        self.offered = 0
+        self.dropped = 0
+
+    async def connect(self, sck: websockets.WebSocketServerProtocol, hello: str):
+        """Starts controlling a streamer, which sends its capture frame rate as "framerate <fps>" """
+        try:
+            self.framerate = int(hello.split()[1])
+        except (IndexError, ValueError):
+            print(f"invalid streamer hello: {hello}")
+            return
+        self.streamer = sck
+        await self.apply()
+
+    def disconnect(self, sck: websockets.WebSocketServerProtocol):
+        if self.streamer is sck:
+            self.streamer = None
+            self.framerate = None
+
+    def record(self, offered: int, dropped: int):
+        """Counts a frame received from the streamer and offered to viewers"""
+        self.received += 1
+        self.offered += offered
+        self.dropped += dropped
+
+    def evaluate(self) -> int:
+        """Ends the window and chooses the level for the next one"""
+        received, offered, dropped = self.received, self.offered, self.dropped
+        self.received = self.offered = self.dropped = 0
+        if self.settling:
+            # The window straddled a level change
+            self.settling = False
+            return self.level
+
+        drop_rate = dropped / offered if offered else 0
+        skip = self.LEVELS[self.level][0]
+        expected = self.framerate * self.interval / (skip + 1) if self.framerate else 0
+        if drop_rate > self.drop_high or received < expected * self.uplink_low:
+            self.good_windows = 0
+            return min(self.level + 1, len(self.LEVELS) - 1)
+        if drop_rate < self.drop_low:
+            self.good_windows += 1
+            if self.good_windows >= self.stable_windows:
+                self.good_windows = 0
+                return max(self.level - 1, 0)
+        else:
+            self.good_windows = 0
+        return self.level
+
+    async def apply(self):
+        """Sends the current level to the streamer, which applies it without restarting"""
+        skip, quality, scale = self.LEVELS[self.level]
+        try:
+            await self.streamer.send(f"skip {skip} quality {quality} scale {scale}")
+        except websockets.ConnectionClosed:
+            pass
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self.streamer is None:
+                continue
+            level = self.evaluate()
+            if level != self.level:
+                print(f"stream level {self.level} -> {level}: {self.LEVELS[level]}")
+                self.level = level
+                self.settling = True
+                await self.apply()
+
+
+class Replay:
+    """
+    Plays archived frames to a viewer, paced by their timestamps. The viewer can send "seek <unix time in seconds>"
+    and "speed <factor>" while it plays.
+    """
+
+    def __init__(self, sck: websockets.WebSocketServerProtocol, reader: CameraArchiveReader, start: int,
+                 speed: float):
+        """
+        :param sck: The viewer connection
+        :param reader: The archive
+        :param start: Time of the first frame in ns since the epoch
+        :param speed: Playback speed, 1 for real time
+        """
+        self.sck = sck
+        self.reader = reader
+        self.position = start
+        self.speed = speed
+        # Set when the viewer seeks or changes speed, to restart playback from the current position
+        self.changed = asyncio.Event()
+        self.sent = 0
+        self.skipped = 0
+
+    async def receive(self):
+        """Applies the viewer's seek and speed requests"""
+        async for msg in self.sck:
+            command, _, value = str(msg).partition(" ")
+            try:
+                match command:
+                    case "seek":
+                        self.position = int(float(value) * 1e9)
+                    case "speed":
+                        if float(value) <= 0:
+                            raise ValueError
+                        self.speed = float(value)
+                    case _:
+                        raise ValueError
+            except ValueError:
+                print(f"replay {self.sck.remote_address}: invalid request {msg!r}")
+                continue
+            self.changed.set()
+
+    async def play(self):
+        """Sends frames from the current position until the archive ends, starting over after a seek or speed change"""
+        loop = asyncio.get_running_loop()
+        while True:
+            self.changed.clear()
+            origin = None
+            async for timestamp, frame in self.reader.read_frames(self.position):
+                if origin is None:
+                    origin = (timestamp, loop.time())
+                delay = origin[1] + (timestamp - origin[0]) / 1e9 / self.speed - loop.time()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self.changed.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                if self.changed.is_set():
+                    break
+                self.position = timestamp + 1
+                # Skip frames to catch up if the viewer can't keep up with the speed
+                if delay < -0.5:
+                    self.skipped += 1
+                    continue
+                await self.sck.send(frame)
+                self.sent += 1
+            else:
+                return
+
+    async def run(self):
+        receiver = asyncio.create_task(self.receive())
+        try:
+            await self.play()
+            await self.sck.close(1000, "End of archive")
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            receiver.cancel()
+
+
+viewers: t.Set[Viewer] = set()
+controller = StreamController()
+# Frames are also shared with local consumers through a memory-mapped ring, unless SANDSHARK_CAMERA_RING is empty
+ring: t.Optional[FrameRing] = None
+# Frames are archived for replay, unless SANDSHARK_CAMERA_ARCHIVE is empty
+archive_path = os.environ.get("SANDSHARK_CAMERA_ARCHIVE", str(pathlib.Path(__file__).parent / "camera_archive"))
+# Segments are deleted after this many days, or oldest first once the archive is bigger than this many GiB
+archive_days = float(os.environ.get("SANDSHARK_CAMERA_ARCHIVE_DAYS", 3))
+archive_gib = float(os.environ.get("SANDSHARK_CAMERA_ARCHIVE_GIB", 20))
+archive: t.Optional[CameraArchive] = None
+
+
+async def serve(sck: websockets.WebSocketServerProtocol):
     print(f"client connected: {sck.remote_address} at path {sck.path}")
-    match sck.path:
+    path = urllib.parse.urlsplit(sck.path)
+    match path.path:
         case "/view":
-            viewers.add(sck)
+            viewer = Viewer(sck)
+            viewers.add(viewer)
             print("connected as viewer")
-            await asyncio.Future()
+            # Viewers don't send anything, stop when the connection closes
+            sender = asyncio.create_task(viewer.run())
+            closed = asyncio.create_task(sck.wait_closed())
+            try:
+                await asyncio.wait((sender, closed), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                sender.cancel()
+                closed.cancel()
+                viewers.discard(viewer)
+            print(f"viewer {sck.remote_address}: {viewer.stats()}")
         case "/stream":
             print("connected as streamer")
-            async for msg in sck:
-                websockets.broadcast(viewers, msg)
+            try:
+                async for msg in sck:
+                    # Text messages are the streamer's hello, frames are binary
+                    if isinstance(msg, str):
+                        await controller.connect(sck, msg)
+                        continue
+                    now = time.time_ns()
+                    if ring is not None:
+                        ring.write(msg, now)
+                    if archive is not None:
+                        archive.add(msg, now)
+                    dropped = 0
+                    for viewer in viewers:
+                        dropped += viewer.offer(msg)
+                    controller.record(len(viewers), dropped)
+            except websockets.ConnectionClosed:
+                pass
+            finally:
+                controller.disconnect(sck)
+        case "/replay":
+            # /replay?start=<unix time in seconds>&speed=<factor>, from the start of the archive at 1x by default
+            query = urllib.parse.parse_qs(path.query)
+            try:
+                start = int(float(query.get("start", ["0"])[0]) * 1e9)
+                speed = float(query.get("speed", ["1"])[0])
+                if speed <= 0 or not archive_path:
+                    raise ValueError
+            except ValueError:
+                await sck.close(1008, "Invalid replay")
+                return
+            print("connected as replay viewer")
+            replay = Replay(sck, CameraArchiveReader(archive_path), start, speed)
+            await replay.run()
+            print(f"replay {sck.remote_address}: {replay.sent} frames sent, {replay.skipped} skipped")
     print(f"client disconnected: {sck.remote_address}")
 
 
+async def report_stats(interval: float = 60):
+    """Periodically prints each viewer's stats"""
+    while True:
+        await asyncio.sleep(interval)
+        for viewer in viewers:
+            print(f"viewer {viewer.sck.remote_address}: {viewer.stats()}")
+
+
 async def main():
-    async with websockets.serve(serve, port=11572):
-        await asyncio.Future()
+    global ring, archive
+    ring_path = os.environ.get("SANDSHARK_CAMERA_RING", RING_PATH)
+    if ring_path:
+        ring = FrameRing(ring_path)
+    if archive_path:
+        archive = CameraArchive(archive_path, retention=archive_days * 86400, max_bytes=int(archive_gib * 1024 ** 3))
+        archive.start()
+    # JPEG frames don't compress, don't spend CPU trying
+    async with websockets.serve(serve, port=11572, compression=None):
+        controller_task = asyncio.create_task(controller.run())
+        try:
+            await report_stats()
+        finally:
+            controller_task.cancel()
+            if archive is not None:
+                archive.close()
 
 
 if __name__ == '__main__':
@@ -2,6 +2,8 @@
 Common components used in both rover and base station
 """
 from enum import Enum
+import bisect
+import json
 import typing as t
 import numbers
 
@@ -9,6 +11,12 @@ import numbers
 import serde.tags
 import serde.fields
 import websockets
+import websockets.frames
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 class Role(Enum):
@@ -24,6 +32,38 @@ class Role(Enum):
         return None
 
 
+class Encoding(Enum):
+    """Wire formats for messages after authentication. JSON is always supported, since browsers use it."""
+    JSON = "json"
+    MSGPACK = "msgpack"
+
+    @property
+    def binary(self) -> bool:
+        """Whether messages are sent as binary rather than text frames"""
+        return self is not Encoding.JSON
+
+    @classmethod
+    def supported(cls) -> t.List["Encoding"]:
+        """The encodings usable with the installed packages, most preferred first"""
+        return ([Encoding.MSGPACK] if msgpack is not None else []) + [Encoding.JSON]
+
+    @classmethod
+    def negotiate(cls, offered: t.Optional[t.List[str]]) -> "Encoding":
+        """
+        Picks the first offered encoding that is supported
+        :param offered: Encoding names in the peer's order of preference, or None if it didn't offer any
+        """
+        supported = cls.supported()
+        for name in offered or ():
+            try:
+                encoding = Encoding(name)
+            except ValueError:
+                continue
+            if encoding in supported:
+                return encoding
+        return Encoding.JSON
+
+
 # Serialization shim to customize the type tag
 class Tag(serde.tags.Internal):
     def lookup_tag(self, variant):
@@ -68,16 +108,92 @@ class MoveContinuousCommand(Command):
     def to_arduino(self): return f"c{self.speed} {self.angle}".encode()  # TODO
 
 
+# TRACING #
+
+class Trace(serde.Model):
+    """
+    Follows a command through each hop to the Arduino and back, to find where control latency comes from. Monotonic
+    clocks of different machines can't be compared, so each hop measures its own duration.
+    """
+    id: serde.fields.Str()
+    sent: serde.fields.Optional(serde.fields.Int())  # originator's monotonic clock in ns, echoed back unchanged
+    # Nanoseconds spent in each hop, by hop name
+    hops: serde.fields.Optional(serde.fields.Dict(key=serde.fields.Str(), value=serde.fields.Int()), default=dict)
+
+
+class LatencyHistogram:
+    """Counts durations in exponentially growing buckets"""
+    # Bucket upper bounds in ns, from 100 us doubling to about 100 s, and a bucket for anything slower
+    BOUNDS = tuple(100_000 << i for i in range(21))
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, duration: int):
+        """Records a duration in ns"""
+        self.counts[bisect.bisect_left(self.BOUNDS, duration)] += 1
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def percentile(self, q: float) -> int:
+        """The upper bound in ns of the bucket holding the q-th (0 to 1) fraction of durations, capped by the max"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= rank and seen:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> t.Dict[str, t.Any]:
+        """Statistics in ms, and the bucket counts by upper bound in ms"""
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count / 1e6 if self.count else None,
+            "p50_ms": self.percentile(0.5) / 1e6,
+            "p90_ms": self.percentile(0.9) / 1e6,
+            "p99_ms": self.percentile(0.99) / 1e6,
+            "max_ms": self.max / 1e6,
+            "buckets": {
+                str(bound / 1e6): count for bound, count in zip(self.BOUNDS + (float("inf"),), self.counts) if count
+            }
+        }
+
+
 # MESSAGES #
 
 class Message(serde.Model):
     """The base message type."""
     tag_name = "__INVALID__"
+    # Whether the message may be dropped for a client that can't keep up, e.g. telemetry superseded by newer readings
+    droppable = False
 
     class Meta:
         abstract = True
         tag = Tag(tag="type")
 
+    def encode(self, encoding: Encoding = Encoding.JSON) -> bytes:
+        """
+        Encodes the message, as UTF-8 for JSON. The result is cached, so a message sent to many clients is only
+        serialized once per encoding; don't modify a message after it has been encoded.
+        """
+        try:
+            cache = self._encoded
+        except AttributeError:
+            cache = self._encoded = {}
+        frame = cache.get(encoding)
+        if frame is None:
+            if encoding is Encoding.MSGPACK:
+                frame = msgpack.packb(self.to_dict())
+            else:
+                frame = self.to_json().encode()
+            cache[encoding] = frame
+        return frame
+
 
 class EStopMessage(Message):
     """Emergency stop: immediately halts motors and cancels the current command"""
@@ -87,6 +203,7 @@ class EStopMessage(Message):
 class LogMessage(Message):
     """Writes a human-readable message to the logger"""
     tag_name = "log"
+    droppable = True
 
     message: serde.fields.Str()
     level: serde.fields.Str()
@@ -97,6 +214,7 @@ class CommandMessage(Message):
     tag_name = "command"
 
     command: serde.fields.Optional(serde.fields.Nested(Command))
+    trace: serde.fields.Optional(serde.fields.Nested(Trace))
 
 
 class CommandEndedMessage(Message):
@@ -105,6 +223,8 @@ class CommandEndedMessage(Message):
 
     command: serde.fields.Nested(Command)
     completed: serde.fields.Bool()
+    trace: serde.fields.Optional(serde.fields.Nested(Trace))  # the command's trace with the hops measured so far
+    rover: serde.fields.Optional(serde.fields.Str())  # the sending rover, set by the base station
 
 
 class CommandStatusMessage(Message):
@@ -112,6 +232,8 @@ class CommandStatusMessage(Message):
     tag_name = "command_status"
 
     command: serde.fields.Optional(serde.fields.Nested(Command))
+    trace: serde.fields.Optional(serde.fields.Nested(Trace))  # the command's trace with the hops measured so far
+    rover: serde.fields.Optional(serde.fields.Str())  # the sending rover, set by the base station
 
 
 class AuthMessage(Message):
@@ -119,6 +241,7 @@ class AuthMessage(Message):
     tag_name = "auth"
 
     token: serde.fields.Str()
+    encodings: serde.fields.Optional(serde.fields.List())  # supported wire formats, most preferred first
 
 
 class AuthResponseMessage(Message):
@@ -127,6 +250,7 @@ class AuthResponseMessage(Message):
 
     success: serde.fields.Bool()
     user: serde.fields.Optional(serde.fields.Str())
+    encoding: serde.fields.Optional(serde.fields.Str())  # wire format for the rest of the connection, JSON if missing
 
 
 class OptionMessage(Message):
@@ -142,15 +266,26 @@ class OptionResponseMessage(Message):
     tag_name = "option_response"
 
     values: serde.fields.Dict()
+    rover: serde.fields.Optional(serde.fields.Str())  # the sending rover, set by the base station
 
 
 class SensorDataMessage(Message):
     """Reports a sensor reading"""
     tag_name = "sensor_data"
+    droppable = True
 
     time: serde.fields.Int()
     sensor: serde.fields.Str()
     measurements: serde.fields.Dict(key=serde.fields.Str())
+    replayed: serde.fields.Optional(serde.fields.Bool())  # sent late from the rover's offline buffer
+    rover: serde.fields.Optional(serde.fields.Str())  # the sending rover, set by the base station
+
+
+class SubscribeMessage(Message):
+    """Sets the rovers a driver controls and receives messages from"""
+    tag_name = "subscribe"
+
+    rovers: serde.fields.Optional(serde.fields.List(element=serde.fields.Str()))  # rover usernames, or null for all
 
 
 class QueryBaseMessage(Message):
@@ -168,6 +303,34 @@ class QueryBaseResponseMessage(Message):
     value: None
 
 
+class QueryHistoryMessage(Message):
+    """Requests stored readings of a sensor measurement over a time range"""
+    tag_name = "query_history"
+
+    id: serde.fields.Str()
+    sensor: serde.fields.Str()
+    measurement: serde.fields.Str()
+    start: serde.fields.Int()
+    end: serde.fields.Int()
+    resolution: serde.fields.Optional(serde.fields.Int(), default=0)  # ns between points, 0 for raw readings
+    cursor: serde.fields.Optional(serde.fields.Str())  # resume after a previously received chunk
+    limit: serde.fields.Optional(serde.fields.Int(), default=500)  # max points per chunk
+
+
+class QueryHistoryResponseMessage(Message):
+    """
+    One chunk of readings requested by a `query_history` message. Points are [time, value] for raw readings, or
+    [bucket start, min, max, mean, count] when `tier` is set.
+    """
+    tag_name = "query_history_response"
+
+    id: serde.fields.Str()
+    tier: serde.fields.Optional(serde.fields.Int())
+    points: serde.fields.List()
+    cursor: serde.fields.Optional(serde.fields.Str())
+    done: serde.fields.Bool()
+
+
 class PointCameraMessage(Message):
     """Sets the target camera pointing direction"""
     tag_name = "point_camera"
@@ -187,25 +350,209 @@ class ArduinoDebugMessage(Message):
 class NmeaMessage(Message):
     """Contains a raw NMEA sentence emitted by the GPS"""
     tag_name = "nmea"
+    droppable = True
 
     time: serde.fields.Int()
     sentence: serde.fields.Str()
+    replayed: serde.fields.Optional(serde.fields.Bool())  # sent late from the rover's offline buffer
+
+
+class ReplayMessage(Message):
+    """Plays stored telemetry and archived camera frames from a time range back to the requesting driver"""
+    tag_name = "replay"
+
+    id: serde.fields.Str()
+    start: serde.fields.Int()
+    end: serde.fields.Int()
+    speed: serde.fields.Optional(serde.fields.Field(), default=1)  # playback speed, 1 for real time
+    camera: serde.fields.Optional(serde.fields.Bool(), default=True)  # include archived camera frames
+
+
+class ReplayControlMessage(Message):
+    """Changes the speed of a running replay, or stops it"""
+    tag_name = "replay_control"
+
+    id: serde.fields.Str()
+    speed: serde.fields.Optional(serde.fields.Field())
+    stop: serde.fields.Optional(serde.fields.Bool(), default=False)
+
+
+class ReplayEndedMessage(Message):
+    """Sent when a replay reaches the end of its time range or is stopped"""
+    tag_name = "replay_ended"
+
+    id: serde.fields.Str()
+    position: serde.fields.Int()  # time of the last message played
+    completed: serde.fields.Bool()
+
+
+class CameraFrameMessage(Message):
+    """A camera frame played back from the archive"""
+    tag_name = "camera_frame"
+    droppable = True
+
+    time: serde.fields.Int()
+    frame: serde.fields.Str()  # base64-encoded JPEG
+
+
+# DECODING #
+
+# Fast decoders by type tag, for message types whose fields can be checked without serde's generic machinery
+decoders: t.Dict[str, t.Callable[[dict], Message]] = {}
+
+
+def _check_instance(ty: type) -> t.Callable[[t.Any], t.Any]:
+    def check(value):
+        if not isinstance(value, ty):
+            raise serde.ValidationError(f"invalid type, expected {ty.__name__!r}", value=value)
+        return value
+    return check
+
+
+def _compile_check(field: serde.fields.Field) -> t.Optional[t.Callable[[t.Any], t.Any]]:
+    """
+    Compiles a serde field into a function that validates and returns a decoded value
+    :return: The check, or None if the field is not simple enough to compile
+    """
+    if field.validators or field.normalizers or field.deserializers:
+        return None
 
+    ty = type(field)
+    if ty is serde.fields.Field:
+        return lambda value: value
+
+    # Primitives and plain instances; their serde deserialization is the identity
+    if ty in (serde.fields.Instance, serde.fields.Bool, serde.fields.Int, serde.fields.Float, serde.fields.Str):
+        return _check_instance(field.ty)
+
+    if ty is serde.fields.Optional:
+        inner = _compile_check(field.inner)
+        if inner is None:
+            return None
+        default = field._default
+
+        def check(value):
+            return default() if value is None else inner(value)
+        return check
+
+    # Dicts with unchecked values, optionally checking the key type
+    if ty is serde.fields.Dict and type(field.value) is serde.fields.Field:
+        if type(field.key) is serde.fields.Field:
+            return _check_instance(dict)
+        if type(field.key) not in (serde.fields.Int, serde.fields.Str):
+            return None
+        key_check = _check_instance(field.key.ty)
+
+        def check(value):
+            if not isinstance(value, dict):
+                raise serde.ValidationError("invalid type, expected 'dict'", value=value)
+            for key in value:
+                key_check(key)
+            return value
+        return check
+
+    # Lists with unchecked elements
+    if ty is serde.fields.List and type(field.element) is serde.fields.Field:
+        return _check_instance(list)
+
+    return None
+
+
+def _compile_decoder(cls: t.Type[Message]) -> t.Optional[t.Callable[[dict], Message]]:
+    """
+    Compiles a decoder equivalent to `cls.from_dict` that checks each field directly
+    :return: The decoder, or None if any field must go through serde
+    """
+    fields = []
+    for field in cls.__fields__.values():
+        check = _compile_check(field)
+        if check is None:
+            return None
+        fields.append((field._attr_name, field._serde_name, check, type(field) is serde.fields.Optional))
+    fields = tuple(fields)
+
+    def decode(d: dict) -> Message:
+        msg = cls.__new__(cls)
+        for attr_name, serde_name, check, optional in fields:
+            try:
+                value = d[serde_name]
+            except KeyError:
+                if not optional:
+                    raise serde.ValidationError(f"missing data, expected field {serde_name!r}")
+                value = None
+            setattr(msg, attr_name, check(value))
+        return msg
+    return decode
+
+
+def _register_decoders(cls: t.Type[Message]):
+    for variant in cls.__subclasses__():
+        decoder = _compile_decoder(variant)
+        if decoder is not None:
+            decoders[variant.tag_name] = decoder
+        _register_decoders(variant)
+
+
+_register_decoders(Message)
+
+
+def decode_message(raw: t.Union[str, bytes]) -> Message:
+    """
+    Decodes a message, using a compiled decoder for the type if there is one and serde otherwise
+    :param raw: The raw message, JSON from a text frame or MessagePack from a binary frame
+    :raises json.JSONDecodeError: if the message is not valid JSON
+    :raises serde.ValidationError: if the message is not valid or does not match its type
+    """
+    if isinstance(raw, str):
+        d = json.loads(raw)
+    elif msgpack is None:
+        raise serde.ValidationError("binary messages are not supported")
+    else:
+        try:
+            d = msgpack.unpackb(raw)
+        except (ValueError, msgpack.UnpackException) as e:
+            raise serde.ValidationError(f"invalid MessagePack: {e}")
+    if not isinstance(d, dict):
+        raise serde.ValidationError("invalid type, expected 'dict'", value=d)
+    decoder = decoders.get(d.get("type"))
+    if decoder is None:
+        return Message.from_dict(d)
+    return decoder(d)
+
+
+# Extension methods
+
+async def send_frames(self: websockets.WebSocketCommonProtocol, frames: t.Iterable[bytes]):
+    """
+    Sends pre-encoded messages, writing them all before waiting for the socket to drain once
+    :param frames: Messages encoded with the socket's encoding, as returned by `Message.encode`
+    """
+    await self.ensure_open()
+    opcode = websockets.frames.OP_BINARY if self.encoding.binary else websockets.frames.OP_TEXT
+    # Write directly, `send` would re-encode each frame and drain after each one
+    for frame in frames:
+        self.write_frame_sync(True, opcode, frame)
+    await self.drain()
 
-# Extension method
 
 def send_msg(self: websockets.WebSocketCommonProtocol, msg: Message):
-    return self.send(msg.to_json())
+    return self.send_frames((msg.encode(self.encoding),))
 
 
+# Negotiated during authentication
+websockets.WebSocketCommonProtocol.encoding = Encoding.JSON
+websockets.WebSocketCommonProtocol.send_frames = send_frames
 websockets.WebSocketCommonProtocol.send_msg = send_msg
-del send_msg
+del send_frames, send_msg
 
 __all__ = [
     "Role",
+    "Encoding",
     "Command",
     "MoveDistanceCommand",
     "MoveContinuousCommand",
+    "Trace",
+    "LatencyHistogram",
     "Message",
     "EStopMessage",
     "LogMessage",
@@ -217,9 +564,17 @@ __all__ = [
     "OptionMessage",
     "OptionResponseMessage",
     "SensorDataMessage",
+    "SubscribeMessage",
     "QueryBaseMessage",
     "QueryBaseResponseMessage",
+    "QueryHistoryMessage",
+    "QueryHistoryResponseMessage",
     "PointCameraMessage",
     "ArduinoDebugMessage",
-    "NmeaMessage"
+    "NmeaMessage",
+    "ReplayMessage",
+    "ReplayControlMessage",
+    "ReplayEndedMessage",
+    "CameraFrameMessage",
+    "decode_message"
 ]
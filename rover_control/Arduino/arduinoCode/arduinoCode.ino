@@ -44,12 +44,12 @@ volatile unsigned long panEncLastPulseStart = 0;
 volatile unsigned int panEncLastPulseLength = 0;
 int panAngle;
 
-// Sensors
-BME280 internalBme("internal_bme", true);
-BME280 externalBme("external_bme", false);
-BNO055 bno("imu");
-AnalogCurrent loadCurrent("load_current");
-INA260 panelIna("panel_power");
+// Sensors, with their binary frame types (see SENSOR_SCHEMAS in rover_control/serial_parser.py)
+BME280 internalBme("internal_bme", 0x01, true);
+BME280 externalBme("external_bme", 0x02, false);
+BNO055 bno("imu", 0x03);
+AnalogCurrent loadCurrent("load_current", 0x04);
+INA260 panelIna("panel_power", 0x05);
 
 // Tasks
 Scheduler scheduler;
@@ -70,7 +70,7 @@ Task loadCurrentTask(500, TASK_FOREVER, [](){ loadCurrent.callback(); }, &schedu
 Task panelInaTask(500, TASK_FOREVER, [](){ panelIna.callback(); }, &scheduler );
 
 Task loadCurrentPoll(10, TASK_FOREVER, [](){ loadCurrent.poll(); }, &scheduler);
-Task loadCurrentSend(200, TASK_FOREVER, [](){ loadCurrent.sendData(); }, &scheduler);
+Task loadCurrentSend(200, TASK_FOREVER, [](){ loadCurrent.report(); }, &scheduler);
 
 void setup() {
   Serial.begin(115200);
@@ -0,0 +1,25 @@
+#include "frame.h"
+
+#include <Arduino.h>
+#include <util/crc16.h>
+
+bool binaryMode = false;
+
+void writeFrame(uint8_t type, const void* payload, uint8_t len) {
+  // CRC-16/CCITT-FALSE over length, type and payload
+  uint16_t crc = 0xFFFF;
+  uint8_t header[3] = {FRAME_SYNC, (uint8_t)(len + 1), type};
+  crc = _crc_xmodem_update(crc, header[1]);
+  crc = _crc_xmodem_update(crc, header[2]);
+  const uint8_t* bytes = (const uint8_t*)payload;
+  for (uint8_t i = 0; i < len; i++) {
+    crc = _crc_xmodem_update(crc, bytes[i]);
+  }
+
+  // AVR is little-endian, so structs are written as-is. The CRC is big-endian, so the receiver can check the CRC
+  // over the whole frame is zero.
+  uint8_t trailer[2] = {(uint8_t)(crc >> 8), (uint8_t)crc};
+  Serial.write(header, sizeof(header));
+  Serial.write(bytes, len);
+  Serial.write(trailer, sizeof(trailer));
+}
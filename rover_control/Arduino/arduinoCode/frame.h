@@ -0,0 +1,12 @@
+#pragma once
+#include <stdint.h>
+#include <stddef.h>
+
+// Binary frames: sync | length (type + payload) | type | payload | CRC-16 (big-endian)
+// Keep in sync with rover_control/serial_parser.py
+#define FRAME_SYNC 0xA5
+
+// Whether sensor data is sent as binary frames instead of text lines, set by the 'b' command
+extern bool binaryMode;
+
+void writeFrame(uint8_t type, const void* payload, uint8_t len);
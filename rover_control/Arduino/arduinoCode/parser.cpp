@@ -1,4 +1,5 @@
 #include "parser.h"
+#include "frame.h"
 
 #include <Arduino.h>
 #include <stdint.h>
@@ -80,6 +81,11 @@ void execute_command() {
       // TODO
       break;
     }
+    case 'b': { // Serial mode: b1 sends sensor data as binary frames, b0 as text lines
+      binaryMode = command_buffer[1] == '1';
+      Serial.println(binaryMode ? "mode binary" : "mode text");
+      break;
+    }
     case 'x': // Cancel command
     case '!': // E-stop
     {
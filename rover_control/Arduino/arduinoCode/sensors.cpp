@@ -5,18 +5,29 @@
 #include <Adafruit_INA260.h>
 
 #include "sensors.h"
+#include "frame.h"
 
 // Print to serial with a trailing space
 #define SP(...) { Serial.print(__VA_ARGS__); Serial.print(' '); }
 
-Sensor::Sensor(char* sensorName) {
+Sensor::Sensor(char* sensorName, uint8_t frameType) {
   this->sensorName = sensorName;
+  this->frameType = frameType;
 }
 
 void Sensor::callback() {
   poll();
-  sendData();
-  Serial.print('\n');
+  report();
+}
+
+void Sensor::report() {
+  if (binaryMode) {
+    sendFrame();
+  }
+  else {
+    sendData();
+    Serial.print('\n');
+  }
 }
 
 void Sensor::init() {}
@@ -26,8 +37,8 @@ void Sensor::sendData() {
   SP(sensorName);
 }
 
-BME280::BME280(char* sensorName, bool altAddress):
-Sensor(sensorName) {
+BME280::BME280(char* sensorName, uint8_t frameType, bool altAddress):
+Sensor(sensorName, frameType) {
   this->altAddress = altAddress;
 }
 
@@ -48,8 +59,12 @@ void BME280::sendData() {
   SP(lastData.pressure, 0);
 }
 
-BNO055::BNO055(char* sensorName):
-Sensor(sensorName), bno(55, 0x28) {}
+void BME280::sendFrame() {
+  writeFrame(frameType, &lastData, sizeof(lastData));
+}
+
+BNO055::BNO055(char* sensorName, uint8_t frameType):
+Sensor(sensorName, frameType), bno(55, 0x28) {}
 
 void BNO055::init() {
   bno.begin();
@@ -72,8 +87,12 @@ void BNO055::sendData() {
   SP(lastData.temp);
 }
 
-AnalogCurrent::AnalogCurrent(char* sensorName):
-Sensor(sensorName) {}
+void BNO055::sendFrame() {
+  writeFrame(frameType, &lastData, sizeof(lastData));
+}
+
+AnalogCurrent::AnalogCurrent(char* sensorName, uint8_t frameType):
+Sensor(sensorName, frameType) {}
 
 void AnalogCurrent::poll() {
   current = map(analogRead(A0), 511, 94, 0, 509); 
@@ -84,8 +103,13 @@ void AnalogCurrent::sendData() {
   SP(current);
 }
 
-INA260::INA260(char* sensorName):
-Sensor(sensorName) {}
+void AnalogCurrent::sendFrame() {
+  int16_t data = current;
+  writeFrame(frameType, &data, sizeof(data));
+}
+
+INA260::INA260(char* sensorName, uint8_t frameType):
+Sensor(sensorName, frameType) {}
 
 void INA260::init() {
   ina.begin();
@@ -101,3 +125,8 @@ void INA260::sendData() {
   SP(voltage, 2);
   SP(current, 2);
 }
+
+void INA260::sendFrame() {
+  float data[2] = {voltage, current};
+  writeFrame(frameType, data, sizeof(data));
+}
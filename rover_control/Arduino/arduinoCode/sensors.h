@@ -6,13 +6,16 @@
 
 class Sensor {
   public:
-    Sensor(char* sensorName);
+    Sensor(char* sensorName, uint8_t frameType);
     void init();
     void callback();
+    void report(); // Sends the last data as a binary frame or text line, per the serial mode
 
   protected:
     char* sensorName;
+    uint8_t frameType;
     virtual void sendData();
+    virtual void sendFrame() = 0;
     
   private:
     virtual void poll() = 0;
@@ -26,7 +29,7 @@ class BME280: public Sensor {
       float pressure; // Pascals
     } lastData;
 
-    BME280(char* sensorName, bool altAddress = false);
+    BME280(char* sensorName, uint8_t frameType, bool altAddress = false);
     void init();
 
   private:
@@ -35,6 +38,7 @@ class BME280: public Sensor {
 
     void poll();
     void sendData();
+    void sendFrame();
 };
 
 class BNO055: public Sensor {
@@ -46,7 +50,7 @@ class BNO055: public Sensor {
       int8_t temp;
     } lastData;
   
-    BNO055(char* sensorName);
+    BNO055(char* sensorName, uint8_t frameType);
     void init();
 
   private:
@@ -55,15 +59,17 @@ class BNO055: public Sensor {
 
     void poll();
     void sendData();
+    void sendFrame();
 };
 
 class AnalogCurrent: public Sensor {
   public:
     int current; // in deciamps
 
-    AnalogCurrent(char* sensorName);
+    AnalogCurrent(char* sensorName, uint8_t frameType);
     void poll();
     void sendData();
+    void sendFrame();
 };
 
 class INA260: public Sensor {
@@ -71,7 +77,7 @@ class INA260: public Sensor {
     float voltage; // Volts
     float current; // Amps
     
-    INA260(char* sensorName);
+    INA260(char* sensorName, uint8_t frameType);
     void init();
 
   private:
@@ -79,4 +85,5 @@ class INA260: public Sensor {
   
     void poll();
     void sendData();
+    void sendFrame();
 };
@@ -7,16 +7,19 @@ import subprocess
 import time
 import typing as t
 import traceback
-import re
 
 import serde.exceptions
 import websockets
 import psutil
 import serial
 import serial_asyncio
-import pynmea2
 # import RPi.GPIO as GPIO
 from common import *
+from rover_control.telemetry import TelemetryAggregator
+from rover_control.spool import TelemetrySpool
+from rover_control.serial_parser import read_message, SensorRecord, LogRecord
+from rover_control.serial_queue import SerialQueue, SerialPriority
+from rover_control.nmea import NmeaStage
 
 # IR_PIN = 17
 
@@ -30,10 +33,20 @@ class Sandshark:
     def __init__(self):
         self.sck: t.Optional[websockets.WebSocketClientProtocol] = None
         self.current_command: t.Optional[Command] = None
+        # Trace of the current command and when it was received, in monotonic ns
+        self.command_trace: t.Optional[Trace] = None
+        self.command_received: int = 0
         self.user: t.Optional[str] = None
         self.serial_connected: bool = False
         self.serial_reader: t.Optional[asyncio.StreamReader] = None
         self.serial_writer: t.Optional[asyncio.StreamWriter] = None
+        # Everything written to the Arduino goes through this queue, so e-stops aren't stuck behind other writes
+        self.serial_queue = SerialQueue()
+        self.serial_sender_task: t.Optional[asyncio.Task] = None
+        # Whether the Arduino acknowledged sending sensor data as binary frames
+        self.serial_binary: bool = False
+        # Mode requests left before assuming the firmware only speaks text
+        self.serial_mode_attempts: int = 0
         self.stream_subprocess = None
 
         self.camera_yaw = 0
@@ -41,14 +54,29 @@ class Sandshark:
 
         self.lastHeartbeat = time.time_ns()
 
+        # Sensor readings are coalesced and delta-compressed before being sent
+        self.telemetry = TelemetryAggregator(self.send_telemetry)
+        # GPS sentences are validated and filtered, and GGA and RMC fused into fixes, before being sent
+        self.nmea = NmeaStage()
+
         self.options = {
             "camera.source": None,
             "camera.resolution": (256, 144),
             "camera.framerate": 10,
+            "camera.adaptive": True,
+            "telemetry.deadbands": self.telemetry.deadbands,
+            "serial.binary": True,
+            "gps.sentences": sorted(self.nmea.sentences),
+            "gps.raw_rate": self.nmea.raw_rate,
+            "gps.fix_rate": self.nmea.fix_rate,
         }
 
         self.module_path = pathlib.Path(os.path.dirname(__file__))
 
+        # Telemetry produced while disconnected is kept here and replayed after reconnecting
+        self.spool = TelemetrySpool(self.module_path / "spool")
+        self.replay_task: t.Optional[asyncio.Task] = None
+
         # GPIO.setmode(GPIO.BOARD)
         # GPIO.setup(IR_PIN, GPIO.OUT)
 
@@ -57,24 +85,64 @@ class Sandshark:
         if self.sck and self.sck.open:
             await self.sck.send_msg(LogMessage(message=msg, level=level))
 
+    def serial_send(self, line: bytes, priority: SerialPriority, key: t.Optional[t.Hashable] = None,
+                    on_written: t.Optional[t.Callable[[], None]] = None) -> bool:
+        """
+        Queues a line to be written to the Arduino
+        :param line: The line, including its newline
+        :param priority: The line's priority
+        :param key: Identifies lines that supersede each other, see `SerialQueue.put`
+        :param on_written: Called once the line has been written
+        :return: False if the Arduino is not connected or nothing is writing to it
+        """
+        if not self.serial_connected or self.serial_sender_task is None or self.serial_sender_task.done():
+            return False
+        self.serial_queue.put(line, priority, key, on_written)
+        return True
+
+    async def send_telemetry(self, messages: t.List[Message]) -> bool:
+        """
+        Sends a batch of telemetry messages to the base station, or spools them to disk if not connected
+        :return: False if the messages could be neither sent nor spooled
+        """
+        if self.sck and self.sck.open:
+            try:
+                await self.sck.send_frames([msg.encode(self.sck.encoding) for msg in messages])
+                return True
+            except websockets.ConnectionClosed:
+                pass
+        try:
+            await self.spool.append(messages)
+        except OSError as e:
+            print(f"Unable to spool telemetry: {e!r}")
+            return False
+        return True
+
+    async def replay_spool(self):
+        """Sends telemetry spooled while disconnected"""
+        print("Replaying spooled telemetry")
+        await self.spool.replay(
+            lambda messages: self.sck.send_frames([msg.encode(self.sck.encoding) for msg in messages])
+        )
+        print(f"Replayed {self.spool.replayed} spooled messages")
+
     async def report_pi_sensors_task(self):
         while True:
-            if self.sck and self.sck.open:
-                # Get various pi stat values
-                ram = psutil.virtual_memory()
-                disk = psutil.disk_usage("/")
-                this_proc = psutil.Process(os.getpid())
-                meas = {
-                    "cpu_percent": psutil.cpu_percent(),
-                    "ram_percent": ram.percent,
-                    "ram_free": ram.available,
-                    "disk_percent": disk.percent,
-                    "disk_free": disk.free,
-                    "ctl_ram_used": this_proc.memory_full_info().uss
-                }
-                if hasattr(psutil, "sensors_temperatures"):
-                    meas["cpu_temp"] = psutil.sensors_temperatures()["cpu_thermal"][0].current
-                await self.sck.send_msg(SensorDataMessage(time=time.time_ns(), sensor="pi", measurements=meas))
+            # Get various pi stat values
+            ram = psutil.virtual_memory()
+            disk = psutil.disk_usage("/")
+            this_proc = psutil.Process(os.getpid())
+            meas = {
+                "cpu_percent": psutil.cpu_percent(),
+                "ram_percent": ram.percent,
+                "ram_free": ram.available,
+                "disk_percent": disk.percent,
+                "disk_free": disk.free,
+                "ctl_ram_used": this_proc.memory_full_info().uss
+            }
+            if hasattr(psutil, "sensors_temperatures"):
+                meas["cpu_temp"] = psutil.sensors_temperatures()["cpu_thermal"][0].current
+            self.telemetry.add("pi", meas)
             await asyncio.sleep(5)
 
     async def main(self):
@@ -82,6 +150,7 @@ class Sandshark:
 
         # Start sensor tasks
         asyncio.create_task(self.report_pi_sensors_task())
+        asyncio.create_task(self.telemetry.run())
 
         # Start serial listener
         asyncio.create_task(self.serial_main())
@@ -89,7 +158,8 @@ class Sandshark:
         # Start GPS listener
         asyncio.create_task(self.gps_main())
 
-        # Start serial heartbeat
+        # Start serial writer and heartbeat
+        self.serial_sender_task = asyncio.create_task(self.serial_sender())
         asyncio.create_task(self.serial_heartbeat())
 
         with open(self.module_path / "secrets.json") as secrets_file:
@@ -98,22 +168,28 @@ class Sandshark:
         async for self.sck in websockets.connect("wss://rover.team1157.org:11571/rover", ping_interval=5, ping_timeout=10):
         # async for self.sck in websockets.connect("ws://127.0.0.1:11571/rover", ping_interval=5, ping_timeout=10):
             # Authenticate
-            await self.sck.send_msg(AuthMessage(token=token))
+            await self.sck.send_msg(AuthMessage(token=token, encodings=[e.value for e in Encoding.supported()]))
             try:
                 auth_response = AuthResponseMessage.from_json(await self.sck.recv())
                 self.user = auth_response.user
-            except (serde.ValidationError, json.JSONDecodeError):
+                self.sck.encoding = Encoding(auth_response.encoding or "json")
+                # The base station may have missed deltas while disconnected
+                self.telemetry.reset()
+            except (serde.ValidationError, json.JSONDecodeError, ValueError):
                 await self.log("Received invalid auth response", "error")
                 await self.sck.close(1002, "Invalid auth response")
                 continue
 
+            if self.spool and (self.replay_task is None or self.replay_task.done()):
+                self.replay_task = asyncio.create_task(self.replay_spool())
+
             try:
                 print("Connected to base station")
                 while True:
                     try:
                         async for msg_raw in self.sck:
                             try:
-                                msg = Message.from_json(msg_raw)
+                                msg = decode_message(msg_raw)
                             except (serde.ValidationError, json.JSONDecodeError):
                                 await self.log("Received invalid message", "error")
                                 continue
@@ -133,10 +209,9 @@ class Sandshark:
                 print("Disconnected from base station, reconnecting in 5 seconds...")
                 # Cancel command if running
                 if self.current_command is not None:
-                    if self.serial_connected:
+                    if self.serial_send(b"x\n", SerialPriority.ESTOP):
                         print("Cancelling command")
-                        self.serial_writer.write(b"x\n")
-                        await self.serial_writer.drain()
+                        self.serial_queue.clear(SerialPriority.COMMAND, SerialPriority.CAMERA)
                     else:
                         print("Unable to cancel command, serial disconnected")
                 await asyncio.sleep(5)
@@ -150,37 +225,72 @@ class Sandshark:
                     baudrate=115200
                 )
                 self.serial_connected = True
+                self.serial_binary = False
+                self.serial_mode_attempts = 5
+                self.request_serial_mode()
 
                 while True:
                     try:
-                        msg = (await self.serial_reader.readline()).decode()
-                        msg_type = msg.strip().split(" ")[0]
+                        msg_type, record = await read_message(self.serial_reader)
 
                         # Delegate to message handler
-                        await arduino_handlers.get(msg_type, arduino_default)(self, msg)
+                        await arduino_handlers.get(msg_type, arduino_default)(self, record)
 
                     except Exception as e:
-                        # Re-raise SerialException
-                        if isinstance(e, serial.SerialException):
+                        # Re-raise SerialException, and the port closing mid-message
+                        if isinstance(e, (serial.SerialException, asyncio.IncompleteReadError)):
                             raise e
 
                         print(f"Uncaught exception in serial_main(): {e!r}: {traceback.format_exc()}")
                         await self.log(f"Rover error in serial_main(): {e!r}: {traceback.format_exc()}", "error")
-            except serial.SerialException:
+            except (serial.SerialException, asyncio.IncompleteReadError):
                 self.serial_connected = False
+                # Don't replay stale commands to the Arduino after it reconnects
+                self.serial_queue.clear(*SerialPriority)
                 print("Disconnected from arduino, reconnecting in 5 seconds...")
                 await self.log(f"Disconnected from arduino with error: {traceback.format_exc()}", "error")
                 await asyncio.sleep(5)
                 continue
 
+    def request_serial_mode(self):
+        """
+        Asks the Arduino to send sensor data as binary frames or text lines, per the serial.binary option. The Arduino
+        replies with a mode line; firmware without binary support rejects the command and keeps sending text.
+        """
+        if self.serial_send(b"b1\n" if self.options["serial.binary"] else b"b0\n", SerialPriority.COMMAND, "mode"):
+            self.serial_mode_attempts -= 1
+
+    async def serial_sender(self):
+        """Writes queued lines to the Arduino, highest priority first, in paced batches"""
+        while True:
+            batch, callbacks = await self.serial_queue.get_batch()
+            if not self.serial_connected:
+                continue
+            try:
+                self.serial_writer.write(batch)
+                await self.serial_writer.drain()
+                for callback in callbacks:
+                    callback()
+            except serial.SerialException:
+                # serial_main() notices the disconnect and reconnects
+                continue
+            except Exception as e:
+                # This is the only task writing to the Arduino, so drop the batch and keep going
+                print(f"Uncaught exception in serial_sender(): {e!r}: {traceback.format_exc()}")
+                try:
+                    await self.log(f"Rover error in serial_sender(): {e!r}: {traceback.format_exc()}", "error")
+                except websockets.ConnectionClosed:
+                    pass
+
     async def serial_heartbeat(self):
         await asyncio.sleep(5)
         self.lastHeartbeat = time.time_ns()
 
         while True:
-            if self.serial_connected:
-                self.serial_writer.write(b"h\n")
-                await self.serial_writer.drain()
+            if self.serial_send(b"h\n", SerialPriority.HEARTBEAT, "hb"):
+                # The mode request may have been lost while the Arduino was resetting after the port opened
+                if self.serial_binary != self.options["serial.binary"] and self.serial_mode_attempts > 0:
+                    self.request_serial_mode()
             if time.time_ns() - self.lastHeartbeat > 5e9:
                 await self.log("Arduino is not replying to heartbeats", "warning")
             await asyncio.sleep(0.5)
@@ -206,31 +316,26 @@ class Sandshark:
                 )
                 while True:
                     try:
-                        sentence_raw = (await gps_reader.readline()).decode()
+                        line = await gps_reader.readline()
                         # Ignore whitespace-only lines
-                        if not sentence_raw.strip():
+                        if not line.strip():
                             continue
 
                         ts = time.time_ns()  # system timestamp
-                        if self.sck and self.sck.open:
-                            # Send raw sentence on an NMEA packet
-                            await self.sck.send_msg(NmeaMessage(time=ts, sentence=sentence_raw))
-                            # Decode sentence and log as sensor
-                            # Only log the values in GGA sentences to avoid duplication by RMC sentences
-                            sentence = pynmea2.parse(sentence_raw)
-                            if sentence.sentence_type == "GGA" and sentence.is_valid:  # don't report before fix
-                                await self.sck.send_msg(SensorDataMessage(
-                                    time=ts,
-                                    sensor="gps",
-                                    measurements={
-                                        "time": sentence.timestamp.isoformat(),
-                                        "lat": sentence.latitude,
-                                        "lon": sentence.longitude,
-                                        "alt": sentence.altitude,
-                                        "hdop": sentence.horizontal_dil,
-                                        "num_sats": int(sentence.num_sats)
-                                    }
-                                ))
+                        invalid = self.nmea.invalid
+                        sentence, fix = self.nmea.feed(line, ts)
+                        if self.nmea.invalid > invalid and self.nmea.invalid % 100 == 1:
+                            await self.log(f"Skipped {self.nmea.invalid} invalid GPS sentences so far", "warning")
+                        messages = []
+                        # Raw sentences of the allowed types on NMEA packets
+                        if sentence is not None:
+                            messages.append(NmeaMessage(time=ts, sentence=sentence))
+                        # Fused GGA and RMC fix as a sensor
+                        if fix is not None:
+                            fix_time, measurements = fix
+                            messages.append(SensorDataMessage(time=fix_time, sensor="gps", measurements=measurements))
+                        if messages:
+                            await self.send_telemetry(messages)
 
                     except Exception as e:
                         # Re-raise SerialException
@@ -246,12 +351,33 @@ class Sandshark:
                 await asyncio.sleep(5)
                 continue
 
-    def start_stream(self, device: str, width: int, height: int, framerate: int):
+    def start_stream(self, device: str, width: int, height: int, framerate: int, adaptive: bool):
         if self.stream_subprocess is not None:
             self.stop_stream()
 
         script_path = self.module_path.parent / "camera-streamer" / "target" / "debug" / "camera-streamer"
-        self.stream_subprocess = subprocess.Popen([script_path, device, "--resolution", str(width), str(height), "--framerate", str(framerate)])
+        args = [script_path, device, "--output-resolution", str(width), str(height), "--framerate", str(framerate),
+                "--reencode"]
+        if adaptive:
+            # Let the camera relay step skip, quality and scale down when viewers or the uplink can't keep up
+            args.append("--adaptive")
+        # Settings that don't need a restart are sent as control lines on stdin
+        self.stream_subprocess = subprocess.Popen(args, stdin=subprocess.PIPE)
+
+    def control_stream(self, line: str) -> bool:
+        """
+        Changes a setting of the running streamer without restarting it
+        :param line: The control line, e.g. "resolution 320 240"
+        :return: Whether the streamer is running and got the line
+        """
+        if self.stream_subprocess is None or self.stream_subprocess.poll() is not None:
+            return False
+        try:
+            self.stream_subprocess.stdin.write(line.encode() + b"\n")
+            self.stream_subprocess.stdin.flush()
+        except BrokenPipeError:
+            return False
+        return True
 
     def stop_stream(self):
         self.stream_subprocess.terminate()
@@ -269,21 +395,30 @@ def message_handler(message_type: t.Type):
 
 @message_handler(CommandMessage)
 async def handle_command(self: Sandshark, msg: CommandMessage):
+    received = time.monotonic_ns()
     if self.current_command is not None:
-        if self.serial_connected:
-            self.serial_writer.write(b"x\n")
-            await self.serial_writer.drain()
+        if self.serial_send(b"x\n", SerialPriority.COMMAND):
             if self.sck and self.sck.open:
-                await self.sck.send_msg(CommandEndedMessage(command=self.current_command, completed=False))
+                await self.sck.send_msg(CommandEndedMessage(
+                    command=self.current_command, completed=False, trace=self.command_trace
+                ))
         else:
             await self.log("Could not cancel current command because Arduino is not connected", "error")
     self.current_command = msg.command
+    self.command_trace = trace = msg.trace
+    self.command_received = received
     if msg.command is not None:
-        if self.serial_connected:
-            self.serial_writer.write(self.current_command.to_arduino())
-            await self.serial_writer.drain()
+        queued = time.monotonic_ns()
+
+        def written():
+            trace.hops["rover.serial_write"] = time.monotonic_ns() - queued
+
+        if self.serial_send(self.current_command.to_arduino() + b"\n", SerialPriority.COMMAND,
+                            on_written=written if trace is not None else None):
+            if trace is not None:
+                trace.hops["rover.handle"] = queued - received
             if self.sck and self.sck.open:
-                await self.sck.send_msg(CommandStatusMessage(command=self.current_command))
+                await self.sck.send_msg(CommandStatusMessage(command=self.current_command, trace=trace))
         else:
             await self.log("Could not set command because Arduino is not connected", "error")
 
@@ -326,12 +461,65 @@ async def handle_option(self: Sandshark, msg: OptionMessage):
 
         self.options["camera.framerate"] = framerate_raw
 
-    if any([self.options[k] != old_options[k] for k in self.options.keys()]):
+    if "camera.adaptive" in msg.set.keys():
+        adaptive_raw = msg.set["camera.adaptive"]
+        if type(adaptive_raw) is not bool:
+            await self.log("Option camera.adaptive must be a boolean", "error")
+            return
+
+        self.options["camera.adaptive"] = adaptive_raw
+
+    if "telemetry.deadbands" in msg.set.keys():
+        deadbands_raw = msg.set["telemetry.deadbands"]
+        if type(deadbands_raw) is not dict or not all(
+                type(sensor_deadbands) is dict and all(type(v) in (int, float) for v in sensor_deadbands.values())
+                for sensor_deadbands in deadbands_raw.values()):
+            await self.log("Option telemetry.deadbands must map sensors to objects of numbers", "error")
+            return
+
+        for sensor, sensor_deadbands in deadbands_raw.items():
+            self.telemetry.set_deadbands(sensor, sensor_deadbands)
+
+    if "serial.binary" in msg.set.keys():
+        binary_raw = msg.set["serial.binary"]
+        if type(binary_raw) is not bool:
+            await self.log("Option serial.binary must be a boolean", "error")
+            return
+
+        self.options["serial.binary"] = binary_raw
+        if binary_raw != old_options["serial.binary"]:
+            self.serial_mode_attempts = 5
+            self.request_serial_mode()
+
+    if "gps.sentences" in msg.set.keys():
+        sentences_raw = msg.set["gps.sentences"]
+        if type(sentences_raw) is not list or not all(type(s) is str for s in sentences_raw):
+            await self.log("Option gps.sentences must be an array of sentence types", "error")
+            return
+
+        self.nmea.sentences = {s.upper() for s in sentences_raw}
+        self.options["gps.sentences"] = sorted(self.nmea.sentences)
+
+    for option in ("gps.raw_rate", "gps.fix_rate"):
+        if option in msg.set.keys():
+            rate_raw = msg.set[option]
+            if type(rate_raw) not in (int, float) or rate_raw < 0:
+                await self.log(f"Option {option} must be a non-negative number", "error")
+                return
+
+            self.options[option] = rate_raw
+            setattr(self.nmea, option.partition(".")[2], rate_raw)
+
+    # Resolution changes are applied by the running streamer, other camera options need it restarted
+    changed = {k for k in self.options.keys() if k.startswith("camera.") and self.options[k] != old_options[k]}
+    width, height = self.options["camera.resolution"]
+    if changed and not (changed == {"camera.resolution"} and self.control_stream(f"resolution {width} {height}")):
         self.start_stream(
             self.options["camera.source"].value if self.options["camera.source"] is not None else None,
-            self.options["camera.resolution"][0],
-            self.options["camera.resolution"][1],
-            self.options["camera.framerate"]
+            width,
+            height,
+            self.options["camera.framerate"],
+            self.options["camera.adaptive"]
         )
 
     # Get values
@@ -343,17 +531,19 @@ async def handle_option(self: Sandshark, msg: OptionMessage):
 
 @message_handler(EStopMessage)
 async def handle_estop(self: Sandshark, _msg: EStopMessage):
-    # Forward E-stop
-    if self.serial_connected:
-        self.serial_writer.write(b"!\n")
-        await self.serial_writer.drain()
+    # Forward E-stop, dropping commands and camera moves not yet written
+    if self.serial_send(b"!\n", SerialPriority.ESTOP):
+        self.serial_queue.clear(SerialPriority.COMMAND, SerialPriority.CAMERA)
     else:
         await self.log("Could not handle E-stop because Arduino is not connected", "error")
 
     if self.current_command is not None:
         if self.sck and self.sck.open:
-            await self.sck.send_msg(CommandEndedMessage(command=self.current_command, completed=False))
+            await self.sck.send_msg(CommandEndedMessage(
+                command=self.current_command, completed=False, trace=self.command_trace
+            ))
         self.current_command = None
+        self.command_trace = None
 
 
 @message_handler(PointCameraMessage)
@@ -368,20 +558,15 @@ async def handle_point_camera(self: Sandshark, msg: PointCameraMessage):
     self.camera_yaw %= 360
     self.camera_pitch = min(max(self.camera_pitch, 0), 100)
 
-    if self.serial_connected:
-        self.serial_writer.write(f"p{self.camera_yaw} {self.camera_pitch}".encode())
-        await self.serial_writer.drain()
-    else:
+    # Only the latest target of a burst of moves is sent
+    if not self.serial_send(f"p{self.camera_yaw} {self.camera_pitch}\n".encode(), SerialPriority.CAMERA, "camera"):
         await self.log("Unable to point camera because Arduino disconnected", "error")
 
 
 @message_handler(ArduinoDebugMessage)
 async def handle_arduino_debug(self: Sandshark, msg: ArduinoDebugMessage):
     # Send to arduino as raw
-    if self.serial_connected:
-        self.serial_writer.write(msg.message.encode() + b"\n")
-        await self.serial_writer.drain()
-    else:
+    if not self.serial_send(msg.message.encode() + b"\n", SerialPriority.COMMAND):
         await self.log("Unable to send debug because Arduino disconnected", "error")
 
 
@@ -394,96 +579,56 @@ arduino_handlers = {}
 
 
 def arduino_handler(message_type: str):
-    def decorate(fn: t.Callable[[Sandshark, str], t.Coroutine]):
+    def decorate(fn: t.Callable[[Sandshark, t.Any], t.Coroutine]):
         arduino_handlers[message_type] = fn
     return decorate
 
 
 @arduino_handler("hb")
-async def arduino_heartbeat(self: Sandshark, _msg: str):
+async def arduino_heartbeat(self: Sandshark, _record: None):
     self.lastHeartbeat = time.time_ns()
 
 
 @arduino_handler("echo")
-async def arduino_echo(self: Sandshark, msg: str):
+async def arduino_echo(self: Sandshark, text: str):
     # Log echo
-    m = re.match(r"^echo (.*)$", msg)
-    await self.log(f"Received echo from Arduino: {m[1]}", "info")
+    await self.log(f"Received echo from Arduino: {text}", "info")
 
 
 @arduino_handler("log")
-async def arduino_log(self: Sandshark, msg: str):
+async def arduino_log(self: Sandshark, record: LogRecord):
     # Echo log to network
-    m = re.match(r"^log (\w+) (.*)$", msg)
-    await self.log(f"Arduino: {m[2]}", m[1])
+    await self.log(f"Arduino: {record.message}", record.level)
 
 
 @arduino_handler("completed")
-async def arduino_completed(self: Sandshark, _msg: str):
+async def arduino_completed(self: Sandshark, _record: None):
     # Alert network of command completion
-    if self.sck and self.sck.open:
-        self.sck.send_msg(CommandEndedMessage(command=self.current_command, completed=True))
+    if self.command_trace is not None:
+        self.command_trace.hops["rover.completed"] = time.monotonic_ns() - self.command_received
+    if self.sck and self.sck.open and self.current_command is not None:
+        await self.sck.send_msg(CommandEndedMessage(
+            command=self.current_command, completed=True, trace=self.command_trace
+        ))
     self.current_command = None
+    self.command_trace = None
 
 
-def float_or_none(x: str) -> t.Optional[float]:
-    try:
-        return float(x)
-    except ValueError:
-        return None
-
-
-def int_or_none(x: str) -> t.Optional[int]:
-    try:
-        return int(x)
-    except ValueError:
-        return None
+@arduino_handler("mode")
+async def arduino_mode(self: Sandshark, mode: str):
+    self.serial_binary = mode == "binary"
+    await self.log(f"Arduino is sending sensor data as {mode}", "info")
 
 
 @arduino_handler("data")
-async def arduino_data(self: Sandshark, msg: str):
-    if self.sck and self.sck.open:
-        time_ = time.time_ns()
-        m = re.match(r"^data (\w+) (.*)$", msg)
-        raw_meas = m[2].strip().split(" ")
-        if m[1] in ("internal_bme", "external_bme"):
-            meas = {
-                "temp": float_or_none(raw_meas[0]),
-                "humidity": float_or_none(raw_meas[1]),
-                "pressure": int_or_none(raw_meas[2])
-            }
-
-        elif m[1] == "imu":
-            meas = {
-                "roll": float_or_none(raw_meas[0]),
-                "pitch": float_or_none(raw_meas[1]),
-                "yaw": float_or_none(raw_meas[2]),
-                "temp": int_or_none(raw_meas[3])
-            }
-
-        elif m[1] == "load_current":
-            int_current = int_or_none(raw_meas[0])
-            meas = {
-                "current":  None if int_current is None else int_current / 10  # deciamps to amps
-            }
-
-        elif m[1] == "panel_power":
-            meas = {
-                "voltage": float_or_none(raw_meas[0]),
-                "current": float_or_none(raw_meas[1])
-            }
+async def arduino_data(self: Sandshark, record: SensorRecord):
+    if record.measurements is None:
+        await self.log(f"Received unknown sensor data from Arduino: {record.sensor}", "error")
+        return
 
-        else:
-            await self.log(f"Received unknown sensor data from Arduino: {m[1]}", "error")
-            return
-
-        await self.sck.send_msg(SensorDataMessage(
-            time=time_,
-            sensor=m[1],
-            measurements=meas
-        ))
+    self.telemetry.add(record.sensor, record.measurements, time.time_ns())
 
 
-async def arduino_default(self: Sandshark, msg: str):
+async def arduino_default(self: Sandshark, line: str):
     if self.sck and self.sck.open:
-        await self.sck.send_msg(LogMessage(message=f"Received unexpected message from Arduino: {msg}", level="error"))
+        await self.sck.send_msg(LogMessage(message=f"Received unexpected message from Arduino: {line}", level="error"))
@@ -0,0 +1,190 @@
+"""
+Streaming stage for NMEA sentences from the GPS: validates each sentence's checksum on the raw bytes, forwards only
+allowed sentence types at a limited rate, and fuses GGA and RMC sentences of the same epoch into one position fix.
+"""
+import functools
+import operator
+import typing as t
+
+
+class NmeaSentence(t.NamedTuple):
+    kind: str  # sentence type without the talker, e.g. "GGA"
+    fields: t.List[bytes]  # comma-separated fields after the address field
+
+
+def checksum(body: bytes) -> int:
+    """XOR of every byte between the $ and the *"""
+    return functools.reduce(operator.xor, body, 0)
+
+
+def parse_sentence(line: bytes) -> t.Optional[NmeaSentence]:
+    """
+    Validates and splits a raw sentence
+    :param line: The sentence, e.g. b"$GPGGA,...*47\\r\\n"
+    :return: The sentence, or None if it is malformed or its checksum doesn't match
+    """
+    line = line.strip()
+    if len(line) < 10 or line[0] not in b"$!" or line[-3] != ord("*"):
+        return None
+    body = line[1:-3]
+    try:
+        if checksum(body) != int(line[-2:], 16):
+            return None
+    except ValueError:
+        return None
+    address, *fields = body.split(b",")
+    # Proprietary sentences (e.g. $PQ...) have no talker
+    kind = address[1:] if address.startswith(b"P") else address[2:]
+    return NmeaSentence(kind.decode(errors="replace"), fields)
+
+
+def _float(field: bytes) -> t.Optional[float]:
+    return float(field) if field else None
+
+
+def _coordinate(value: bytes, hemisphere: bytes) -> t.Optional[float]:
+    """Converts (d)ddmm.mmmm and a hemisphere to signed decimal degrees"""
+    if not value:
+        return None
+    point = value.index(b".") if b"." in value else len(value)
+    degrees = int(value[:point - 2]) + float(value[point - 2:]) / 60
+    return -degrees if hemisphere in (b"S", b"W") else degrees
+
+
+def _time(value: bytes) -> str:
+    """Converts hhmmss(.ss) to ISO 8601, as `datetime.time.isoformat` would"""
+    text = value.decode()
+    iso = f"{text[0:2]}:{text[2:4]}:{text[4:6]}"
+    fraction = text[7:].rstrip("0")
+    return f"{iso}.{fraction.ljust(6, '0')}" if fraction else iso
+
+
+class NmeaStage:
+    """
+    Turns the GPS's sentences into raw sentences to forward and fused position fixes. Sentences are grouped into epochs
+    by their UTC time field; an epoch's fix needs a GGA sentence with a fix, and an RMC sentence of the same epoch, in
+    either order, adds the date, speed and course.
+    """
+
+    def __init__(self, sentences: t.Iterable[str] = ("GGA", "RMC"), raw_rate: float = 1, fix_rate: float = 1):
+        """
+        :param sentences: Sentence types forwarded raw, e.g. "GGA"
+        :param raw_rate: Maximum raw sentences of each type forwarded per second, 0 to forward none
+        :param fix_rate: Maximum fixes per second, 0 for none
+        """
+        self.sentences = set(sentences)
+        self.raw_rate = raw_rate
+        self.fix_rate = fix_rate
+
+        # When the next raw sentence of each type, and the next fix, is due in ns
+        self._due: t.Dict[str, float] = {}
+        # The current epoch: its UTC time field, when its first sentence was received, whether its GGA sentence has
+        # arrived, its GGA measurements if that had a fix and it hasn't been reported yet, and its RMC fields
+        self._epoch = b""
+        self._epoch_received = 0
+        self._epoch_gga = False
+        self._gga: t.Optional[t.Dict[str, t.Any]] = None
+        self._rmc: t.Optional[t.List[bytes]] = None
+        # Whether the GPS sends RMC at all, otherwise GGA alone completes an epoch
+        self._rmc_seen = False
+
+        self.invalid = 0
+        self.forwarded = 0
+        self.filtered = 0
+        self.fixes = 0
+
+    def _allowed(self, key: str, rate: float, now: int) -> bool:
+        """
+        Rate limits by a schedule rather than the time since the last one allowed, letting each through up to half a
+        period early so arrival jitter in a stream at exactly the rate doesn't drop every other one
+        """
+        if rate <= 0:
+            return False
+        period = 1e9 / rate
+        due = self._due.get(key)
+        if due is not None and now < due - period / 2:
+            return False
+        self._due[key] = max(due or 0, now) + period
+        return True
+
+    def feed(self, line: bytes, now: int) \
+            -> t.Tuple[t.Optional[str], t.Optional[t.Tuple[int, t.Dict[str, t.Any]]]]:
+        """
+        Processes a line read from the GPS
+        :param line: The raw line
+        :param now: The system time in ns
+        :return: The sentence to forward raw or None, and a new fix to forward or None, as the time its epoch's first
+            sentence was received and its measurements
+        """
+        sentence = parse_sentence(line)
+        if sentence is None:
+            self.invalid += 1
+            return None, None
+
+        raw = None
+        if sentence.kind in self.sentences and self._allowed(sentence.kind, self.raw_rate, now):
+            self.forwarded += 1
+            raw = line.decode(errors="replace")
+        else:
+            self.filtered += 1
+
+        try:
+            fix = self._fuse(sentence, now)
+        except (ValueError, IndexError):
+            # Checksum was fine but the fields aren't, e.g. a receiver quirk
+            self.invalid += 1
+            fix = None
+        if fix is not None:
+            if self._allowed("fix", self.fix_rate, now):
+                self.fixes += 1
+            else:
+                fix = None
+        return raw, fix
+
+    def _complete(self) -> t.Optional[t.Tuple[int, t.Dict[str, t.Any]]]:
+        """Takes the current epoch's fix, if it has one that wasn't reported yet"""
+        if self._gga is None:
+            return None
+        fix = self._gga
+        self._gga = None
+        rmc = self._rmc
+        if rmc is not None and rmc[1] == b"A":
+            fix["date"] = f"20{rmc[8][4:6].decode()}-{rmc[8][2:4].decode()}-{rmc[8][0:2].decode()}"
+            knots = _float(rmc[6])
+            fix["speed"] = None if knots is None else knots * 0.514444  # m/s
+            fix["course"] = _float(rmc[7])
+        return self._epoch_received, fix
+
+    def _fuse(self, sentence: NmeaSentence, now: int) -> t.Optional[t.Tuple[int, t.Dict[str, t.Any]]]:
+        """Collects a GGA or RMC sentence, returning a fix once its epoch is complete or a later one starts"""
+        if sentence.kind not in ("GGA", "RMC"):
+            return None
+        fields = sentence.fields
+
+        previous = None
+        if fields[0] != self._epoch:
+            # The previous epoch won't get any more sentences
+            previous = self._complete()
+            self._epoch = fields[0]
+            self._epoch_received = now
+            self._epoch_gga = False
+            self._rmc = None
+
+        if sentence.kind == "GGA":
+            self._epoch_gga = True
+            if fields[5] not in (b"", b"0"):  # don't report before a fix
+                self._gga = {
+                    "time": _time(fields[0]),
+                    "lat": _coordinate(fields[1], fields[2]),
+                    "lon": _coordinate(fields[3], fields[4]),
+                    "alt": _float(fields[8]),
+                    "hdop": _float(fields[7]),
+                    "num_sats": int(fields[6] or 0),
+                }
+        else:
+            self._rmc_seen = True
+            self._rmc = fields
+
+        if self._epoch_gga and (self._rmc is not None or not self._rmc_seen):
+            return self._complete() or previous
+        return previous
@@ -0,0 +1,178 @@
+"""
+Table-driven parser for the serial protocol spoken by the Arduino.
+
+The Arduino sends text lines, or in binary mode binary frames for sensor data interleaved with text lines for
+everything else. A binary frame is:
+
+    sync (0xA5) | length (u8) | type (u8) | payload (length - 1 bytes) | CRC-16 (u16 BE)
+
+The length counts the type byte and payload. The CRC is CRC-16/CCITT-FALSE over the length, type and payload, sent
+big-endian so that the CRC over the whole frame after the sync byte is zero. Payloads are packed little-endian fields.
+Since the sync byte is not ASCII it can't start a text line.
+"""
+import asyncio
+import binascii
+import struct
+import typing as t
+
+FRAME_SYNC = 0xA5
+
+
+class SensorSchema(t.NamedTuple):
+    frame_type: int
+    frame_format: str  # `struct` format of the binary frame's payload
+    fields: t.Tuple[t.Tuple[str, type, int], ...]  # (measurement, type, divisor) in the order the Arduino sends them
+
+
+# The layout of each sensor's data, in text lines and in binary frames. Keep in sync with sensors.cpp.
+SENSOR_SCHEMAS: t.Dict[bytes, SensorSchema] = {
+    b"internal_bme": SensorSchema(0x01, "<fff", (("temp", float, 1), ("humidity", float, 1), ("pressure", int, 1))),
+    b"external_bme": SensorSchema(0x02, "<fff", (("temp", float, 1), ("humidity", float, 1), ("pressure", int, 1))),
+    b"imu": SensorSchema(0x03, "<fffb", (("roll", float, 1), ("pitch", float, 1), ("yaw", float, 1), ("temp", int, 1))),
+    b"load_current": SensorSchema(0x04, "<h", (("current", int, 10),)),  # deciamps to amps
+    b"panel_power": SensorSchema(0x05, "<ff", (("voltage", float, 1), ("current", float, 1))),
+}
+
+
+class SensorRecord(t.NamedTuple):
+    sensor: str
+    measurements: t.Optional[t.Dict[str, t.Any]]  # None if the sensor has no schema
+
+
+class LogRecord(t.NamedTuple):
+    level: str
+    message: str
+
+
+def _compile_schema(schema: t.Tuple[t.Tuple[str, type, int], ...], offset: int) \
+        -> t.Callable[[t.Sequence[t.Any]], t.Dict[str, t.Any]]:
+    """
+    Compiles a sensor schema into a function converting raw values into measurements. The fast path is a generated
+    dict literal; missing or unconvertible values (e.g. "ovf" or NaN) fall back to converting each value separately and
+    reporting the bad ones as None.
+    :param schema: The sensor's fields
+    :param offset: Index of the first value in the sequence passed to the function
+    """
+    exprs = []
+    for i, (name, ty, divisor) in enumerate(schema, offset):
+        expr = f"{ty.__name__}(fields[{i}])"
+        if divisor != 1:
+            expr += f" / {divisor}"
+        exprs.append(f"{name!r}: {expr}")
+    namespace = {}
+    exec(f"def convert(fields):\n    return {{{', '.join(exprs)}}}", {"float": float, "int": int}, namespace)
+    fast = namespace["convert"]
+
+    def convert_each(fields: t.List[bytes]) -> t.Dict[str, t.Any]:
+        measurements = {}
+        for i, (name, ty, divisor) in enumerate(schema, offset):
+            try:
+                value = ty(fields[i])
+            except (ValueError, OverflowError, IndexError):
+                measurements[name] = None
+                continue
+            measurements[name] = value if divisor == 1 else value / divisor
+        return measurements
+
+    def convert(fields: t.List[bytes]) -> t.Dict[str, t.Any]:
+        try:
+            return fast(fields)
+        except (ValueError, OverflowError, IndexError):
+            return convert_each(fields)
+    return convert
+
+
+# Text values start after the "data" and sensor name fields
+_converters = {
+    sensor: (sensor.decode(), _compile_schema(schema.fields, 2))
+    for sensor, schema in SENSOR_SCHEMAS.items()
+}
+
+_frame_converters = {
+    schema.frame_type: (sensor.decode(), struct.Struct(schema.frame_format), _compile_schema(schema.fields, 0))
+    for sensor, schema in SENSOR_SCHEMAS.items()
+}
+
+# Builds records without NamedTuple's slower keyword-handling constructor
+_record = tuple.__new__
+
+
+def _parse_data(_line: bytes, fields: t.List[bytes]) -> SensorRecord:
+    if len(fields) < 2:
+        return _record(SensorRecord, ("", None))
+    entry = _converters.get(fields[1])
+    if entry is None:
+        return _record(SensorRecord, (fields[1].decode(errors="replace"), None))
+    name, convert = entry
+    return _record(SensorRecord, (name, convert(fields)))
+
+
+def _parse_log(line: bytes, _fields: t.List[bytes]) -> LogRecord:
+    # Split the raw line again to keep the message's spacing
+    _, level, message = (line.strip().split(None, 2) + [b"", b""])[:3]
+    return LogRecord(level.decode(errors="replace"), message.decode(errors="replace"))
+
+
+def _parse_text(line: bytes, _fields: t.List[bytes]) -> str:
+    return line.strip().partition(b" ")[2].decode(errors="replace")
+
+
+def _parse_none(_line: bytes, _fields: t.List[bytes]) -> None:
+    return None
+
+
+# Line type and parser by the line's first word. Parsers get the raw line and its whitespace-split fields.
+LINE_PARSERS: t.Dict[bytes, t.Tuple[str, t.Callable[[bytes, t.List[bytes]], t.Any]]] = {
+    b"data": ("data", _parse_data),
+    b"log": ("log", _parse_log),
+    b"echo": ("echo", _parse_text),
+    b"hb": ("hb", _parse_none),
+    b"completed": ("completed", _parse_none),
+    b"mode": ("mode", _parse_text),
+}
+
+
+def parse_line(line: bytes) -> t.Tuple[t.Optional[str], t.Any]:
+    """
+    Parses a line received from the Arduino
+    :param line: The raw line, with or without its line ending
+    :return: The line type and its parsed record, or None and the decoded line if the type is unknown
+    """
+    fields = line.split()
+    entry = LINE_PARSERS.get(fields[0]) if fields else None
+    if entry is None:
+        return None, line.decode(errors="replace").strip()
+    kind, parse = entry
+    return kind, parse(line, fields)
+
+
+def parse_frame(frame: memoryview) -> t.Tuple[t.Optional[str], t.Any]:
+    """
+    Parses the type and payload of a binary frame
+    :param frame: The frame's type byte and payload
+    :return: The frame type and its parsed record, or None and a description if the frame is invalid
+    """
+    entry = _frame_converters.get(frame[0])
+    if entry is None:
+        return None, f"Unknown binary frame type {frame[0]:#04x}"
+    name, layout, convert = entry
+    if len(frame) - 1 != layout.size:
+        return None, f"Binary {name} frame has {len(frame) - 1} bytes of payload, expected {layout.size}"
+    return "data", _record(SensorRecord, (name, convert(layout.unpack_from(frame, 1))))
+
+
+async def read_message(reader: asyncio.StreamReader) -> t.Tuple[t.Optional[str], t.Any]:
+    """
+    Reads and parses the next text line or binary frame from the Arduino
+    :return: The message type and its parsed record, as `parse_line` returns
+    """
+    # Every message is at least two bytes, as the Arduino never sends empty lines
+    head = await reader.readexactly(2)
+    if head[0] != FRAME_SYNC:
+        return parse_line(head if head[1] == 0x0A else head + await reader.readline())
+
+    length = head[1]
+    body = await reader.readexactly(length + 2)
+    if length == 0 or binascii.crc_hqx(body, binascii.crc_hqx(head[1:], 0xFFFF)) != 0:
+        return None, "Corrupt binary frame"
+    return parse_frame(memoryview(body)[:length])
@@ -0,0 +1,107 @@
+"""
+Prioritized, coalescing queue of lines written to the Arduino
+"""
+import asyncio
+import enum
+import itertools
+import typing as t
+
+
+class SerialPriority(enum.IntEnum):
+    """Lines of a lower priority are written first"""
+    ESTOP = 0
+    COMMAND = 1
+    CAMERA = 2
+    HEARTBEAT = 3
+
+
+class SerialQueue:
+    """
+    Lines waiting to be written to the Arduino, by priority. A line queued with a key replaces the queued line with the
+    same key, so e.g. a burst of camera moves only sends the latest target.
+    """
+
+    def __init__(self, max_batch: int = 64, interval: float = 0.02):
+        """
+        :param max_batch: Bytes written per flush. The Arduino's receive buffer is 64 bytes and is only read every
+            20 ms, so bigger writes, or writes closer together, can overflow it.
+        :param interval: Minimum seconds between flushes
+        """
+        self.max_batch = max_batch
+        self.interval = interval
+        # Pending lines and their callbacks by priority, each ordered oldest first by key. Lines without a key get a
+        # unique one.
+        self._pending: t.List[t.Dict[t.Hashable, t.Tuple[bytes, t.Optional[t.Callable[[], None]]]]] = \
+            [{} for _ in SerialPriority]
+        self._unique_keys = itertools.count()
+        self._ready = asyncio.Event()
+        # Loop time of the last flush
+        self._last_flush: t.Optional[float] = None
+
+        self.written = 0
+        self.coalesced = 0
+        self.flushes = 0
+
+    def __len__(self) -> int:
+        return sum(len(pending) for pending in self._pending)
+
+    def put(self, line: bytes, priority: SerialPriority, key: t.Optional[t.Hashable] = None,
+            on_written: t.Optional[t.Callable[[], None]] = None):
+        """
+        Queues a line to be written
+        :param line: The line, including its newline
+        :param priority: The line's priority
+        :param key: Identifies lines that supersede each other, None if the line must always be written
+        :param on_written: Called once the line has been written, not if it is superseded or discarded
+        """
+        pending = self._pending[priority]
+        if key is None:
+            key = next(self._unique_keys)
+        elif key in pending:
+            # Move to the end so lines keep the order their latest versions were queued in
+            del pending[key]
+            self.coalesced += 1
+        pending[key] = (line, on_written)
+        self._ready.set()
+
+    def clear(self, *priorities: SerialPriority):
+        """Discards the lines queued at some priorities, e.g. commands made obsolete by an e-stop"""
+        for priority in priorities:
+            self._pending[priority].clear()
+
+    async def get_batch(self) -> t.Tuple[bytes, t.List[t.Callable[[], None]]]:
+        """
+        Waits for lines to be queued and for the Arduino to have read the previous batch, then takes the highest
+        priority ones that fit in a batch
+        :return: The lines to write, and the callbacks to call once they have been written
+        """
+        while not len(self):
+            self._ready.clear()
+            await self._ready.wait()
+        loop = asyncio.get_running_loop()
+        if self._last_flush is not None:
+            # Lines queued meanwhile, e.g. an e-stop, still make it into this batch
+            await asyncio.sleep(self._last_flush + self.interval - loop.time())
+        self._last_flush = loop.time()
+
+        batch = []
+        callbacks = []
+        size = 0
+        for pending in self._pending:
+            while pending:
+                key = next(iter(pending))
+                line, on_written = pending[key]
+                # Always take at least one line, even if it's bigger than a batch
+                if batch and size + len(line) > self.max_batch:
+                    break
+                del pending[key]
+                batch.append(line)
+                if on_written is not None:
+                    callbacks.append(on_written)
+                size += len(line)
+            if pending:
+                break
+
+        self.written += len(batch)
+        self.flushes += 1
+        return b"".join(batch), callbacks
@@ -0,0 +1,128 @@
+"""
+On-disk store-and-forward buffer for telemetry produced while disconnected from the base station
+"""
+import asyncio
+import collections
+import json
+import os
+import pathlib
+import typing as t
+
+import serde
+import websockets
+
+from common import Message, decode_message
+
+
+class TelemetrySpool:
+    """
+    A bounded ring of append-only segment files. Messages are written as JSON lines to the newest segment; when the
+    total exceeds `max_segments` the oldest segment is discarded. File writes run in a worker thread, so the event loop
+    never waits on the disk.
+    """
+
+    def __init__(self, path: t.Union[str, pathlib.Path], segment_size: int = 1 << 20, max_segments: int = 64):
+        """
+        :param path: Directory holding the segment files
+        :param segment_size: Bytes after which a new segment is started
+        :param max_segments: Maximum number of segments kept on disk
+        """
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+
+        # Segments left over from a previous run are replayed too
+        self._segments: t.Deque[pathlib.Path] = collections.deque(sorted(self.path.glob("*.log")))
+        self._next_index = int(self._segments[-1].stem) + 1 if self._segments else 0
+        self._file: t.Optional[t.BinaryIO] = None
+        self._replaying = False
+        # Held while the files or the segment list change, only one worker thread touches them at a time
+        self._lock = asyncio.Lock()
+
+        self.spooled = 0
+        self.replayed = 0
+        self.discarded_segments = 0
+
+    def __bool__(self) -> bool:
+        return bool(self._segments)
+
+    def _rotate(self):
+        if self._file is not None:
+            self._file.close()
+        segment = self.path / f"{self._next_index:08d}.log"
+        self._next_index += 1
+        self._file = open(segment, "ab")
+        self._segments.append(segment)
+        while len(self._segments) > self.max_segments:
+            os.remove(self._segments.popleft())
+            self.discarded_segments += 1
+
+    def _write(self, messages: t.List[Message]):
+        if self._file is None or self._file.tell() >= self.segment_size:
+            self._rotate()
+        self._file.write(b"".join(msg.encode() + b"\n" for msg in messages))
+        self._file.flush()
+        self.spooled += len(messages)
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _read(self, segment: pathlib.Path) -> bytes:
+        # Later appends go to a new segment, so none are deleted along with this one
+        if self._segments[-1] == segment:
+            self._close_file()
+        return segment.read_bytes()
+
+    def _remove(self, segment: pathlib.Path):
+        # The segment may have been discarded while sending
+        if self._segments and self._segments[0] == segment:
+            self._segments.popleft()
+            os.remove(segment)
+
+    async def append(self, messages: t.List[Message]):
+        """
+        Writes messages to the newest segment
+        :raises OSError: If the segment couldn't be written, e.g. because the disk is full
+        """
+        async with self._lock:
+            await asyncio.to_thread(self._write, messages)
+
+    async def replay(self, send: t.Callable[[t.List[Message]], t.Awaitable], rate: float = 200.0, batch: int = 50):
+        """
+        Sends spooled messages oldest first, marked as replayed, deleting each segment once it has been sent. Stops
+        early if the connection closes; an interrupted segment is sent again in full on the next replay.
+        :param send: Sends a batch of messages
+        :param rate: Maximum messages per second, so live traffic isn't starved
+        :param batch: Messages sent per write
+        """
+        if self._replaying:
+            return
+        self._replaying = True
+        try:
+            while self._segments:
+                async with self._lock:
+                    segment = self._segments[0]
+                    lines = (await asyncio.to_thread(self._read, segment)).splitlines()
+                for start in range(0, len(lines), batch):
+                    messages = []
+                    for line in lines[start:start + batch]:
+                        try:
+                            msg = decode_message(line.decode())
+                        except (serde.ValidationError, json.JSONDecodeError, UnicodeDecodeError):
+                            continue  # e.g. a line cut short by a power loss
+                        msg.replayed = True
+                        messages.append(msg)
+                    if not messages:
+                        continue
+                    await send(messages)
+                    self.replayed += len(messages)
+                    await asyncio.sleep(len(messages) / rate)
+                async with self._lock:
+                    await asyncio.to_thread(self._remove, segment)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            self._replaying = False
@@ -0,0 +1,130 @@
+"""
+Coalescing and delta compression of sensor telemetry sent to the base station
+"""
+import asyncio
+import time
+import typing as t
+
+from common import SensorDataMessage
+
+# Smallest change in a measurement worth reporting, by sensor and measurement. Measurements not listed are reported on
+# any change.
+DEFAULT_DEADBANDS: t.Dict[str, t.Dict[str, float]] = {
+    "pi": {
+        "cpu_percent": 2.0,
+        "ram_percent": 1.0,
+        "ram_free": 10e6,
+        "disk_percent": 0.5,
+        "disk_free": 100e6,
+        "ctl_ram_used": 1e6,
+        "cpu_temp": 0.5
+    },
+    "internal_bme": {"temp": 0.1, "humidity": 0.5, "pressure": 20},
+    "external_bme": {"temp": 0.1, "humidity": 0.5, "pressure": 20},
+    "imu": {"roll": 0.5, "pitch": 0.5, "yaw": 0.5, "temp": 1},
+    "load_current": {"current": 0.1},
+    "panel_power": {"voltage": 0.05, "current": 0.05}
+}
+
+
+class TelemetryAggregator:
+    """
+    Collects sensor readings and periodically sends one message per sensor with only the measurements that changed by
+    more than their deadband since they were last sent. Every sensor periodically sends a keyframe with all its latest
+    measurements, so a client that missed deltas catches up.
+    """
+
+    def __init__(self, send: t.Callable[[t.List[SensorDataMessage]], t.Awaitable[bool]], window: float = 0.25,
+                 keyframe_interval: float = 30.0,
+                 deadbands: t.Optional[t.Dict[str, t.Dict[str, float]]] = None):
+        """
+        :param send: Sends a batch of messages, returning False if they couldn't be sent
+        :param window: Seconds over which readings of a sensor are coalesced into one message
+        :param keyframe_interval: Seconds between keyframes of each sensor
+        :param deadbands: Deadbands by sensor and measurement, defaults to `DEFAULT_DEADBANDS`
+        """
+        self.send = send
+        self.window = window
+        self.keyframe_interval = keyframe_interval
+        self.deadbands = {sensor: dict(d) for sensor, d in (deadbands or DEFAULT_DEADBANDS).items()}
+
+        # Time of the newest reading per sensor not yet flushed
+        self._pending: t.Dict[str, int] = {}
+        # Latest value of every measurement, and the last value sent
+        self._latest: t.Dict[str, t.Dict[str, t.Any]] = {}
+        self._sent: t.Dict[str, t.Dict[str, t.Any]] = {}
+        self._last_keyframe: t.Dict[str, float] = {}
+
+        # Counters for comparing against sending every reading
+        self.readings = 0
+        self.messages_sent = 0
+        self.measurements_sent = 0
+
+    def add(self, sensor: str, measurements: t.Dict[str, t.Any], time_: t.Optional[int] = None):
+        """
+        Records a sensor reading, to be sent on the next flush if it changed
+        :param sensor: The sensor name
+        :param measurements: The measured values
+        :param time_: The reading's timestamp in nanoseconds, defaults to now
+        """
+        self._latest.setdefault(sensor, {}).update(measurements)
+        self._pending[sensor] = time.time_ns() if time_ is None else time_
+        self.readings += 1
+
+    def set_deadbands(self, sensor: str, deadbands: t.Dict[str, float]):
+        """Sets the deadbands of some of a sensor's measurements"""
+        self.deadbands.setdefault(sensor, {}).update(deadbands)
+
+    def reset(self):
+        """Forgets what was sent, so every sensor's next message is a keyframe. Call after reconnecting."""
+        self._sent.clear()
+        self._last_keyframe.clear()
+
+    def _changed(self, sensor: str, latest: t.Dict[str, t.Any]) -> t.Dict[str, t.Any]:
+        sent = self._sent.get(sensor, {})
+        deadbands = self.deadbands.get(sensor, {})
+        changed = {}
+        for name, value in latest.items():
+            if name not in sent:
+                changed[name] = value
+                continue
+            old = sent[name]
+            if type(value) in (int, float) and type(old) in (int, float):
+                if abs(value - old) >= deadbands.get(name, 0) and value != old:
+                    changed[name] = value
+            elif value != old:
+                changed[name] = value
+        return changed
+
+    async def flush(self):
+        """Sends the changes of every sensor read since the last flush"""
+        if not self._pending:
+            return
+        now = time.monotonic()
+        messages = []
+        keyframes = set()
+        for sensor, time_ in self._pending.items():
+            latest = self._latest[sensor]
+            if now - self._last_keyframe.get(sensor, -self.keyframe_interval) >= self.keyframe_interval:
+                meas = dict(latest)
+                keyframes.add(sensor)
+            else:
+                meas = self._changed(sensor, latest)
+            if meas:
+                messages.append(SensorDataMessage(time=time_, sensor=sensor, measurements=meas))
+        self._pending.clear()
+
+        if not messages or not await self.send(messages):
+            return
+        for msg in messages:
+            self._sent.setdefault(msg.sensor, {}).update(msg.measurements)
+            self.measurements_sent += len(msg.measurements)
+        for sensor in keyframes:
+            self._last_keyframe[sensor] = now
+        self.messages_sent += len(messages)
+
+    async def run(self):
+        """Flushes every window, forever"""
+        while True:
+            await asyncio.sleep(self.window)
+            await self.flush()
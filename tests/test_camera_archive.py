@@ -0,0 +1,58 @@
+import os
+import time
+
+from camera_archive import CameraArchive, CameraArchiveReader
+
+SECOND = 1_000_000_000
+
+
+def write(directory, frames, **kwargs) -> CameraArchive:
+    archive = CameraArchive(directory, **kwargs)
+    archive.start()
+    for timestamp, frame in frames:
+        assert archive.add(frame, timestamp)
+    archive.close()
+    return archive
+
+
+def test_round_trip(tmp_path):
+    frames = [(i * SECOND, b"frame%d" % i) for i in range(20)]
+    write(tmp_path, frames, segment_seconds=5)
+    reader = CameraArchiveReader(tmp_path)
+    assert len(reader.segments()) == 4
+    assert list(reader.frames()) == frames
+    assert list(reader.frames(3 * SECOND, 12 * SECOND)) == frames[3:12]
+    assert list(reader.frames(7 * SECOND + 1, 8 * SECOND + 1)) == frames[8:9]
+
+
+def test_clock_step_back(tmp_path):
+    # The clock steps back 5 s after frame 9
+    times = [i * SECOND for i in range(10)] + [(i - 5) * SECOND + SECOND // 2 for i in range(10, 20)]
+    frames = [(timestamp, b"frame%d" % i) for i, timestamp in enumerate(times)]
+    write(tmp_path, frames)
+    reader = CameraArchiveReader(tmp_path)
+    assert len(reader.segments()) == 2
+    assert list(reader.frames()) == sorted(frames)
+    assert [timestamp for timestamp, _frame in reader.frames(6 * SECOND, 8 * SECOND)] == [
+        6 * SECOND, 6 * SECOND + SECOND // 2, 7 * SECOND, 7 * SECOND + SECOND // 2
+    ]
+
+
+def test_retention_by_size(tmp_path):
+    frames = [(i * SECOND, bytes(1000)) for i in range(20)]
+    archive = write(tmp_path, frames, segment_seconds=5, max_bytes=12000)
+    # Each segment is 5 frames, about 5 KiB with its index, so only the last two fit
+    assert archive.segments_deleted == 2
+    assert [timestamp for timestamp, _frame in CameraArchiveReader(tmp_path).frames()] == [
+        timestamp for timestamp, _frame in frames[10:]
+    ]
+
+
+def test_retention_by_age(tmp_path):
+    write(tmp_path, [(0, b"old")])
+    old = time.time() - 7200
+    for path in tmp_path.iterdir():
+        os.utime(path, (old, old))
+    archive = write(tmp_path, [(SECOND, b"new")], retention=3600)
+    assert archive.segments_deleted == 1
+    assert list(CameraArchiveReader(tmp_path).frames()) == [(SECOND, b"new")]
@@ -0,0 +1,114 @@
+import functools
+import operator
+
+import pytest
+
+from rover_control.nmea import NmeaStage, parse_sentence
+
+SECOND = 1_000_000_000
+
+
+def sentence(body: str) -> bytes:
+    """Frames a sentence body with its checksum"""
+    checksum = functools.reduce(operator.xor, body.encode(), 0)
+    return f"${body}*{checksum:02X}\r\n".encode()
+
+
+def gga(utc: str, quality: str = "1") -> bytes:
+    return sentence(f"GPGGA,{utc},4807.038,N,01131.000,W,{quality},08,0.9,545.4,M,46.9,M,,")
+
+
+def rmc(utc: str) -> bytes:
+    return sentence(f"GPRMC,{utc},A,4807.038,N,01131.000,W,022.4,084.4,230394,003.1,W")
+
+
+def test_checksum():
+    assert parse_sentence(gga("123519")).kind == "GGA"
+    assert parse_sentence(gga("123519").replace(b"4807", b"4808")) is None
+    assert parse_sentence(b"$GPGGA,123519") is None
+
+
+def test_invalid_sentences_counted():
+    stage = NmeaStage()
+    assert stage.feed(b"garbage\r\n", 0) == (None, None)
+    assert stage.feed(gga("123519").replace(b"*", b"#"), 0) == (None, None)
+    assert stage.invalid == 2
+
+
+@pytest.mark.parametrize("order", ["gga_first", "rmc_first"])
+def test_fuses_either_order(order):
+    stage = NmeaStage(fix_rate=10)
+    first, second = (gga, rmc) if order == "gga_first" else (rmc, gga)
+    # An earlier epoch shows the GPS sends RMC
+    stage.feed(first("123518"), 0)
+    stage.feed(second("123518"), 1)
+    assert stage.feed(first("123519"), SECOND)[1] is None
+    fix_time, fix = stage.feed(second("123519"), SECOND + 100)[1]
+    # Timestamped when the epoch started, and reported as soon as it's complete
+    assert fix_time == SECOND
+    assert fix["time"] == "12:35:19"
+    assert fix["lat"] == pytest.approx(48.1173)
+    assert fix["lon"] == pytest.approx(-11.516667)
+    assert fix["num_sats"] == 8
+    assert fix["date"] == "2094-03-23"
+    assert fix["speed"] == pytest.approx(22.4 * 0.514444)
+    assert fix["course"] == 84.4
+    # Nothing left over for the next epoch
+    assert stage.feed(gga("123520"), 2 * SECOND)[1] is None
+
+
+def test_gga_only_receiver_reports_immediately():
+    stage = NmeaStage()
+    fix_time, fix = stage.feed(gga("123519"), 100)[1]
+    assert fix_time == 100
+    assert "date" not in fix
+
+
+def test_missing_rmc_reported_when_next_epoch_starts():
+    stage = NmeaStage(fix_rate=10)
+    stage.feed(gga("123519"), 0)
+    stage.feed(rmc("123519"), 1)
+    # Epoch 123520 loses its RMC sentence
+    assert stage.feed(gga("123520"), SECOND)[1] is None
+    fix_time, fix = stage.feed(rmc("123521"), 2 * SECOND)[1]
+    assert fix_time == SECOND
+    assert fix["time"] == "12:35:20"
+    assert "date" not in fix
+
+
+def test_no_fix_before_gps_fix():
+    stage = NmeaStage()
+    assert stage.feed(gga("123519", quality="0"), 0)[1] is None
+    assert stage.feed(gga("123520", quality="0"), SECOND)[1] is None
+
+
+def test_rate_tolerates_jitter():
+    stage = NmeaStage(raw_rate=1, fix_rate=1)
+    forwarded = fixes = 0
+    for i in range(100):
+        # 1 Hz, arriving up to 5 ms early or late
+        now = i * SECOND + (5_000_000 if i % 2 else -5_000_000)
+        raw, fix = stage.feed(gga(f"1235{i % 60:02d}"), now)
+        forwarded += raw is not None
+        fixes += fix is not None
+    assert forwarded == 100
+    assert fixes == 100
+
+
+def test_rate_limits_faster_streams():
+    stage = NmeaStage(raw_rate=1, fix_rate=2)
+    forwarded = fixes = 0
+    for i in range(100):
+        # 10 Hz for 10 s
+        raw, fix = stage.feed(gga(f"1235{i // 10:02d}.{i % 10}0"), i * SECOND // 10)
+        forwarded += raw is not None
+        fixes += fix is not None
+    assert 10 <= forwarded <= 11
+    assert 20 <= fixes <= 21
+
+
+def test_filters_sentence_types():
+    stage = NmeaStage(sentences=["RMC"])
+    assert stage.feed(gga("123519"), 0)[0] is None
+    assert stage.feed(rmc("123519"), 0)[0] is not None
+    assert stage.filtered == 1
@@ -0,0 +1,113 @@
+import sqlite3
+import time
+
+from common import NmeaMessage
+from base_station import storage
+from base_station.nmea_archive import MINUTE, NmeaArchive, NmeaArchiveReader
+
+SECOND = storage.SECOND
+# Minutes long over, so they are sealed when the archive closes
+START = (time.time_ns() - 60 * MINUTE) // MINUTE * MINUTE
+
+
+def sentence(i: int) -> str:
+    return f"$GPGGA,{i:06d},4807.038,N,01131.000,E,1,08,0.9,545.4,M,46.9,M,,*47"
+
+
+def archive(path, messages, **kwargs) -> NmeaArchive:
+    nmea = NmeaArchive(path, **kwargs)
+    nmea.start()
+    for msg in messages:
+        assert nmea.add(msg)
+    nmea.close()
+    return nmea
+
+
+def count(path, table: str) -> int:
+    with sqlite3.connect(path) as db:
+        return db.execute(f"select count(*) from {table}").fetchone()[0]
+
+
+def test_sealed_round_trip(tmp_path):
+    path = tmp_path / "data.db"
+    times = [START + i * SECOND for i in range(150)]
+    nmea = archive(path, [NmeaMessage(time=time_, sentence=sentence(i) + "\r\n") for i, time_ in enumerate(times)])
+    assert nmea.stats()["written"] == 150
+    assert nmea.stats()["sealed"] == 3
+    assert nmea.stats()["compression_ratio"] > 1
+    assert count(path, "nmea") == 0
+    assert count(path, "nmea_blocks") == 3
+
+    reader = NmeaArchiveReader(path)
+    assert list(reader.read(START, START + 150 * SECOND)) == [(time_, sentence(i)) for i, time_ in enumerate(times)]
+    # Only the range asked for, across a block boundary
+    assert [time_ for time_, _sentence in reader.read(START + 59 * SECOND, START + 61 * SECOND)] == times[59:61]
+    reader.close()
+
+
+def test_current_minute_stays_rows(tmp_path):
+    path = tmp_path / "data.db"
+    now = time.time_ns()
+    archive(path, [NmeaMessage(time=START, sentence=sentence(0)), NmeaMessage(time=now, sentence=sentence(1))])
+    assert count(path, "nmea") == 1
+    assert count(path, "nmea_blocks") == 1
+    assert list(NmeaArchiveReader(path).read(START, now + 1)) == [(START, sentence(0)), (now, sentence(1))]
+
+
+def test_late_and_replayed_sentences_merge_into_block(tmp_path):
+    path = tmp_path / "data.db"
+    archive(path, [NmeaMessage(time=START + i, sentence=sentence(i)) for i in range(3)])
+    # Replayed from the rover's spool after the minute was sealed, one already stored
+    nmea = archive(path, [
+        NmeaMessage(time=START + 1, sentence=sentence(1), replayed=True),
+        NmeaMessage(time=START + 5, sentence=sentence(5), replayed=True),
+    ])
+    assert nmea.stats()["sealed"] == 1
+    assert count(path, "nmea") == 0
+    assert [time_ - START for time_, _sentence in NmeaArchiveReader(path).read(START, START + MINUTE)] == [0, 1, 2, 5]
+
+
+def test_uncompressed_rows(tmp_path):
+    path = tmp_path / "data.db"
+    archive(path, [
+        NmeaMessage(time=START, sentence=sentence(0)),
+        NmeaMessage(time=START, sentence=sentence(0), replayed=True),
+        NmeaMessage(time=START + 1, sentence=sentence(1)),
+    ], codec=None)
+    assert count(path, "nmea") == 2
+    assert count(path, "nmea_blocks") == 0
+    assert len(list(NmeaArchiveReader(path).read(START, START + MINUTE))) == 2
+
+
+def test_corrupt_block_does_not_stop_archiving(tmp_path):
+    path = tmp_path / "data.db"
+    archive(path, [NmeaMessage(time=START, sentence=sentence(0))])
+    with sqlite3.connect(path) as db:
+        db.execute("update nmea_blocks set data = x'00112233'")
+    nmea = archive(path, [
+        NmeaMessage(time=START + 1, sentence=sentence(1)),
+        NmeaMessage(time=START + MINUTE, sentence=sentence(2)),
+    ])
+    assert nmea.stats()["errors"] == 1
+    # The next minute is still sealed, the corrupt one's new sentence is left as a row
+    assert nmea.stats()["sealed"] == 1
+    assert count(path, "nmea") == 1
+    assert list(NmeaArchiveReader(path).read(START, START + 2 * MINUTE)) == [
+        (START + 1, sentence(1)), (START + MINUTE, sentence(2))
+    ]
+
+
+def test_export_is_read_only(tmp_path):
+    path = tmp_path / "data.db"
+    # A database from before the NMEA blocks, which export must not migrate
+    with sqlite3.connect(path) as db:
+        db.execute("create table nmea (id integer primary key, time integer, sentence text)")
+        db.execute("insert into nmea (time, sentence) values (?, ?)", (START, sentence(0) + "\r\n"))
+    output = tmp_path / "out.nmea"
+    reader = NmeaArchiveReader(path)
+    assert reader.export(output, START, START + MINUTE) == 1
+    reader.close()
+    assert output.read_bytes() == (sentence(0) + "\r\n").encode()
+    with sqlite3.connect(path) as db:
+        assert storage.schema_version(db) == 0
+        assert db.execute("pragma journal_mode").fetchone()[0] == "delete"
@@ -0,0 +1,58 @@
+import asyncio
+import typing as t
+
+from common import NmeaMessage
+from base_station.replay import Replay, merge_by_time
+
+SECOND = 1_000_000_000
+
+
+async def messages(*times: int) -> t.AsyncIterator[NmeaMessage]:
+    for time_ in times:
+        yield NmeaMessage(time=time_, sentence="$GPGGA*00")
+
+
+def play(times: t.Sequence[int], speed: float, changes: t.Sequence[t.Tuple[float, float]] = ()) \
+        -> t.Tuple[Replay, t.List[t.Tuple[int, float]]]:
+    """Plays messages at the given times, changing speed after each (seconds, speed), and records when each is sent"""
+    async def run():
+        loop = asyncio.get_running_loop()
+        sent = []
+        start = loop.time()
+        replay = Replay(messages(*times), lambda msg: sent.append((msg.time, loop.time() - start)), times[0], speed)
+        task = asyncio.create_task(replay.run())
+        for delay, new_speed in changes:
+            await asyncio.sleep(delay)
+            replay.set_speed(new_speed)
+        await task
+        return replay, sent
+
+    return asyncio.run(run())
+
+
+def test_paced_by_timestamps():
+    replay, sent = play([0, SECOND // 10, SECOND // 5], speed=1)
+    assert [time_ for time_, _at in sent] == [0, SECOND // 10, SECOND // 5]
+    assert sent[0][1] < 0.05
+    assert 0.18 < sent[2][1] < 0.3
+    assert replay.position == SECOND // 5
+
+
+def test_speed_change_keeps_progress_through_gap():
+    # A 10 s gap at 100x takes 0.1 s. Slowing to 10x after 0.08 s leaves 2 s of replay time, which takes 0.2 s.
+    # Restarting the gap would take 1 s.
+    _replay, sent = play([0, 10 * SECOND], speed=100, changes=[(0.08, 10)])
+    assert 0.22 < sent[1][1] < 0.5
+
+
+def test_speed_up_sends_sooner():
+    # 1 s of a 10 s gap at 10x has played, the other 9 s take 0.09 s at 100x
+    _replay, sent = play([0, 10 * SECOND], speed=10, changes=[(0.1, 100)])
+    assert 0.15 < sent[1][1] < 0.4
+
+
+def test_merge_by_time():
+    async def run():
+        return [msg.time async for msg in merge_by_time(messages(1, 4, 6), messages(), messages(2, 3, 7))]
+
+    assert asyncio.run(run()) == [1, 2, 3, 4, 6, 7]
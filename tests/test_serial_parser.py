@@ -0,0 +1,68 @@
+import asyncio
+import binascii
+import struct
+
+import pytest
+
+from rover_control.serial_parser import FRAME_SYNC, LogRecord, SensorRecord, parse_line, read_message
+
+
+def frame(frame_type: int, payload: bytes) -> bytes:
+    """Frames a payload as the Arduino does in binary mode"""
+    body = bytes((len(payload) + 1, frame_type)) + payload
+    return bytes((FRAME_SYNC,)) + body + struct.pack(">H", binascii.crc_hqx(body, 0xFFFF))
+
+
+def read_all(data: bytes) -> list:
+    """Reads every message from a byte stream"""
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        messages = []
+        while not reader.at_eof():
+            messages.append(await read_message(reader))
+        return messages
+    return asyncio.run(run())
+
+
+def test_text_lines():
+    assert parse_line(b"data imu 1.5 -2 3.25 30\r\n") == \
+        ("data", SensorRecord("imu", {"roll": 1.5, "pitch": -2.0, "yaw": 3.25, "temp": 30}))
+    assert parse_line(b"data load_current 15\n") == ("data", SensorRecord("load_current", {"current": 1.5}))
+    assert parse_line(b"data imu ovf 1 2 3\n")[1].measurements["roll"] is None
+    assert parse_line(b"data lidar 1 2\n") == ("data", SensorRecord("lidar", None))
+    assert parse_line(b"log warning battery  low\n") == ("log", LogRecord("warning", "battery  low"))
+    assert parse_line(b"hb\n") == ("hb", None)
+    assert parse_line(b"whatever 1\n") == (None, "whatever 1")
+
+
+def test_binary_frames_between_text_lines():
+    data = (
+        b"hb\n"
+        + frame(0x03, struct.pack("<fffb", 1.5, -2.0, 3.25, 30))
+        + b"log info ok\n"
+        + frame(0x04, struct.pack("<h", -15))
+        + b"mode binary\n"
+    )
+    assert read_all(data) == [
+        ("hb", None),
+        ("data", SensorRecord("imu", {"roll": 1.5, "pitch": -2.0, "yaw": 3.25, "temp": 30})),
+        ("log", LogRecord("info", "ok")),
+        ("data", SensorRecord("load_current", {"current": -1.5})),
+        ("mode", "binary"),
+    ]
+
+
+@pytest.mark.parametrize("data, error", [
+    (frame(0x7F, b"\x00"), "Unknown binary frame type 0x7f"),
+    (frame(0x04, b"\x00\x00\x00"), "Binary load_current frame has 3 bytes of payload, expected 2"),
+])
+def test_invalid_frames(data: bytes, error: str):
+    assert read_all(data) == [(None, error)]
+
+
+def test_corrupt_frame_is_skipped():
+    corrupt = bytearray(frame(0x04, struct.pack("<h", 15)))
+    corrupt[3] ^= 0x01
+    assert read_all(bytes(corrupt) + b"hb\n") == [(None, "Corrupt binary frame"), ("hb", None)]
@@ -0,0 +1,45 @@
+import asyncio
+
+from common import SensorDataMessage
+from rover_control.spool import TelemetrySpool
+
+
+def reading(time: int) -> SensorDataMessage:
+    return SensorDataMessage(time=time, sensor="imu", measurements={"roll": float(time)})
+
+
+def test_replay_in_order(tmp_path):
+    async def run():
+        spool = TelemetrySpool(tmp_path, segment_size=200)
+        for time in range(10):
+            await spool.append([reading(time)])
+        sent = []
+
+        async def send(messages):
+            sent.extend(messages)
+        await spool.replay(send, rate=1e6, batch=3)
+        return spool, sent
+
+    spool, sent = asyncio.run(run())
+    assert [msg.time for msg in sent] == list(range(10))
+    assert all(msg.replayed for msg in sent)
+    assert not spool and not list(tmp_path.glob("*.log"))
+
+
+def test_appends_during_replay_are_kept(tmp_path):
+    async def run():
+        spool = TelemetrySpool(tmp_path)
+        await spool.append([reading(0), reading(1)])
+        sent = []
+
+        async def send(messages):
+            sent.extend(messages)
+            if len(sent) == 2:
+                # Written to the segment being replayed if it were still open
+                await spool.append([reading(2)])
+        await spool.replay(send, rate=1e6)
+        return spool, sent
+
+    spool, sent = asyncio.run(run())
+    assert [msg.time for msg in sent] == [0, 1, 2]
+    assert not spool